@@ -14,8 +14,11 @@
 #include <stdio.h>
 #include <signal.h>
 
+#include <sys/mman.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <stdint.h>
+#include <stdlib.h>
 #include <limits.h>
 #include <pthread.h>
 
@@ -31,6 +34,211 @@ static void InterruptHandler(int signo) {
   exit(1);
 }
 
+// Wire protocol, shared with python-controller/rpi_ipc.py.
+// Everything on the pipe is a sequence of frames:
+//   magic ("RM") | version (u8) | body length (u16, little endian) | body
+// and a body is a sequence of commands, an opcode byte followed by fixed
+// width operands.
+static const unsigned char kMagic[2] = { 'R', 'M' };
+static const int kProtocolVersion = 2;
+static const size_t kFrameHeaderSize = 5;
+static const size_t kPixelRecordSize = 5;
+
+enum Opcode {
+  OP_PIXELS = 0x01,  // count (u16), then count * (x, y, r, g, b)
+  OP_CLEAR = 0x02,
+  OP_FILL = 0x03,    // r, g, b
+  OP_EXIT = 0x04,
+  OP_HLINE = 0x05,   // x, y, length, r, g, b
+  OP_VLINE = 0x06,   // x, y, length, r, g, b
+  OP_RECT = 0x07,    // x, y, width, height, r, g, b
+  OP_SHM_FRAME = 0x08,  // buffer (u8), sequence number (u32)
+};
+
+static inline int read_u16(const unsigned char *p) {
+  return p[0] | (p[1] << 8);
+}
+
+static inline uint32_t read_u32(const unsigned char *p) {
+  return p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+// Shared memory transport, shared with python-controller/shm.py. Whole
+// frames are double buffered in a file in /dev/shm, and an SHM_FRAME on the
+// pipe says which buffer to show. The file is laid out as:
+//   magic ("RMFB") | version (u8) | front (u8) | width (u16) | height (u16)
+//   | padding (2) | seq of buffer 0 (u32) | seq of buffer 1 (u32)
+// then, from kShmDataOffset, two buffers of height * width * rgb. A buffer's
+// seq is zero while it's being written.
+static const char kShmPath[] = "/dev/shm/scrimblo_fb";
+static const unsigned char kShmMagic[4] = { 'R', 'M', 'F', 'B' };
+static const int kShmVersion = 1;
+static const size_t kShmSeqOffset = 12;
+static const size_t kShmDataOffset = 32;
+
+struct SharedFrames {
+  int fd;
+  unsigned char *map;
+  size_t size;
+  unsigned char *copy;  // Somewhere to copy a frame to before checking it.
+};
+
+static void unmap_shared_frames(SharedFrames *shm) {
+  if (shm->map != NULL) munmap(shm->map, shm->size);
+  if (shm->fd >= 0) close(shm->fd);
+  free(shm->copy);
+  shm->fd = -1;
+  shm->map = NULL;
+  shm->size = 0;
+  shm->copy = NULL;
+}
+
+// Maps the shared frame file, remapping it if it's been resized since.
+static bool map_shared_frames(SharedFrames *shm) {
+  if (shm->fd < 0) {
+    shm->fd = open(kShmPath, O_RDONLY);
+    if (shm->fd < 0) {
+      fprintf(stderr, "Couldn't open '%s'\n", kShmPath);
+      return false;
+    }
+  }
+
+  struct stat st;
+  if (fstat(shm->fd, &st) < 0) {
+    unmap_shared_frames(shm);
+    return false;
+  }
+
+  if (shm->map != NULL && (size_t)st.st_size == shm->size)
+    return true;
+
+  if (shm->map != NULL) munmap(shm->map, shm->size);
+  free(shm->copy);
+  shm->map = NULL;
+  shm->copy = NULL;
+  shm->size = st.st_size;
+
+  if (shm->size < kShmDataOffset) return false;
+  void *map = mmap(NULL, shm->size, PROT_READ, MAP_SHARED, shm->fd, 0);
+  if (map == MAP_FAILED) {
+    shm->size = 0;
+    return false;
+  }
+
+  shm->map = (unsigned char *)map;
+  shm->copy = (unsigned char *)malloc(shm->size);
+  return shm->copy != NULL;
+}
+
+static inline uint32_t load_seq(const unsigned char *map, int index) {
+  return __atomic_load_n((const uint32_t *)(map + kShmSeqOffset + 4 * index),
+                         __ATOMIC_ACQUIRE);
+}
+
+// Shows a whole frame from shared memory, as long as the buffer still holds
+// frame seq once it's been copied out. If it doesn't, the controller has
+// moved on and another SHM_FRAME is on its way.
+static void apply_shm_frame(Canvas *canvas, SharedFrames *shm, int index,
+                            uint32_t seq) {
+  if (index > 1 || seq == 0 || !map_shared_frames(shm)) return;
+
+  const unsigned char *map = shm->map;
+  if (memcmp(map, kShmMagic, 4) != 0 || map[4] != kShmVersion) {
+    fprintf(stderr, "Bad shared frame header\n");
+    return;
+  }
+
+  int width = read_u16(map + 6);
+  int height = read_u16(map + 8);
+  size_t frame_size = (size_t)width * height * 3;
+  if (kShmDataOffset + 2 * frame_size > shm->size) return;
+
+  if (load_seq(map, index) != seq) return;
+  memcpy(shm->copy, map + kShmDataOffset + index * frame_size, frame_size);
+  __atomic_thread_fence(__ATOMIC_ACQUIRE);
+  if (load_seq(map, index) != seq) return;
+
+  const unsigned char *p = shm->copy;
+  for (int y = 0; y < height; y++)
+    for (int x = 0; x < width; x++, p += 3)
+      canvas->SetPixel(x, y, p[0], p[1], p[2]);
+}
+
+// Applies every command in a frame body to the canvas. Returns false once an
+// EXIT has been seen. A malformed body is dropped from the bad command on.
+static bool apply_frame(Canvas *canvas, SharedFrames *shm,
+                        const unsigned char *body, size_t len) {
+  size_t pos = 0;
+  while (pos < len) {
+    switch (body[pos]) {
+    case OP_CLEAR:
+      canvas->Clear();
+      pos += 1;
+      break;
+
+    case OP_EXIT:
+      return false;
+
+    case OP_FILL:
+      if (pos + 4 > len) return true;
+      canvas->Fill(body[pos + 1], body[pos + 2], body[pos + 3]);
+      pos += 4;
+      break;
+
+    case OP_PIXELS: {
+      if (pos + 3 > len) return true;
+      size_t count = read_u16(body + pos + 1);
+      pos += 3;
+      if (pos + count * kPixelRecordSize > len) return true;
+      for (size_t i = 0; i < count; i++, pos += kPixelRecordSize) {
+        const unsigned char *p = body + pos;
+        canvas->SetPixel(p[0], p[1], p[2], p[3], p[4]);
+      }
+      break;
+    }
+
+    case OP_HLINE: {
+      if (pos + 7 > len) return true;
+      const unsigned char *p = body + pos + 1;
+      for (int x = p[0]; x < p[0] + p[2]; x++)
+        canvas->SetPixel(x, p[1], p[3], p[4], p[5]);
+      pos += 7;
+      break;
+    }
+
+    case OP_VLINE: {
+      if (pos + 7 > len) return true;
+      const unsigned char *p = body + pos + 1;
+      for (int y = p[1]; y < p[1] + p[2]; y++)
+        canvas->SetPixel(p[0], y, p[3], p[4], p[5]);
+      pos += 7;
+      break;
+    }
+
+    case OP_RECT: {
+      if (pos + 8 > len) return true;
+      const unsigned char *p = body + pos + 1;
+      for (int y = p[1]; y < p[1] + p[3]; y++)
+        for (int x = p[0]; x < p[0] + p[2]; x++)
+          canvas->SetPixel(x, y, p[4], p[5], p[6]);
+      pos += 8;
+      break;
+    }
+
+    case OP_SHM_FRAME:
+      if (pos + 6 > len) return true;
+      apply_shm_frame(canvas, shm, body[pos + 1], read_u32(body + pos + 2));
+      pos += 6;
+      break;
+
+    default:
+      fprintf(stderr, "Unknown opcode 0x%02x, dropping rest of frame\n", body[pos]);
+      return true;
+    }
+  }
+  return true;
+}
+
 void read_loop(Canvas *canvas)
 {
   canvas->Fill(0, 0, 0);
@@ -43,113 +251,61 @@ void read_loop(Canvas *canvas)
     return;
   }
 
-	int fd;
-	size_t len;
-	char buf[PIPE_BUF];
-  char text[PIPE_BUF];
+  int fd;
+  ssize_t len;
+  // Frames are at most PIPE_BUF bytes, but a read can end part way through
+  // one; whatever is left over is kept at the front of the buffer for the next
+  // read to complete.
+  unsigned char buf[2 * PIPE_BUF];
+  size_t have = 0;
   printf("entered read_loop\n");
-  
-  int running = 1;
-
-	while (running && !interrupt_received) {
-		fd = open("/home/pi/scrimblopipe", O_RDONLY);
-
-		while ((len = read(fd, buf, PIPE_BUF)) > 0 && !interrupt_received && running) {
-      for (size_t i=0; i<len; i++) {
-        text[i] = buf[i];
-      }
-      text[len] = '\0';
 
-      if (strcmp(text, "EXIT") == 0) {
-        running = 0;
-        break;
-      }
-
-      std::string s(text);
-      std::string delimiter = "|";
-      std::string subdelimiter = ",";
-
-      //printf("str: %s\n", s.c_str());
-
-      bool consumed_token = true;
-      while (consumed_token) {
-        consumed_token = false;
-        bool need_to_parse = true;
-
-        std::string token;
-        if (s.find(delimiter) == std::string::npos) {
-          token = s;
-        }
-        else {
-          token = s.substr(0, s.find(delimiter));
+  int running = 1;
+  SharedFrames shm = { -1, NULL, 0, NULL };
+
+  while (running && !interrupt_received) {
+    fd = open("/home/pi/scrimblopipe", O_RDONLY);
+    have = 0;
+
+    while (running && !interrupt_received
+           && (len = read(fd, buf + have, sizeof(buf) - have)) > 0) {
+      have += len;
+
+      size_t pos = 0;
+      while (running && have - pos >= kFrameHeaderSize) {
+        const unsigned char *frame = buf + pos;
+        if (frame[0] != kMagic[0] || frame[1] != kMagic[1]) {
+          // Lost sync; skip ahead a byte at a time until we find a header.
+          pos++;
+          continue;
         }
 
-        if (strcmp(token.c_str(), "EXIT") == 0) {
-          running = 0;
-          break;
+        size_t body_len = read_u16(frame + 3);
+        if (frame[2] != kProtocolVersion
+            || kFrameHeaderSize + body_len > PIPE_BUF) {
+          fprintf(stderr, "Bad frame header (version %d, length %zu)\n",
+                  frame[2], body_len);
+          pos++;
+          continue;
         }
 
-        if (strcmp(token.c_str(), "CLEAR") == 0) {
-          canvas->Clear();
-          need_to_parse = false;
-        }
+        if (have - pos < kFrameHeaderSize + body_len)
+          break;  // Wait for the rest of this frame.
 
-        bool worked = true;
-        bool filling = false;
-        int values[5];        
-        if (need_to_parse) {
-          for (int i=0; i<5; i++) {
-            std::string subtoken = token.substr(0, token.find(subdelimiter));
-
-            //printf("token;    %s\nsubtoken; %s\n", token.c_str(), subtoken.c_str());
-            int v = 0;
-            try {
-              if (strcmp(subtoken.c_str(), "FILL") == 0) {
-                filling = true;
-              } else {
-                v = stoi(subtoken);
-              }
-            } catch (std::exception &err) {
-              worked = false;
-              break;
-            }
-            values[i] = v;
-
-            if (token.find(subdelimiter) == std::string::npos) {
-              break;
-            }
-            else {
-              token.erase(0, token.find(subdelimiter) + subdelimiter.length());
-            }
-          }
-        }
+        if (!apply_frame(canvas, &shm, frame + kFrameHeaderSize, body_len))
+          running = 0;
 
-        if (worked) {
-          if (need_to_parse) {
-            if (filling) {
-              canvas->Fill(values[2], values[3], values[4]);
-            } else {
-              canvas->SetPixel(values[0], values[1], values[2], values[3], values[4]);
-            }
-          }
-
-          if (s.find(delimiter) == std::string::npos) {
-            break;
-          }
-          else {
-            s.erase(0, s.find(delimiter) + delimiter.length());
-          }
-          consumed_token = true;
-
-          //printf("remaining (%d): %s\n", s.length(), s.c_str());
-        } else {
-          break;
-        }
+        pos += kFrameHeaderSize + body_len;
       }
+
+      memmove(buf, buf + pos, have - pos);
+      have -= pos;
     }
 
-		close(fd);
-	}
+    close(fd);
+  }
+
+  unmap_shared_frames(&shm);
 }
 
 static void DrawOnCanvas(Canvas *canvas) {
@@ -0,0 +1,210 @@
+"""
+Caching for animations that show the same frames over and over, so they're only ever drawn and diffed once.
+
+The first time through, each frame is drawn on a canvas as usual and the message update_changes() makes for it is
+kept. Every time after that, the kept messages are just sent again. Every so often there's a keyframe as well, a
+message that draws the whole frame from scratch, so playing can start (or pick back up) part way through.
+"""
+
+import os
+import tempfile
+from typing import Callable, List, Union
+
+import numpy as np
+
+from canvas import Canvas
+from recording import FrameRecorder, Recording
+
+
+class MessageStore:
+    """
+    An append-only list of messages, kept in one buffer in memory until that reaches memory_limit bytes and spilled
+    to a recording file (see recording.py) after that.
+
+    :param memory_limit: How many bytes of messages to keep in memory
+    :param spill_path: Where to spill to; a temporary file (deleted on close) if not given
+    """
+
+    def __init__(self, memory_limit: int = 8 * 1024 * 1024, spill_path: Union[str, None] = None):
+        self.memory_limit = memory_limit
+        self.spill_path = spill_path
+        self.temporary = False
+
+        # the messages in memory are data[offsets[n]:offsets[n + 1]]
+        self.data = bytearray()
+        self.offsets: List[int] = [0]
+
+        # messages from spilled_from on are in the spill file, written through the recorder and read back through the
+        # recording once there are no more to add
+        self.spilled_from: Union[int, None] = None
+        self.recorder: Union[FrameRecorder, None] = None
+        self.spill: Union[Recording, None] = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory(self) -> int:
+        return len(self.data)
+
+    def append(self, data: bytes) -> int:
+        """
+        Add a message, returning its number.
+        """
+        if self.recorder is None and self.spill is None and len(self.data) + len(data) <= self.memory_limit:
+            self.data += data
+            self.offsets.append(len(self.data))
+        else:
+            if self.spill is not None:
+                raise ValueError("Can't add to a message store once it's finished")
+
+            if self.recorder is None:
+                if self.spill_path is None:
+                    fd, self.spill_path = tempfile.mkstemp(suffix=".rec")
+                    os.close(fd)
+                    self.temporary = True
+
+                self.recorder = FrameRecorder(self.spill_path)
+                self.spilled_from = self.count
+
+            # the time is just the message number; a spill file isn't for replaying
+            self.recorder.record(data, float(self.count))
+
+        self.count += 1
+        return self.count - 1
+
+    def finish(self):
+        # no more messages are coming, so whatever's been spilled can be read back
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+            self.spill = Recording(self.spill_path)
+
+    def __getitem__(self, n: int) -> bytes:
+        if self.spilled_from is not None and n >= self.spilled_from:
+            if self.spill is None:
+                raise ValueError("Spilled messages can't be read until the store is finished")
+
+            return self.spill[n - self.spilled_from]
+
+        return bytes(self.data[self.offsets[n]:self.offsets[n + 1]])
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+
+        if self.temporary and self.spill_path and os.path.exists(self.spill_path):
+            os.unlink(self.spill_path)
+
+
+class AnimationCache:
+    """
+    Plays an animation of length frames on a loop, drawing and diffing each frame the first time round only.
+
+    :param canvas: The canvas the animation is drawn on
+    :param draw: Draws frame n onto the canvas; it'll be called with every n in order the first time round, then
+                 once more with 0 to work out how to get from the last frame back to the first. It has to draw the
+                 same thing for the same n every time
+    :param length: How many frames are in the animation
+    :param keyframe_every: How many frames apart keyframes are
+    :param memory_limit: How many bytes of messages to keep in memory before spilling to disk
+    :param spill_path: Where to spill to, if not a temporary file
+    :param clear_last: Passed to update_changes() for each frame
+    """
+
+    def __init__(
+            self, canvas: Canvas, draw: Callable[[int], None], length: int, keyframe_every: int = 30,
+            memory_limit: int = 8 * 1024 * 1024, spill_path: Union[str, None] = None, clear_last: bool = True
+    ):
+        if length < 1:
+            raise ValueError("An animation needs at least one frame")
+
+        self.canvas = canvas
+        self.draw = draw
+        self.length = length
+        self.keyframe_every = max(1, keyframe_every)
+        self.clear_last = clear_last
+
+        self.store = MessageStore(memory_limit, spill_path)
+        # the message number of each frame's delta (from the frame before it) and of each keyframe. frame 0's delta
+        # is from the last frame, for looping round; the first time through it's sent from whatever came before
+        self.deltas = np.full(length, -1, dtype=np.int64)
+        self.keyframes = np.full((length - 1) // self.keyframe_every + 1, -1, dtype=np.int64)
+
+        # the next frame to send, and whether every frame's been drawn yet
+        self.position = 0
+        self.cached = False
+
+    def __str__(self):
+        return "{} frames, {} keyframes, {} bytes in memory{}".format(
+            self.length, len(self.keyframes), self.store.memory,
+            ", spilled to {}".format(self.store.spill_path) if self.store.spilled_from is not None else ""
+        )
+
+    def _render(self, n: int) -> bytes:
+        self.draw(n)
+        message = self.canvas.update_changes(clear_last=self.clear_last)
+
+        key = n // self.keyframe_every
+        if n % self.keyframe_every == 0 and self.keyframes[key] < 0:
+            self.keyframes[key] = self.store.append(self.canvas.full_frame())
+
+        return message
+
+    def next_message(self) -> bytes:
+        """
+        Move on a frame, returning the message that shows it. The first time round, that means drawing it; after
+        that it's only a lookup.
+        """
+        n = self.position
+        self.position = (n + 1) % self.length
+
+        if self.cached:
+            return self.store[self.deltas[n]]
+
+        message = self._render(n)
+        if n:
+            self.deltas[n] = self.store.append(message)
+
+        if n == self.length - 1:
+            # how to get from the last frame back round to the first
+            self.deltas[0] = self.store.append(self._render(0))
+            self.store.finish()
+            self.cached = True
+
+        return message
+
+    def seek(self, n: int) -> bytes:
+        """
+        Jump to frame n, returning the message that shows it whatever the panel was showing before: the keyframe
+        before it, plus every delta from there. The next message is for the frame after it.
+        """
+        if not self.cached:
+            raise ValueError("Can't seek until every frame has been drawn once")
+
+        n %= self.length
+        key = n - n % self.keyframe_every
+        messages = [self.store[self.keyframes[key // self.keyframe_every]]]
+        messages += [self.store[self.deltas[i]] for i in range(key + 1, n + 1)]
+
+        self.position = (n + 1) % self.length
+        return b"".join(messages)
+
+    def full_frame(self) -> bytes:
+        """
+        A message that draws the last frame sent from scratch, for when the panel's lost track (see
+        PipeWriter.resync()).
+        """
+        if not self.cached:
+            return self.canvas.full_frame()
+
+        return self.seek(self.position - 1)
+
+    def close(self):
+        self.store.close()
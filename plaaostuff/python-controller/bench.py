@@ -0,0 +1,366 @@
+"""
+Benchmarks for the render and encode path, over a set of fixed scenes. Nothing is sent anywhere; messages go into an
+in-memory sink, so this runs on any linux box.
+
+    python3 bench.py [SCENE ...] [--frames N] [--save BASELINE.json] [--compare BASELINE.json] [--threshold 0.1]
+
+For each scene, reports the time per frame, the bytes of protocol (or terminal output) per frame and the peak memory
+per frame: the most allocated at once while drawing a frame, above what was allocated before it. That's a high water
+mark, so it catches big temporary arrays but not lots of small objects made and thrown away one after another.
+--save writes the results out as a baseline, and --compare checks them against one, exiting with an error if anything
+got slower, bigger or hungrier by more than the threshold.
+"""
+
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+from bdfparser import Font
+from PIL import Image
+
+import path
+from animation import AnimationCache
+import rpi_ipc
+from canvas import Canvas, Colour
+from dat import Vector2
+from layers import LayerStack
+from preview import TerminalPreview
+from sprites import Sprites
+from timeseries import TimeSeries, Sparkline
+
+
+DIMENSIONS = Vector2(64, 64)
+
+font = Font(path.from_root("../../fonts/6x12.bdf"))
+font2 = Font(path.from_root("../../fonts/5x7.bdf"))
+
+
+class MemorySink:
+    """
+    Stands in for the matrix pipe (it has the same send() as a PipeWriter), counting what's sent and throwing it away.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+        self.messages = 0
+
+    def send(self, data: bytes) -> bool:
+        self.bytes += len(data)
+        self.messages += 1
+        return True
+
+
+# a scene is set up with the sink to send to, and returns a function that draws and sends frame number i
+Scene = Callable[[MemorySink], Callable[[int], None]]
+
+
+def clock_scene(sink: MemorySink) -> Callable[[int], None]:
+    # the clock.py layout, with a second passing every frame and the sensors changing every few
+    canvas = Canvas(DIMENSIONS)
+    layers = LayerStack(canvas)
+    nav_layer = layers.add_layer(z=0)
+    frame_layer = layers.add_layer(z=1)
+
+    start = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    rng = random.Random(1)
+
+    history = TimeSeries(24 * 60, channels=2)
+    for i in range(24 * 60):
+        history.append(i * 60.0, 15 + 5 * np.sin(i / 100), 50)
+    graph = Sparkline(history, Vector2(45, 7), 24 * 60 * 60)
+
+    def frame(i: int):
+        now = start + datetime.timedelta(seconds=i)
+
+        frame_layer.clear()
+        frame_layer.set_text(Vector2(7, 1), font, now.strftime("%X"), Colour(12, 130, 12))
+        frame_layer.set_text(Vector2(2, 14), font2, now.strftime("%A"), Colour(0, 70, 0))
+        frame_layer.set_text(Vector2(1, 21), font2, now.strftime("%x"), Colour(0, 70, 0))
+        frame_layer.set_text(Vector2(42, 21), font2, "{:-3}C".format(14), Colour(64, 128, 64))
+        frame_layer.set_text(Vector2(42, 28), font2, "{:-3}C".format(12), Colour(32, 64, 32))
+
+        temp, humid = 20 + rng.random() * 5, rng.random() * 100
+        frame_layer.set_text(Vector2(2, 46), font2, "{:5}C".format(round(temp, 1)), Colour(128, 128, 32))
+        frame_layer.set_text(
+            Vector2(36, 46), font2, "{:4}%".format(round(humid, 1)),
+            Colour(128, 128, 128).lerp(Colour(64, 64, 255), humid / 100)
+        )
+        graph.draw(frame_layer, Vector2(1, 27), Colour(128, 128, 32))
+
+        # the focused sensor changes every 4 seconds
+        if i % 4 == 0:
+            nav_layer.clear()
+            nav_layer.set_text(Vector2(2, 35), font2, "{:^12}".format(("bedroom", "outside")[i // 4 % 2]),
+                               Colour(192, 192, 192))
+            nav_layer.set_text(Vector2(1, 56), font2, "<", Colour(192, 192, 192))
+            nav_layer.set_text(Vector2(58, 56), font2, ">", Colour(32, 32, 32))
+            nav_layer.set_text(Vector2(15, 56), font2, "{:3}/{:<3}".format(i // 4 % 2 + 1, 2), Colour(192, 192, 192))
+
+        layers.render()
+        rpi_ipc.send_prot_msg(sink, canvas.update_changes())
+
+    return frame
+
+
+def bouncing_sprites(canvas: Canvas, sprites: int) -> Callable[[int], None]:
+    # hi_bounce.py's sprites, returning a function that moves them along and draws them
+    glyphs = font.glyph("h").draw().concat(font.glyph("i").draw())
+    image = Image.frombytes("RGBA", (glyphs.width(), glyphs.height()), glyphs.tobytes("RGBA"))
+
+    rng = random.Random(sprites)
+    positions = [Vector2(rng.uniform(0, 54), rng.uniform(0, 53)) for _ in range(sprites)]
+    speeds = [
+        Vector2(1 - rng.random() * 2, 1 - rng.random() * 2).normalized() * (rng.randint(50, 150) / 200)
+        for _ in range(sprites)
+    ]
+    cols = [Colour(rng.randint(0, 192), rng.randint(64, 255), rng.randint(0, 192)) for _ in range(sprites)]
+
+    def draw(i: int):
+        for pos, speed, col in zip(positions, speeds, cols):
+            pos += speed
+            if not (0 <= pos.x < 54):
+                speed *= Vector2(-1, 1)
+                pos.x = max(0, min(54, pos.x))
+            if not (0 <= pos.y < 53):
+                speed *= Vector2(1, -1)
+                pos.y = max(0, min(53, pos.y))
+
+            canvas.set_image(pos.floor_to_intvec(), image, col)
+
+    return draw
+
+
+def bounce_scene(sprites: int) -> Scene:
+    # hi_bounce.py, with a fixed number of sprites
+    def scene(sink: MemorySink) -> Callable[[int], None]:
+        canvas = Canvas(DIMENSIONS)
+        draw = bouncing_sprites(canvas, sprites)
+
+        def frame(i: int):
+            draw(i)
+            rpi_ipc.send_prot_msg(sink, canvas.update_changes(clear_last=True))
+
+        return frame
+
+    return scene
+
+
+def sprites_scene(sprites: int) -> Scene:
+    # hi_bounce.py as it is now, with a fixed number of sprites moved and drawn by Sprites
+    def scene(sink: MemorySink) -> Callable[[int], None]:
+        canvas = Canvas(DIMENSIONS)
+        glyphs = font.glyph("h").draw().concat(font.glyph("i").draw())
+        image = Image.frombytes("RGBA", (glyphs.width(), glyphs.height()), glyphs.tobytes("RGBA"))
+
+        rng = random.Random(sprites)
+        group = Sprites(np.asarray(image)[:, :, 3] > 0, Vector2(0, 0), Vector2(54, 53), capacity=sprites, seed=sprites)
+        for _ in range(sprites):
+            group.add(
+                Vector2(rng.uniform(0, 54), rng.uniform(0, 53)),
+                Vector2(1 - rng.random() * 2, 1 - rng.random() * 2).normalized() * (rng.randint(50, 150) / 200)
+            )
+
+        def frame(i: int):
+            group.step()
+            group.draw(canvas)
+            rpi_ipc.send_prot_msg(sink, canvas.update_changes(clear_last=True))
+
+        return frame
+
+    return scene
+
+
+def fill_scene(sink: MemorySink) -> Callable[[int], None]:
+    # fill_test.py; the whole screen changes colour every frame
+    canvas = Canvas(DIMENSIONS)
+    cols = (Colour(255, 0, 0), Colour(0, 255, 0), Colour(0, 0, 255), Colour(255, 255, 255))
+
+    def frame(i: int):
+        canvas.set_fill(Canvas.FILLTYPE.FILL, cols[i % len(cols)])
+        rpi_ipc.send_prot_msg(sink, canvas.update_changes(clear_last=True))
+
+    return frame
+
+
+def scroll_scene(sink: MemorySink) -> Callable[[int], None]:
+    # a line of text scrolling right to left, a pixel a frame
+    canvas = Canvas(DIMENSIONS)
+    text = "the quick brown fox jumps over the lazy dog"
+    width = len(text) * 6
+
+    def frame(i: int):
+        x = DIMENSIONS.x - i % (width + DIMENSIONS.x)
+        canvas.set_text(Vector2(x, 26), font, text, Colour(255, 128, 0))
+        rpi_ipc.send_prot_msg(sink, canvas.update_changes(clear_last=True))
+
+    return frame
+
+
+def scroll_cached_scene(sink: MemorySink) -> Callable[[int], None]:
+    # scroll_text through an AnimationCache, so after the first time round it's only sending what it kept
+    canvas = Canvas(DIMENSIONS)
+    text = "the quick brown fox jumps over the lazy dog"
+    width = len(text) * 6
+
+    def draw(n: int):
+        canvas.set_text(Vector2(DIMENSIONS.x - n, 26), font, text, Colour(255, 128, 0))
+
+    animation = AnimationCache(canvas, draw, width + DIMENSIONS.x)
+    # go round once before anything's measured, so the frames measured are all played back from the cache
+    for _ in range(animation.length):
+        animation.next_message()
+
+    def frame(i: int):
+        rpi_ipc.send_prot_msg(sink, animation.next_message())
+
+    return frame
+
+
+def terminal_scene(incremental: bool) -> Scene:
+    # the --print-canvas output for 10 bouncing sprites, either the incremental preview or str(canvas).
+    # what's counted is the bytes of terminal output rather than protocol
+    def scene(sink: MemorySink) -> Callable[[int], None]:
+        canvas = Canvas(DIMENSIONS)
+        preview = TerminalPreview(DIMENSIONS)
+        draw = bouncing_sprites(canvas, 10)
+
+        def frame(i: int):
+            draw(i)
+            canvas.update_changes(clear_last=True, encode=False)
+            output = preview.render(canvas.current_canvas, canvas.updated_regions) if incremental else str(canvas)
+            sink.send(output.encode())
+
+        return frame
+
+    return scene
+
+
+SCENES: Dict[str, Scene] = {
+    "clock": clock_scene,
+    "bounce_1": bounce_scene(1),
+    "bounce_10": bounce_scene(10),
+    "bounce_100": bounce_scene(100),
+    "sprites_10": sprites_scene(10),
+    "sprites_100": sprites_scene(100),
+    "sprites_500": sprites_scene(500),
+    "fill": fill_scene,
+    "scroll_text": scroll_scene,
+    "scroll_cached": scroll_cached_scene,
+    "terminal_str": terminal_scene(False),
+    "terminal_preview": terminal_scene(True),
+}
+
+
+def run_scene(scene: Scene, frames: int, warmup: int = 20) -> Dict[str, float]:
+    """
+    Run a scene for a number of frames (after some warmup ones that aren't counted), returning its results.
+    """
+    # timed first, without tracemalloc slowing everything down
+    sink = MemorySink()
+    frame = scene(sink)
+    for i in range(warmup):
+        frame(i)
+
+    sink.bytes = 0
+    times: List[int] = []
+    for i in range(warmup, warmup + frames):
+        start = time.perf_counter_ns()
+        frame(i)
+        times.append(time.perf_counter_ns() - start)
+
+    sent = sink.bytes
+
+    # then again for memory. the peak allocated during each frame, above what was already allocated
+    frame = scene(MemorySink())
+    for i in range(warmup):
+        frame(i)
+
+    tracemalloc.start()
+    peaks = 0
+    for i in range(warmup, warmup + frames):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        frame(i)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks += peak - before
+    tracemalloc.stop()
+
+    times_ms = np.array(times) / 1e6
+    return {
+        "ms_per_frame": float(np.mean(times_ms)),
+        "ms_median": float(np.median(times_ms)),
+        "ms_p95": float(np.percentile(times_ms, 95)),
+        "bytes_per_frame": sent / frames,
+        "peak_kb_per_frame": peaks / frames / 1024,
+    }
+
+
+# what's compared against a baseline, and what's just for information
+COMPARED = ("ms_median", "bytes_per_frame", "peak_kb_per_frame")
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> bool:
+    """
+    Print how the results compare to a baseline. Returns False if anything's regressed by more than threshold.
+    """
+    ok = True
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric in COMPARED:
+            old, new = baseline[name].get(metric), result[metric]
+            if not old:
+                continue
+
+            change = (new - old) / old
+            regressed = change > threshold
+            ok &= not regressed
+            print("{:18} {:20} {:10.3f} -> {:10.3f} ({:+.1%}){}".format(
+                name, metric, old, new, change, "  REGRESSION" if regressed else ""
+            ))
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the render and encode path.")
+    parser.add_argument("scenes", nargs="*", help="scenes to run (default: all of {})".format(", ".join(SCENES)))
+    parser.add_argument("--frames", type=int, default=300, help="frames to measure per scene")
+    parser.add_argument("--save", help="save the results as a baseline")
+    parser.add_argument("--compare", help="compare the results to a baseline")
+    parser.add_argument("--threshold", type=float, default=0.1, help="how much worse counts as a regression")
+    args = parser.parse_args()
+
+    for name in args.scenes:
+        if name not in SCENES:
+            parser.error("unknown scene {}".format(name))
+
+    results = {}
+    print("{:18} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+        "scene", "ms/frame", "median", "p95", "bytes/frame", "peak KB"
+    ))
+    for name in args.scenes or SCENES:
+        result = results[name] = run_scene(SCENES[name], args.frames)
+        print("{:18} {:10.3f} {:10.3f} {:10.3f} {:12.1f} {:12.1f}".format(
+            name, result["ms_per_frame"], result["ms_median"], result["ms_p95"], result["bytes_per_frame"],
+            result["peak_kb_per_frame"]
+        ))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        print()
+        if not compare(results, baseline, args.threshold):
+            sys.exit(1)
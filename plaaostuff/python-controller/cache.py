@@ -0,0 +1,142 @@
+"""
+A cache for data from remote sources (like the weather), kept fresh in the background and saved to disk so there's
+something to show straight away after a restart.
+"""
+
+import asyncio
+import json
+import os
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Union
+
+
+class CachedSource:
+    """
+    Caches whatever a fetch function returns. The cached value is always what gets shown, even once it's stale;
+    refreshes happen in the background (see run()) and only replace it when they succeed. Failed refreshes are retried
+    with exponential backoff.
+
+    The value has to be something json can store, since it's saved to path after every successful refresh and loaded
+    back from there on startup.
+
+    :param fetch: A coroutine function returning the latest value
+    :param ttl: How long a value stays fresh for, in seconds
+    :param path: Where to save the value, if anywhere
+    :param max_age: How old a value can get before it's too stale to show at all, in seconds (None to always show it)
+    :param timeout: How long a fetch gets before it's given up on, in seconds
+    :param backoff: How long to wait before retrying after the first failure, in seconds; doubles with every failure
+    :param max_backoff: The longest to ever wait before retrying, in seconds
+    """
+
+    def __init__(
+            self, fetch: Callable[[], Awaitable[Any]], ttl: float, path: Union[str, None] = None,
+            max_age: Union[float, None] = None, timeout: Union[float, None] = 30, backoff: float = 30,
+            max_backoff: float = 30 * 60
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.path = path
+        self.max_age = max_age
+        self.timeout = timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._value = None
+        # wall clock time, so it still means something after a restart
+        self.fetched_at: Union[float, None] = None
+
+        self.failures = 0
+        self.retry_at = 0.0
+
+        if path:
+            self.load()
+
+    @property
+    def age(self) -> Union[float, None]:
+        if self.fetched_at is None:
+            return None
+
+        return time.time() - self.fetched_at
+
+    @property
+    def stale(self) -> bool:
+        return self.fetched_at is None or self.age >= self.ttl
+
+    @property
+    def value(self) -> Any:
+        # the latest value we have, fresh or not. None if we've never had one or it's past max_age
+        if self.fetched_at is None or (self.max_age is not None and self.age > self.max_age):
+            return None
+
+        return self._value
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+
+            self._value = saved["value"]
+            self.fetched_at = float(saved["fetched_at"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            # a broken cache file is no worse than no cache file
+            traceback.print_exc()
+
+    def save(self):
+        # written to a temporary file and then moved over the old one, so a crash halfway through a write (or a pkill
+        # from restart.sh) never leaves a half-written cache behind
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as f:
+            json.dump({"value": self._value, "fetched_at": self.fetched_at}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.path)
+
+    def next_refresh(self) -> float:
+        # when the next refresh is due, on the wall clock
+        if self.failures:
+            return self.retry_at
+
+        if self.fetched_at is None:
+            return 0.0
+
+        return self.fetched_at + self.ttl
+
+    async def refresh(self) -> bool:
+        """
+        Fetch a new value, keeping the old one if it fails. Returns whether it worked.
+        """
+        try:
+            value = await asyncio.wait_for(self.fetch(), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failures += 1
+            self.retry_at = time.time() + min(self.backoff * 2 ** (self.failures - 1), self.max_backoff)
+            return False
+
+        self._value = value
+        self.fetched_at = time.time()
+        self.failures = 0
+
+        if self.path:
+            try:
+                self.save()
+            except OSError:
+                traceback.print_exc()
+
+        return True
+
+    async def run(self):
+        """
+        Keep the value fresh forever. Meant to be run as a background task, e.g. with Runtime.add_task().
+        """
+        while True:
+            wait = self.next_refresh() - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            await self.refresh()
@@ -0,0 +1,115 @@
+"""
+Per-panel calibration; a per-pixel, per-channel gain applied to everything on its way out to the panel.
+
+Run this file with a path to write out the built-in calibration as a .npy file, ready for editing and loading back
+with Calibration.load(), or giving to clock.py, hi_bounce.py or fill_test.py with --calibration:
+
+    python3 calibration.py panel.npy
+    python3 clock.py --calibration panel.npy
+"""
+
+import sys
+from typing import Dict, Iterable, Tuple, Union
+
+import numpy as np
+
+from dat import Vector2, Rect
+
+
+# dropped the matrix! lol
+# these pixels are completely dead
+DEAD_PIXELS = (
+    Vector2(0, 0),
+    Vector2(0, 1),
+    Vector2(0, 2),
+    Vector2(1, 0),
+
+    Vector2(63, 0),
+
+    Vector2(62, 61),
+    Vector2(62, 62),
+    Vector2(62, 63),
+
+    Vector2(63, 61),
+    Vector2(63, 62),
+    Vector2(63, 63)
+)
+
+# and these have individual channels (0 = r, 1 = g, 2 = b) that don't work
+# (the green led is broken at (4, 35))
+DEAD_CHANNELS: Dict[Vector2, Tuple[int, ...]] = {
+    Vector2(4, 35): (1,)
+}
+
+
+class Calibration:
+    """
+    A gain for every channel of every pixel, as a (height, width, 3) array; 1 leaves a channel alone, 0 turns it off
+    and anything in between dims it.
+
+    :param gain: The gain array
+    """
+
+    def __init__(self, gain: np.ndarray):
+        self.gain: np.ndarray = np.asarray(gain, dtype=np.float32)
+        if self.gain.ndim != 3 or self.gain.shape[2] != 3:
+            raise ValueError("Calibration gain must be a (height, width, 3) array, not {}".format(self.gain.shape))
+
+        # every pixel the calibration does anything to
+        self.adjusted: np.ndarray = np.any(self.gain != 1, axis=2)
+        self.identity = not self.adjusted.any()
+
+    @classmethod
+    def uniform(cls, dimensions: Vector2) -> "Calibration":
+        return cls(np.ones((dimensions.y, dimensions.x, 3), dtype=np.float32))
+
+    @classmethod
+    def from_dead(
+            cls, dimensions: Vector2, dead_pixels: Iterable[Vector2] = (),
+            dead_channels: Union[Dict[Vector2, Tuple[int, ...]], None] = None
+    ) -> "Calibration":
+        gain = np.ones((dimensions.y, dimensions.x, 3), dtype=np.float32)
+        for pixel in dead_pixels:
+            if (0 <= pixel.x < dimensions.x) and (0 <= pixel.y < dimensions.y):
+                gain[pixel.y, pixel.x] = 0
+
+        for pixel, channels in (dead_channels or {}).items():
+            if (0 <= pixel.x < dimensions.x) and (0 <= pixel.y < dimensions.y):
+                gain[pixel.y, pixel.x, list(channels)] = 0
+
+        return cls(gain)
+
+    @classmethod
+    def default(cls, dimensions: Vector2) -> "Calibration":
+        # our panel
+        return cls.from_dead(dimensions, DEAD_PIXELS, DEAD_CHANNELS)
+
+    @classmethod
+    def load(cls, path: str) -> "Calibration":
+        return cls(np.load(path))
+
+    def save(self, path: str):
+        np.save(path, self.gain)
+
+    def apply(self, frame: np.ndarray, region: Union[Rect, None] = None) -> np.ndarray:
+        """
+        Return a calibrated copy of a frame, or of the part of one covering region.
+
+        :param frame: An (h, w, 3) array of colours
+        :param region: Where frame sits on the panel, if it isn't the whole thing
+        """
+        if self.identity:
+            return frame.copy()
+
+        gain = self.gain if region is None else self.gain[region.slices()]
+        out = np.multiply(frame, gain, dtype=np.float32)
+        np.rint(out, out=out)
+        return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python3 calibration.py <output.npy>")
+        sys.exit(1)
+
+    Calibration.default(Vector2(64, 64)).save(sys.argv[1])
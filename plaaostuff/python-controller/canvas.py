@@ -1,26 +1,73 @@
+import numbers
 from enum import Enum
-from typing import List, Dict, Union, Tuple
+from typing import Dict, List, Union, Tuple
 
 import bdfparser
+import numpy as np
 
-from dat import Vector2
+from dat import Vector2, Rect, merge_rects, bounding_rect
 from PIL import Image
+import rpi_ipc
+import timing
+from textcache import TextCache
+from calibration import Calibration
 
 
 class Colour:
+    # colours are shared (see __new__), so treat them as immutable
+    __slots__ = ("r", "g", "b", "packed")
+
     black = None
     white = None
     red = None
     green = None
     blue = None
 
-    def __init__(self, r: int, g: int, b: int, ignore_validation=False):
-        self.initialised = False
-        self.r: int = r if ignore_validation else max(0, min(255, r))
-        self.g: int = g if ignore_validation else max(0, min(255, g))
-        self.b: int = b if ignore_validation else max(0, min(255, b))
+    # every in-range colour made is kept here (up to a limit) and handed back instead of a new object
+    INTERN_LIMIT = 4096
+    interned: Dict[int, "Colour"] = {}
+
+    def __new__(cls, r: int, g: int, b: int, ignore_validation=False):
+        if not ignore_validation:
+            r = max(0, min(255, r))
+            g = max(0, min(255, g))
+            b = max(0, min(255, b))
+
+        # integers from numpy (e.g. a pixel read out of an array) are made plain ints, so they pack and compare the
+        # same as everything else. floats are left alone
+        if type(r) is not int and isinstance(r, numbers.Integral):
+            r = int(r)
+        if type(g) is not int and isinstance(g, numbers.Integral):
+            g = int(g)
+        if type(b) is not int and isinstance(b, numbers.Integral):
+            b = int(b)
+
+        # in-range integer colours are packed into 24 bits for hashing and comparing.
+        # anything else (e.g. the intermediate results of arithmetic) falls back to a tuple
+        packed = None
+        if type(r) is int and type(g) is int and type(b) is int and 0 <= r <= 255 and 0 <= g <= 255 and 0 <= b <= 255:
+            packed = (r << 16) | (g << 8) | b
+            if cls is Colour:
+                existing = Colour.interned.get(packed)
+                if existing is not None:
+                    return existing
+
+        self = object.__new__(cls)
+        self.r: int = r
+        self.g: int = g
+        self.b: int = b
+
+        if packed is None:
+            self.packed = (r, g, b)
+        else:
+            self.packed = packed
+            if cls is Colour and len(Colour.interned) < Colour.INTERN_LIMIT:
+                Colour.interned[packed] = self
+
+        return self
 
-        self.initialised = True
+    def __getnewargs__(self):
+        return self.r, self.g, self.b, True
 
     @staticmethod
     def check_type(other):
@@ -43,11 +90,17 @@ class Colour:
     def __str__(self):
         return "{},{},{}".format(self.r, self.g, self.b)
 
+    def __repr__(self):
+        return "Colour({}, {}, {})".format(self.r, self.g, self.b)
+
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        if not isinstance(other, Colour):
+            return NotImplemented
+
+        return self.packed == other.packed
 
     def __hash__(self):
-        return hash((self.r, self.g, self.b))
+        return hash(self.packed)
 
     def __neg__(self):
         return Colour(255 - self.r, 255 - self.g, 255 - self.b)
@@ -95,179 +148,293 @@ Colour.green = Colour(0, 255, 0)
 Colour.blue = Colour(0, 0, 255)
 
 
-class Canvas:
-    broken_pixels = {
-        Vector2(0, 0),
-        Vector2(0, 1),
-        Vector2(0, 2),
-        Vector2(1, 0),
+class Surface:
+    """
+    Something that can be drawn on. Drawing doesn't show up anywhere by itself; changes holds the colours that have
+    been set, changes_mask which pixels have been set at all and damage the areas that have been drawn to.
 
-        Vector2(63, 0),
+    :param dimensions: The size of the surface
+    :param text_cache: The cache to render text through, if not the shared one
+    """
 
-        Vector2(62, 61),
-        Vector2(62, 62),
-        Vector2(62, 63),
+    # rendered text is shared between every surface unless one is given its own cache
+    text_cache = TextCache()
 
-        Vector2(63, 61),
-        Vector2(63, 62),
-        Vector2(63, 63)
-    }
+    # how many damage rects can pile up between merges, and how many are allowed to survive one.
+    # past that it's cheaper to treat everything in their bounding box as damaged
+    DAMAGE_MERGE_THRESHOLD = 256
+    MAX_DAMAGE_RECTS = 32
 
-    class FILLTYPE(Enum):
-        NONE = 0
-        CLEAR = 1
-        FILL = 2
+    def __init__(self, dimensions: Vector2, text_cache: Union[TextCache, None] = None):
+        self.dimensions = dimensions
+        if text_cache is not None:
+            self.text_cache = text_cache
+
+        # everything is held in (height, width, 3) arrays indexed [y, x]
+        shape = (dimensions.y, dimensions.x)
+        self.changes: np.ndarray = np.zeros(shape + (3,), dtype=np.uint8)
+        self.changes_mask: np.ndarray = np.zeros(shape, dtype=bool)
+        self.damage: List[Rect] = []
+
+    def _add_damage(self, rect: Rect):
+        damage = self.damage
+        if damage and damage[-1].touches(rect):
+            damage[-1] = damage[-1].union(rect)
+            return
 
-    class Pixel:
-        def __init__(self, pos: Vector2, col: Colour):
-            self.pos = pos
-            self.col = col
+        damage.append(rect)
+        if len(damage) > Surface.DAMAGE_MERGE_THRESHOLD:
+            self.damage = merge_rects(damage)
+            if len(self.damage) > Surface.MAX_DAMAGE_RECTS:
+                self.damage = [bounding_rect(self.damage)]
 
-        def __str__(self):
-            # special case; if the pixel is at (4, 35), disable the green colour channel
-            # (the green led is broken here)
+    @staticmethod
+    def _rgb(col: Colour) -> Tuple[int, int, int]:
+        packed = col.packed
+        if type(packed) is int:
+            return packed >> 16, (packed >> 8) & 0xff, packed & 0xff
 
-            col = self.col
-            if self.pos == Vector2(4, 35):
-                col = Colour(col.r, 0, col.b)
+        # colours built with ignore_validation can go out of range, which won't fit into a uint8
+        return max(0, min(255, int(col.r))), max(0, min(255, int(col.g))), max(0, min(255, int(col.b)))
 
-            # dropped the matrix! lol
-            if self.pos in Canvas.broken_pixels:
-                col = Colour(0, 0, 0)
+    def set_pixel(self, pos: Vector2, col: Colour):
+        if not ((0 <= pos.x < self.dimensions.x) and (0 <= pos.y < self.dimensions.y)):
+            return
 
-            return "{},{}|".format(str(self.pos), str(col))
+        self.changes[pos.y, pos.x] = Surface._rgb(col)
+        self.changes_mask[pos.y, pos.x] = True
+        self._add_damage(Rect(pos.x, pos.y, 1, 1))
+
+    def _clip(self, pos: Vector2, h: int, w: int):
+        # works out which part of an (h, w) source drawn at pos lands on the canvas.
+        # returns the rect it covers on the canvas and the (y, x) slices into the source, or None if none of it does
+        x0, y0 = max(pos.x, 0), max(pos.y, 0)
+        x1, y1 = min(pos.x + w, self.dimensions.x), min(pos.y + h, self.dimensions.y)
+        if x0 >= x1 or y0 >= y1:
+            return None
+
+        return (
+            Rect(x0, y0, x1 - x0, y1 - y0),
+            (slice(y0 - pos.y, y1 - pos.y), slice(x0 - pos.x, x1 - pos.x))
+        )
 
-    def __init__(self, dimensions: Vector2):
-        self.dimensions = dimensions
+    def set_pixels(self, pos: Vector2, colours: np.ndarray, mask: Union[np.ndarray, None] = None):
+        # copies an (h, w, 3) array of colours onto the surface, only where mask is true if one's given
+        h, w = colours.shape[:2]
+        region = self._clip(pos, h, w)
+        if region is None:
+            return
+
+        rect, src = region
+        dest = rect.slices()
+        if mask is None:
+            self.changes[dest] = colours[src]
+            self.changes_mask[dest] = True
+        else:
+            mask = mask[src]
+            self.changes[dest][mask] = colours[src][mask]
+            self.changes_mask[dest] |= mask
+
+        self._add_damage(rect)
+
+    def set_image(self, pos: Vector2, image_draw: Image, override_col: Union[Colour, None] = None):
+        image = image_draw
+        if image_draw.mode != "RGBA":
+            image = image_draw.convert("RGBA")
+
+        pixels = np.asarray(image)
+        opaque = pixels[:, :, 3] > 0
+
+        if override_col:
+            self.set_mask(pos, opaque, override_col)
+        else:
+            self.set_pixels(pos, pixels[:, :, :3], opaque)
+
+    def set_mask(self, pos: Vector2, mask: np.ndarray, col: Colour):
+        # sets every pixel where the (height, width) mask is true, clipped to the canvas
+        region = self._clip(pos, *mask.shape)
+        if region is None:
+            return
+
+        rect, src = region
+        dest = rect.slices()
+        mask = mask[src]
+        self.changes[dest][mask] = Surface._rgb(col)
+        self.changes_mask[dest] |= mask
+        self._add_damage(rect)
+
+    def set_masks(self, positions: np.ndarray, mask: np.ndarray, colours: np.ndarray):
+        # draws the same (height, width) mask at every one of an (n, 2) array of integer (x, y) positions, each in its
+        # own colour from an (n, 3) array, all in one go. where they overlap, later ones are drawn over earlier ones
+        if not len(positions):
+            return
+
+        dy, dx = np.nonzero(mask)
+        xs = positions[:, 0:1] + dx
+        ys = positions[:, 1:2] + dy
+        inside = (xs >= 0) & (xs < self.dimensions.x) & (ys >= 0) & (ys < self.dimensions.y)
+
+        cols = np.broadcast_to(colours[:, None, :], xs.shape + (3,))[inside]
+        xs, ys = xs[inside], ys[inside]
+        if not len(xs):
+            return
+
+        # numpy assigns repeated indices in order, so the last sprite over a pixel wins
+        self.changes[ys, xs] = cols
+        self.changes_mask[ys, xs] = True
+
+        # a rect per mask while there are few enough to be worth it, otherwise just the box around all of them
+        if len(positions) <= Surface.MAX_DAMAGE_RECTS:
+            for x, y in positions.tolist():
+                region = self._clip(Vector2(x, y), *mask.shape)
+                if region is not None:
+                    self._add_damage(region[0])
+        else:
+            x0, y0 = int(xs.min()), int(ys.min())
+            self._add_damage(Rect(x0, y0, int(xs.max()) - x0 + 1, int(ys.max()) - y0 + 1))
+
+    def set_text(self, pos: Vector2, font: bdfparser.Font, text: str, col: Colour):
+        with timing.span("text"):
+            mask = self.text_cache.get(font, text)
+            if mask is not None:
+                self.set_mask(pos, mask, col)
+
+
+class Canvas(Surface):
+    class FILLTYPE(Enum):
+        NONE = 0
+        CLEAR = 1
+        FILL = 2
+
+    def __init__(
+            self, dimensions: Vector2, text_cache: Union[TextCache, None] = None,
+            calibration: Union[Calibration, None] = None
+    ):
+        super().__init__(dimensions, text_cache)
+
+        # everything sent out to the panel goes through this; by default it's the calibration for our panel
+        self.calibration: Calibration = calibration if calibration is not None else Calibration.default(dimensions)
+        if self.calibration.gain.shape[:2] != (dimensions.y, dimensions.x):
+            raise ValueError("Calibration is for a {}x{} panel, not {}x{}".format(
+                self.calibration.gain.shape[1], self.calibration.gain.shape[0], dimensions.x, dimensions.y
+            ))
 
         self.fill: Canvas.FILLTYPE = Canvas.FILLTYPE.NONE
         self.fill_col: Colour = Colour.black
 
-        self.previous_changes: Dict[Vector2, Canvas.Pixel] = {}
-        self.changes: Dict[Vector2, Canvas.Pixel] = {}
+        # current_canvas is what the board looks like as of the last update_changes() call,
+        # and the changes since then are drawn on top of it
+        shape = (dimensions.y, dimensions.x)
+        self.current_canvas: np.ndarray = np.zeros(shape + (3,), dtype=np.uint8)
+        self.previous_mask: np.ndarray = np.zeros(shape, dtype=bool)
 
-        self.current_canvas: List[List[Colour]] = [
-            [Colour.black for _ in range(dimensions.y)] for __ in range(dimensions.x)
-        ]
+        # the areas drawn to in the frame before this one,
+        # and every (merged, non-overlapping) area the last update_changes() call touched. nothing outside those can
+        # have changed, so things that follow the canvas (like a TerminalPreview) only need to look inside them
+        self.previous_damage: List[Rect] = []
+        self.updated_regions: List[Rect] = []
 
     def __str__(self):
+        rows = self.current_canvas.tolist()
         return "\n".join(
-            "".join("\x1b[38;2;{};{};{}m##".format(
-                self.current_canvas[x][y].r, self.current_canvas[x][y].g, self.current_canvas[x][y].b
-            ) for x in range(self.dimensions.x))
-        for y in range(self.dimensions.y)) + "\x1b[0m"
+            "".join("\x1b[38;2;{};{};{}m##".format(r, g, b) for r, g, b in row)
+        for row in rows) + "\x1b[0m"
 
-    def update_changes(self, clear_last: bool = False) -> str:
-        # this function will edit the board to the new state and return a string for sending through to the pipe.
+    def update_changes(self, clear_last: bool = False, encode: bool = True) -> bytes:
+        # this function will edit the board to the new state and return a message for sending through to the pipe.
+        # without encode, only the board is updated (for when something else works out what to send, like a
+        # CoalescingSender) and the message is left empty
 
-        changes_string = ""
+        encoder = rpi_ipc.FrameEncoder(calibration=self.calibration)
+        damage = merge_rects(self.damage)
 
         # first, fill
         filled = False
 
         if self.fill == Canvas.FILLTYPE.CLEAR:
-            changes_string += "CLEAR|"
+            encoder.clear()
             filled = True
             self.fill_col = Colour.black
 
-            self.current_canvas: List[List[Colour]] = [
-                [Colour.black for _ in range(self.dimensions.y)] for __ in range(self.dimensions.x)
-            ]
+            self.current_canvas[:] = 0
 
         elif self.fill == Canvas.FILLTYPE.FILL:
-            changes_string += "FILL,0,{}|".format(str(self.fill_col))
-
-            # need to insert an instruction here to turn off the green LED at (4, 35)
-            changes_string += "4,35,{},0,{}|".format(
-                self.fill_col.r,
-                self.fill_col.b
-            )
-
-            # dropped the matrix so turn off all the broken pixels if we fill
-            for pixel in Canvas.broken_pixels:
-                changes_string += "{},0,0,0|".format(
-                    str(pixel)
-                )
-
-            self.current_canvas: List[List[Colour]] = [
-                [self.fill_col for _ in range(self.dimensions.y)] for __ in range(self.dimensions.x)
-            ]
+            fill_rgb = Surface._rgb(self.fill_col)
+            encoder.fill(*fill_rgb)
+            self.current_canvas[:] = fill_rgb
 
             filled = True
 
-        # then handle every colour change
-        for change in self.changes.values():
-            # if the change's colour is the same as the current board's colour,
-            if change.col == self.get_pixel(change.pos, wrt_changes=False):
-                # don't change anything
-                pass
-            else:
-                changes_string += str(change)
-                self.current_canvas[change.pos.x][change.pos.y] = change.col
-
-        # if there are changes in previous_changes we haven't touched yet, clear them here
-        # if we filled the screen, we know that we shouldn't touch these
-        if clear_last and not filled:
-            for change in self.previous_changes.values():
-                # if there is a previous change which isn't in current changes
-                if change.pos not in self.changes:
-                    # we should set it to the last fill colour
-                    # (might be this one, otherwise check the value of our last fill)
-                    last_fill_col = self.fill_col
-
-                    changes_string += str(
-                        Canvas.Pixel(change.pos, last_fill_col)
-                    )
-                    self.current_canvas[change.pos.x][change.pos.y] = last_fill_col
-
-        self.previous_changes = self.changes
-        self.changes = {}
-        return changes_string
+        # only the areas drawn to this frame (and last frame, if we're clearing it) need looking at
+        if filled:
+            regions = [Rect(0, 0, self.dimensions.x, self.dimensions.y)]
+        elif clear_last:
+            regions = merge_rects(damage + self.previous_damage)
+        else:
+            regions = damage
+
+        fill_rgb = np.array(Surface._rgb(self.fill_col), dtype=np.uint8)
+        changed = np.zeros(self.changes_mask.shape, dtype=bool)
+
+        with timing.span("diff"):
+            for region in regions:
+                area = region.slices()
+                current = self.current_canvas[area]
+                changes = self.changes[area]
+                changes_mask = self.changes_mask[area]
+
+                # then handle every colour change; anything set to the colour the board already has is skipped
+                region_changed = changes_mask & np.any(changes != current, axis=2)
+
+                # if there are changes in previous_changes we haven't touched yet, clear them here
+                # if we filled the screen, we know that we shouldn't touch these
+                if clear_last and not filled:
+                    # anything drawn last frame but not this one goes back to the last fill colour
+                    erased = self.previous_mask[area] & ~changes_mask
+                    erased &= np.any(current != fill_rgb, axis=2)
+
+                    current[erased] = fill_rgb
+                    region_changed |= erased
+
+                current[changes_mask] = changes[changes_mask]
+                changed[area] = region_changed
+
+        box = bounding_rect(regions)
+        if encode and box is not None:
+            area = box.slices()
+            with timing.span("encode"):
+                encoder.changes(changed[area], self.current_canvas[area], box.x, box.y)
+
+        # swap the masks around rather than allocating a new one every frame.
+        # the old previous mask can only have anything set inside the previous damage, so only that needs clearing
+        self.previous_mask, self.changes_mask = self.changes_mask, self.previous_mask
+        for region in self.previous_damage:
+            self.changes_mask[region.slices()] = False
+
+        self.previous_damage = damage
+        self.damage = []
+        self.updated_regions = regions
+        return encoder.getvalue()
+
+    def full_frame(self) -> bytes:
+        """
+        A message that draws the whole board as of the last update_changes() call from scratch, whatever the panel
+        was showing before; for getting the panel back in step (see PipeWriter.resync()).
+        """
+        encoder = rpi_ipc.FrameEncoder(calibration=self.calibration)
+        encoder.clear()
+        encoder.changes(np.any(self.current_canvas != 0, axis=2), self.current_canvas)
+        return encoder.getvalue()
 
     def set_fill(self, fill_type: "Canvas.FILLTYPE", fill_col: Colour = Colour.black):
         self.fill = fill_type
         self.fill_col = fill_col
 
-    def set_pixel(self, pos: Vector2, col: Colour):
-        if not ((0 <= pos.x < self.dimensions.x) and (0 <= pos.y < self.dimensions.y)):
-            return
-
-        # isnt it crazy what boilerplate can do?
-        self.changes[pos] = Canvas.Pixel(pos, col)
-
-    def set_image(self, pos: Vector2, image_draw: Image, override_col: Union[Colour, None] = None):
-        image = image_draw
-        if image_draw.mode != "RGBA":
-            image = image_draw.convert("RGBA")
-
-        w, h = image.size
-        for x in range(w):
-            for y in range(h):
-                pixelpos = pos + Vector2(x, y)
-                pixelcol: Tuple[int, int, int, int] = image.getpixel((x, y))
-                if pixelcol[3] > 0:
-                    if override_col:
-                        self.set_pixel(pixelpos, override_col)
-                    else:
-                        self.set_pixel(pixelpos, Colour.from_tuple(pixelcol))
-
-    def set_text(self, pos: Vector2, font: bdfparser.Font, text: str, col: Colour):
-        font_text = None
-        for c in text:
-            if font_text:
-                font_text.concat(font.glyph(c).draw())
-            else:
-                font_text = font.glyph(c).draw()
-
-        if font_text:
-            im = Image.frombytes("RGBA", (font_text.width(), font_text.height()), font_text.tobytes("RGBA"))
-            self.set_image(pos, im, col)
-
     def get_pixel(self, pos: Vector2, wrt_changes: bool = True) -> Colour:
         if not ((0 <= pos.x < self.dimensions.x) and (0 <= pos.y < self.dimensions.y)):
             return Colour.black
 
-        col = self.current_canvas[pos.x][pos.y]
+        col = self.current_canvas[pos.y, pos.x]
         if wrt_changes:
             # check for any fills
             if self.fill == Canvas.FILLTYPE.CLEAR:
@@ -276,7 +443,10 @@ class Canvas:
                 col = self.fill_col
 
             # then check for changes (fills always happen before changes)
-            if pos in self.changes:
-                col = self.changes[pos].col
+            if self.changes_mask[pos.y, pos.x]:
+                col = self.changes[pos.y, pos.x]
+
+        if isinstance(col, Colour):
+            return col
 
-        return col
+        return Colour.from_tuple(col.tolist())
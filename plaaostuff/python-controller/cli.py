@@ -0,0 +1,67 @@
+"""
+Command line options shared by the controller scripts (clock.py, hi_bounce.py and fill_test.py):
+
+    --no-pipe           don't send anything to the matrix
+    --record PATH       record everything sent to the matrix, for replay.py to play back
+    --calibration PATH  load the panel calibration from a file (see calibration.py) instead of the built-in one
+    --timings           print per-stage frame timings every so often, and write them to timings.json
+"""
+
+import sys
+from typing import Tuple, Union
+
+import path
+import rpi_ipc
+import timing
+from calibration import Calibration
+from canvas import Canvas
+from dat import Vector2
+from recording import FrameRecorder
+
+
+Output = Union[rpi_ipc.PipeWriter, FrameRecorder, None]
+
+
+def setup(dimensions: Vector2 = Vector2(64, 64)) -> Tuple[Output, Union[FrameRecorder, None], Canvas]:
+    """
+    Handle the shared options, returning where to send messages, the recording (if there is one) and the canvas to
+    draw on.
+
+    Messages go down the matrix pipe, unless there's --no-pipe or no pipe to open. With --record they also go into
+    the recording, or only into the recording if there's no pipe, for rendering something ahead of time without a
+    matrix.
+
+    :param dimensions: The size of the canvas
+    """
+    pipe: Output = None
+    if "--no-pipe" not in sys.argv:
+        pipe = rpi_ipc.open_pipe(clear=True)
+
+    recorder = None
+    record_path = path.from_argv("--record")
+    if record_path:
+        recorder = FrameRecorder(record_path)
+        recorder.record(rpi_ipc.encode_clear())
+        if pipe:
+            pipe.recorder = recorder
+        else:
+            pipe = recorder
+
+    if "--timings" in sys.argv:
+        timing.enable(path=path.from_root("timings.json"))
+
+    calibration_path = path.from_argv("--calibration")
+    canvas = Canvas(dimensions, calibration=Calibration.load(calibration_path) if calibration_path else None)
+
+    return pipe, recorder, canvas
+
+
+def close(pipe: Output, recorder: Union[FrameRecorder, None]):
+    # clear the panel on the way out, and finish off the recording
+    if pipe:
+        pipe.write(rpi_ipc.encode_clear())
+        pipe.close()
+
+    if recorder:
+        recorder.close()
+        print(recorder)
@@ -1,8 +1,7 @@
 import datetime
-import math
+import functools
 import os
 import platform
-import threading
 
 import requests
 from bdfparser import Font
@@ -11,10 +10,17 @@ import random
 import time
 import sys
 
+import cli
 import path
-from canvas import Colour, Canvas
+from cache import CachedSource
+from canvas import Colour
 from dat import Vector2
-import rpi_ipc
+from layers import LayerStack
+from preview import TerminalPreview
+from runtime import Runtime
+from scheduler import FrameScheduler
+import timing
+from timeseries import TimeSeries, Sparkline
 
 
 last_print_time = time.time()
@@ -37,15 +43,21 @@ else:
     print_canvas = "--no-print-canvas" not in sys.argv
     os.system("cls")
 
-pipe = None
-if "--no-pipe" not in sys.argv:
-    pipe = rpi_ipc.open_pipe(clear=True)
-
 make_webrequests = True
 if "--no-webrequests" in sys.argv:
     make_webrequests = False
 
-canvas = Canvas(Vector2(64, 64))
+# the pipe (or recording) and canvas, set up from --no-pipe, --record, --calibration and --timings (see cli.py)
+pipe, recorder, canvas = cli.setup()
+preview = TerminalPreview(canvas.dimensions)
+
+# the sensor name and navigation only change when the focused sensor does, so they live on their own layer
+# and only get redrawn then. everything else is redrawn every frame
+layers = LayerStack(canvas)
+nav_layer = layers.add_layer(z=0)
+frame_layer = layers.add_layer(z=1)
+nav_state = None
+
 font = Font(path.from_root("../../fonts/6x12.bdf"))
 font2 = Font(path.from_root("../../fonts/5x7.bdf"))
 
@@ -72,7 +84,17 @@ temperature_cols = (
 current_focused_sensor_pos = Vector2(2, 35)
 focused_sensor_info_pos = Vector2(2, 46)
 
+# the graph sits beside the feels like temperature, so it has to stop short of x 42 or it'd cover the minus sign
+sensor_graph_pos = Vector2(1, 27)
+sensor_graph_size = Vector2(40, 7)
+
+# the latest (temperature, humidity) from each sensor, and a day of history at one reading a minute
 sensors = {}
+sensor_history = {}
+sensor_graphs = {}
+history_interval = 60
+history_span = 24 * 60 * 60
+
 sensor_order = []
 sensor_name_lookups = {
     "temp_humidity_0": "broom closet",
@@ -80,148 +102,172 @@ sensor_name_lookups = {
     "temp_humidity_2": "outside"
 }
 
+
+def add_reading(origin, temp, humid):
+    if origin not in sensors:
+        sensor_order.append(origin)
+        sensor_history[origin] = TimeSeries(history_span // history_interval, channels=2)
+        sensor_graphs[origin] = Sparkline(sensor_history[origin], sensor_graph_size, history_span)
+
+    sensors[origin] = (temp, humid)
+
+    now = time.time()
+    history = sensor_history[origin]
+    if history.latest_time is None or now - history.latest_time >= history_interval:
+        history.append(now, temp, humid)
+
+
 testing_sensors = False
 if "--test-sensors" in sys.argv:
     testing_sensors = True
     for s in sensor_name_lookups.keys():
-        sensors[s] = "0|0"
-        sensor_order.append(s)
+        add_reading(s, 0, 0)
 
 
 current_sensor = -1
 sensor_switch_timeout = 0
 
-recorded_temperature = 0
-recorded_temperature_feel = 0
+# tick on every second of the wall clock
+scheduler = FrameScheduler(1, align=True)
+runtime = Runtime(scheduler, pipe, resync=canvas.full_frame)
+
+
+# how long a weather fetch gets before it's given up on, in seconds
+WEATHER_TIMEOUT = 20
+
+
+async def fetch_weather():
+    # the request runs on a worker thread, so a slow response doesn't hold the clock up. giving up on it only stops
+    # waiting for the thread though, so requests needs its own timeout too or a hung connection ties the thread up
+    # for good. that one's per connect and per read rather than overall, hence only half
+    response = await Runtime.run_blocking(functools.partial(
+        requests.get, "https://wttr.in/Southampton?format=\"%t|%f\"", timeout=WEATHER_TIMEOUT / 2
+    ))
+
+    return [int(t) for t in response.text[1:-1].replace("°C", "").split("|")]
+
+
+# refreshed every 30 minutes in the background. whatever was fetched last is saved, so it's on screen straight away
+# after a restart; anything older than half a day is too out of date to show though
+weather = CachedSource(
+    fetch_weather, ttl=30 * 60, path=path.from_root("weather_cache.json"), max_age=12 * 60 * 60,
+    timeout=WEATHER_TIMEOUT
+)
+if make_webrequests:
+    runtime.add_task(weather.run)
+
 
-record_timeout = 0
+def read_sensor(entry):
+    if entry:
+        origin, _, payload = entry.partition(":")
+        if origin in sensor_name_lookups:
+            part1, _, part2 = payload.partition("|")
+            if is_float(part1) and is_float(part2):
+                add_reading(origin, float(part1), float(part2))
 
-last_recorded_time = time.time()
 
-# If using pipe, set up thread here for reading from the info pipe as well
+# If using pipe, read from the info pipe as well
 if pipe:
-    def read_pipe():
-        global sensors
-        with open("/home/pi/sensor_inp_pipe", "r") as f:
-            while True:
-                data = f.read()
-                if len(data) == 0:
-                    pass
-                    # closed pipe
-                    # return
-
-                entries = data.split("\n")
-                for entry in entries:
-                    if entry:
-                        origin, _, payload = entry.partition(":")
-                        if origin in sensor_name_lookups:
-                            part1, _, part2 = payload.partition("|")
-                            if is_float(part1) and is_float(part2):
-                                if origin not in sensors:
-                                    sensor_order.append(origin)
-
-                                sensors[origin] = payload
-
-    threading.Thread(target=read_pipe, daemon=True).start()
+    runtime.read_lines("/home/pi/sensor_inp_pipe", read_sensor)
 
-try:
-    while True:
-        while time.time() < math.floor(last_recorded_time + 1):
-            time.sleep(max(0.0, min(0.25, math.floor(last_recorded_time + 1) - time.time())))
-
-        last_recorded_time = round(time.time())
-
-        # 30 minutes
-        # TODO put this in a different thread since it'll hang the clock
-        if time.time() > record_timeout + (30 * 60) and make_webrequests:
-            record_timeout = time.time()
-            try:
-                response = requests.get("https://wttr.in/Southampton?format=\"%t|%f\"")
-
-                recorded_temperature, recorded_temperature_feel = (int(t) for t in response.text[1:-1].replace("°C", "").split("|"))
-            except:
-                pass
-
-        cur_time = datetime.datetime.now()
-        canvas.set_text(clock_pos, font, cur_time.strftime('%X'), clock_main_col)
-        canvas.set_text(day_pos, font2, cur_time.strftime('%A'), clock_sub_col)
-        canvas.set_text(date_pos, font2, cur_time.strftime('%x'), clock_sub_col)
-
-        if recorded_temperature or recorded_temperature_feel:
-            temp_index = 0
-            temperature_col = temperature_cols[0]
-            while recorded_temperature < temperature_col[1]:
-                temp_index += 1
-                temperature_col = temperature_cols[temp_index]
-
-            canvas.set_text(temperature_pos, font2, "{:-3}C".format(int(round(recorded_temperature))), temperature_col[0])
-
-            temp_index = 0
-            temperature_col = temperature_cols[0]
-            while recorded_temperature_feel < temperature_col[1]:
-                temp_index += 1
-                temperature_col = temperature_cols[temp_index]
-
-            canvas.set_text(
-                temperature_feel_pos, font2, "{:-3}C".format(int(round(recorded_temperature_feel))),
-                temperature_col[0].fade_black(0.5)
-            )
 
-        sensor_switch_timeout -= 1
-        if sensor_switch_timeout < 0 and len(sensor_order) > 0:
-            sensor_switch_timeout = 3
-            current_sensor = (current_sensor + 1) % len(sensor_order)
+def render():
+    global current_sensor, sensor_switch_timeout, nav_state, last_print_time
+
+    recorded_temperature, recorded_temperature_feel = weather.value or (0, 0)
+
+    frame_layer.clear()
+
+    cur_time = datetime.datetime.now()
+    frame_layer.set_text(clock_pos, font, cur_time.strftime('%X'), clock_main_col)
+    frame_layer.set_text(day_pos, font2, cur_time.strftime('%A'), clock_sub_col)
+    frame_layer.set_text(date_pos, font2, cur_time.strftime('%x'), clock_sub_col)
 
-        if current_sensor != -1:
-            if sensor_order[current_sensor]:
-                canvas.set_text(
-                    current_focused_sensor_pos, font2, "{:^12}".format(sensor_name_lookups[sensor_order[current_sensor]]), Colour(192, 192, 192)
-                )
+    if recorded_temperature or recorded_temperature_feel:
+        temp_index = 0
+        temperature_col = temperature_cols[0]
+        while recorded_temperature < temperature_col[1]:
+            temp_index += 1
+            temperature_col = temperature_cols[temp_index]
 
-            data = sensors[sensor_order[current_sensor]]
-            if data:
-                temp, _, humid = data.partition("|")
+        frame_layer.set_text(temperature_pos, font2, "{:-3}C".format(int(round(recorded_temperature))), temperature_col[0])
 
-                temp_index = 0
-                temperature_col = temperature_cols[0]
-                while float(temp) < temperature_col[1]:
-                    temp_index += 1
-                    temperature_col = temperature_cols[temp_index]
+        temp_index = 0
+        temperature_col = temperature_cols[0]
+        while recorded_temperature_feel < temperature_col[1]:
+            temp_index += 1
+            temperature_col = temperature_cols[temp_index]
 
-                canvas.set_text(
-                    focused_sensor_info_pos, font2, "{:5}{}".format(round(float(temp), 1), "C"), temperature_col[0]
-                )
+        frame_layer.set_text(
+            temperature_feel_pos, font2, "{:-3}C".format(int(round(recorded_temperature_feel))),
+            temperature_col[0].fade_black(0.5)
+        )
+
+    sensor_switch_timeout -= 1
+    if sensor_switch_timeout < 0 and len(sensor_order) > 0:
+        sensor_switch_timeout = 3
+        current_sensor = (current_sensor + 1) % len(sensor_order)
+
+    if current_sensor != -1:
+        origin = sensor_order[current_sensor]
+        temp, humid = sensors[origin]
 
-                canvas.set_text(
-                    focused_sensor_info_pos + Vector2(34, 0), font2, "{:4}{}".format(round(float(humid), 1) if float(humid) < 100 else 100, "%"), Colour(128, 128, 128).lerp(Colour(64, 64, 255), float(humid) / 100)
-                )
+        temp_index = 0
+        temperature_col = temperature_cols[0]
+        while temp < temperature_col[1]:
+            temp_index += 1
+            temperature_col = temperature_cols[temp_index]
+
+        frame_layer.set_text(
+            focused_sensor_info_pos, font2, "{:5}{}".format(round(temp, 1), "C"), temperature_col[0]
+        )
 
-        canvas.set_text(
+        frame_layer.set_text(
+            focused_sensor_info_pos + Vector2(34, 0), font2, "{:4}{}".format(round(humid, 1) if humid < 100 else 100, "%"), Colour(128, 128, 128).lerp(Colour(64, 64, 255), humid / 100)
+        )
+
+        # the last day of temperatures
+        sensor_graphs[origin].draw(frame_layer, sensor_graph_pos, temperature_col[0])
+
+    if nav_state != (current_sensor, len(sensor_order)):
+        nav_state = (current_sensor, len(sensor_order))
+        nav_layer.clear()
+
+        if current_sensor != -1 and sensor_order[current_sensor]:
+            nav_layer.set_text(
+                current_focused_sensor_pos, font2, "{:^12}".format(sensor_name_lookups[sensor_order[current_sensor]]), Colour(192, 192, 192)
+            )
+
+        nav_layer.set_text(
             Vector2(1, 56), font2, "<", Colour(192, 192, 192) if current_sensor > 0 else Colour(32, 32, 32)
         )
 
-        canvas.set_text(
+        nav_layer.set_text(
             Vector2(58, 56), font2, ">", Colour(192, 192, 192) if current_sensor + 1 < len(sensor_order) else Colour(32, 32, 32)
         )
 
-        canvas.set_text(
+        nav_layer.set_text(
             Vector2(15, 56), font2, "{:3}/{:<3}".format(current_sensor + 1, len(sensor_order)), Colour(192, 192, 192)
         )
 
-        st = canvas.update_changes(clear_last=True)
+    layers.render()
+    st = canvas.update_changes()
+
+    if print_canvas:
+        print(preview.render(canvas.current_canvas, canvas.updated_regions), end="", flush=True)
 
-        if print_canvas:
-            print("\033[1;1H" + str(canvas))
+    print("\033[0mLast frame took \033[32m{:8} \033[0mseconds ({})\r".format(round(time.time() - last_print_time, 4), scheduler), end="")
+    last_print_time = time.time()
 
-        print("\033[0mLast frame took \033[32m{:8} \033[0mseconds\r".format(round(time.time() - last_print_time, 4)), end="")
-        last_print_time = time.time()
+    if testing_sensors:
+        for s in sensor_order:
+            add_reading(s, random.randint(-2000, 4000) / 100.0, random.randint(0, 10000) / 100.0)
 
-        rpi_ipc.send_prot_msg(pipe, st)
+    return st
 
-        if testing_sensors:
-            for s in sensor_order:
-                sensors[s] = "{}|{}".format(random.randint(-2000, 4000) / 100.0, random.randint(0, 10000) / 100.0)
 
+try:
+    runtime.run(render)
 
 except KeyboardInterrupt:
     if print_canvas:
@@ -234,6 +280,4 @@ except KeyboardInterrupt:
     else:
         print("Interrupted. Clearing screen and exiting...\n")
 
-    if pipe:
-        pipe.write("CLEAR")
-        pipe.flush()
+    cli.close(pipe, recorder)
@@ -1,7 +1,10 @@
 import math
+from typing import Iterable, List, Union
 
 
 class Vector2:
+    __slots__ = ("x", "y")
+
     def __init__(self, x, y):
         self.x = x
         self.y = y
@@ -17,8 +20,14 @@ class Vector2:
     def __str__(self):
         return "{},{}".format(self.x, self.y)
 
+    def __repr__(self):
+        return "Vector2({}, {})".format(self.x, self.y)
+
     def __eq__(self, other):
-        return hash(self) == hash(other)
+        if not isinstance(other, Vector2):
+            return NotImplemented
+
+        return self.x == other.x and self.y == other.y
 
     def __hash__(self):
         return hash((self.x, self.y))
@@ -34,7 +43,7 @@ class Vector2:
     def __sub__(self, other):
         Vector2.check_type(other)
 
-        return self + (-other)
+        return Vector2(self.x - other.x, self.y - other.y)
 
     def __mul__(self, other):
         if isinstance(other, Vector2):
@@ -42,6 +51,32 @@ class Vector2:
         else:
             return Vector2(self.x * other, self.y * other)
 
+    # the in-place operators change the vector itself rather than making a new one.
+    # don't use them on a vector that's being used as a dict key or set member
+    def __iadd__(self, other):
+        Vector2.check_type(other)
+
+        self.x += other.x
+        self.y += other.y
+        return self
+
+    def __isub__(self, other):
+        Vector2.check_type(other)
+
+        self.x -= other.x
+        self.y -= other.y
+        return self
+
+    def __imul__(self, other):
+        if isinstance(other, Vector2):
+            self.x *= other.x
+            self.y *= other.y
+        else:
+            self.x *= other
+            self.y *= other
+
+        return self
+
     def __truediv__(self, other):
         if isinstance(other, Vector2):
             return Vector2(self.x / other.x, self.y / other.y)
@@ -61,7 +96,96 @@ class Vector2:
         return math.sqrt((self.x ** 2) + (self.y ** 2))
 
     def distance(self, other):
-        return abs(other - self).magnitude()
+        return math.hypot(other.x - self.x, other.y - self.y)
 
     def normalized(self):
         return self / self.magnitude()
+
+
+class Rect:
+    """
+    An integer rectangle, covering x <= px < x + w and y <= py < y + h.
+    """
+
+    __slots__ = ("x", "y", "w", "h")
+
+    def __init__(self, x: int, y: int, w: int, h: int):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+
+    @property
+    def right(self) -> int:
+        return self.x + self.w
+
+    @property
+    def bottom(self) -> int:
+        return self.y + self.h
+
+    @property
+    def area(self) -> int:
+        return self.w * self.h
+
+    def __repr__(self):
+        return "Rect({}, {}, {}, {})".format(self.x, self.y, self.w, self.h)
+
+    def __eq__(self, other):
+        if not isinstance(other, Rect):
+            return NotImplemented
+
+        return self.x == other.x and self.y == other.y and self.w == other.w and self.h == other.h
+
+    def __hash__(self):
+        return hash((self.x, self.y, self.w, self.h))
+
+    def contains(self, x: int, y: int) -> bool:
+        return self.x <= x < self.x + self.w and self.y <= y < self.y + self.h
+
+    def touches(self, other: "Rect") -> bool:
+        # true if the rects overlap or sit right next to each other
+        return self.x <= other.right and other.x <= self.right and self.y <= other.bottom and other.y <= self.bottom
+
+    def union(self, other: "Rect") -> "Rect":
+        x, y = min(self.x, other.x), min(self.y, other.y)
+        return Rect(x, y, max(self.right, other.right) - x, max(self.bottom, other.bottom) - y)
+
+    def slices(self):
+        # for indexing a [y, x] array
+        return slice(self.y, self.y + self.h), slice(self.x, self.x + self.w)
+
+
+def merge_rects(rects: Iterable[Rect]) -> List[Rect]:
+    """
+    Merge every overlapping or adjacent rect together, so the rects that are left don't touch each other.
+
+    :param rects: The rects to merge
+    """
+    merged: List[Rect] = []
+    for rect in rects:
+        # keep absorbing whatever the (growing) rect touches until it's clear of everything
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            for i, other in enumerate(merged):
+                if rect.touches(other):
+                    rect = rect.union(merged.pop(i))
+                    absorbed = True
+                    break
+
+        merged.append(rect)
+
+    return merged
+
+
+def bounding_rect(rects: Iterable[Rect]) -> Union[Rect, None]:
+    """
+    The smallest rect covering all of the given rects, or None if there aren't any.
+
+    :param rects: The rects to cover
+    """
+    box = None
+    for rect in rects:
+        box = rect if box is None else box.union(rect)
+
+    return box
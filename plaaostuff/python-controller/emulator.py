@@ -0,0 +1,291 @@
+"""
+A headless stand-in for ipc.cc: reads the pipe protocol into a framebuffer, so the controller scripts can be run,
+measured and checked on any linux machine without a Pi or a matrix.
+
+    python3 emulator.py [--pipe PATH] [--snapshots DIR] [--snapshot-every SECONDS] [--stats-every SECONDS]
+
+Runs until something sends EXIT, printing throughput as it goes and saving a PNG of the framebuffer to the snapshot
+directory (if there is one) every so often and at the end.
+"""
+
+import argparse
+import errno
+import os
+import sys
+import time
+from typing import Iterator, Union
+
+import numpy as np
+from PIL import Image
+
+import rpi_ipc
+from dat import Vector2
+from shm import ShmFrameReader
+
+
+class StreamDecoder:
+    """
+    Splits a byte stream into protocol frames, however it's been chunked up on the way. Bytes that don't look like a
+    frame header are skipped one at a time until one turns up, the same way ipc.cc resyncs.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # bytes skipped while looking for a frame header
+        self.skipped = 0
+
+    def feed(self, data: bytes) -> Iterator[bytes]:
+        """
+        Add some more of the stream, yielding the body of every frame it completes.
+        """
+        self.buffer += data
+        header_size = rpi_ipc.FRAME_HEADER.size
+
+        pos = 0
+        while len(self.buffer) - pos >= header_size:
+            magic, version, length = rpi_ipc.FRAME_HEADER.unpack_from(self.buffer, pos)
+            if magic != rpi_ipc.MAGIC or version != rpi_ipc.PROTOCOL_VERSION \
+                    or header_size + length > rpi_ipc.MAX_FRAME_SIZE:
+                pos += 1
+                self.skipped += 1
+                continue
+
+            end = pos + header_size + length
+            if end > len(self.buffer):
+                # wait for the rest of this frame
+                break
+
+            yield bytes(self.buffer[pos + header_size:end])
+            pos = end
+
+        del self.buffer[:pos]
+
+
+class Emulator:
+    """
+    A framebuffer that protocol frames are applied to, just like ipc.cc applies them to the matrix.
+
+    :param dimensions: The size of the emulated matrix
+    :param shm_path: Where to find shared memory frames, for SHM_FRAME commands
+    """
+
+    def __init__(self, dimensions: Vector2 = Vector2(64, 64), shm_path: Union[str, None] = None):
+        self.dimensions = dimensions
+        self.framebuffer = np.zeros((dimensions.y, dimensions.x, 3), dtype=np.uint8)
+
+        self.decoder = StreamDecoder()
+        self.shm_path = shm_path
+        self.shm: Union[ShmFrameReader, None] = None
+
+        self.exited = False
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.started = time.perf_counter()
+        self.bytes = 0
+        self.frames = 0
+        # every command, with every pixel in a PIXELS command counted separately
+        self.tokens = 0
+        # time spent decoding and applying frames
+        self.parse_time = 0.0
+        # frames with something wrong in them
+        self.errors = 0
+
+    def __str__(self):
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return "{:.0f} tokens/s, {:.1f} frames/s, {:.1f} KB/s, {:.1%} of the time parsing, {} errors".format(
+            self.tokens / elapsed, self.frames / elapsed, self.bytes / elapsed / 1024, self.parse_time / elapsed,
+            self.errors + self.decoder.skipped
+        )
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Apply whatever frames a chunk of the stream completes. Returns False once an EXIT has been seen.
+        """
+        start = time.perf_counter()
+        if not self.bytes:
+            # rates are from the first data in, not counting however long we sat waiting for a writer
+            self.started = start
+
+        self.bytes += len(data)
+
+        for body in self.decoder.feed(data):
+            self.frames += 1
+            if not self.apply(body):
+                self.exited = True
+                break
+
+        self.parse_time += time.perf_counter() - start
+        return not self.exited
+
+    def _shm_frame(self, index: int, seq: int):
+        if self.shm is None:
+            try:
+                self.shm = ShmFrameReader(self.shm_path) if self.shm_path else ShmFrameReader()
+            except (OSError, rpi_ipc.ProtocolError) as e:
+                print("Couldn't open shared frames: {}".format(e), file=sys.stderr)
+                return
+
+        try:
+            frame = self.shm.read(index, seq)
+        except rpi_ipc.ProtocolError as e:
+            # the writer started over; open it again for the next one
+            print("Dropped a shared frame: {}".format(e), file=sys.stderr)
+            self.shm.close()
+            self.shm = None
+            return
+
+        if frame is not None:
+            h, w = min(frame.shape[0], self.dimensions.y), min(frame.shape[1], self.dimensions.x)
+            self.framebuffer[:h, :w] = frame[:h, :w]
+
+    def apply(self, body: bytes) -> bool:
+        """
+        Apply every command in a frame body. Returns False if there's an EXIT. Like ipc.cc, a malformed body is
+        dropped from the bad command on.
+        """
+        fb = self.framebuffer
+        height, width = fb.shape[:2]
+
+        pos = 0
+        while pos < len(body):
+            op = body[pos]
+            self.tokens += 1
+
+            if op == rpi_ipc.OP_CLEAR:
+                fb[:] = 0
+                pos += 1
+
+            elif op == rpi_ipc.OP_EXIT:
+                return False
+
+            elif op == rpi_ipc.OP_FILL:
+                if pos + 4 > len(body):
+                    break
+
+                fb[:] = tuple(body[pos + 1:pos + 4])
+                pos += 4
+
+            elif op == rpi_ipc.OP_PIXELS:
+                if pos + rpi_ipc.PIXELS_HEADER.size > len(body):
+                    break
+
+                _, count = rpi_ipc.PIXELS_HEADER.unpack_from(body, pos)
+                pos += rpi_ipc.PIXELS_HEADER.size
+                end = pos + count * rpi_ipc.PIXEL_RECORD_SIZE
+                if end > len(body):
+                    break
+
+                records = np.frombuffer(body[pos:end], dtype=np.uint8).reshape(-1, rpi_ipc.PIXEL_RECORD_SIZE)
+                inside = (records[:, 0] < width) & (records[:, 1] < height)
+                records = records[inside]
+                fb[records[:, 1], records[:, 0]] = records[:, 2:]
+
+                self.tokens += count - 1
+                pos = end
+
+            elif op in (rpi_ipc.OP_HLINE, rpi_ipc.OP_VLINE):
+                if pos + rpi_ipc.LINE_COMMAND_SIZE > len(body):
+                    break
+
+                x, y, length, r, g, b = body[pos + 1:pos + rpi_ipc.LINE_COMMAND_SIZE]
+                if op == rpi_ipc.OP_HLINE:
+                    fb[y:y + 1, x:x + length] = (r, g, b)
+                else:
+                    fb[y:y + length, x:x + 1] = (r, g, b)
+
+                pos += rpi_ipc.LINE_COMMAND_SIZE
+
+            elif op == rpi_ipc.OP_RECT:
+                if pos + rpi_ipc.RECT_COMMAND_SIZE > len(body):
+                    break
+
+                x, y, w, h, r, g, b = body[pos + 1:pos + rpi_ipc.RECT_COMMAND_SIZE]
+                fb[y:y + h, x:x + w] = (r, g, b)
+                pos += rpi_ipc.RECT_COMMAND_SIZE
+
+            elif op == rpi_ipc.OP_SHM_FRAME:
+                if pos + rpi_ipc.SHM_FRAME_COMMAND.size > len(body):
+                    break
+
+                _, index, seq = rpi_ipc.SHM_FRAME_COMMAND.unpack_from(body, pos)
+                self._shm_frame(index, seq)
+                pos += rpi_ipc.SHM_FRAME_COMMAND.size
+
+            else:
+                break
+
+        if pos < len(body):
+            self.errors += 1
+
+        return True
+
+    def snapshot(self, path: str, scale: int = 8):
+        # save the framebuffer as a PNG, blown up so each led is a scale x scale square
+        image = Image.fromarray(self.framebuffer, "RGB")
+        image.resize((image.width * scale, image.height * scale), Image.NEAREST).save(path)
+
+    def run(self, path: str = rpi_ipc.PIPE_PATH, snapshots: Union[str, None] = None, snapshot_every: float = 0,
+            stats_every: float = 1):
+        """
+        Read from a fifo until something sends EXIT, reopening it whenever the writer goes away.
+
+        :param path: The fifo to read; made if it doesn't exist
+        :param snapshots: A directory to save snapshots in, if any
+        :param snapshot_every: How often to save a snapshot, in seconds (0 for only at the end)
+        :param stats_every: How often to print the stats, in seconds (0 for never)
+        """
+        try:
+            os.mkfifo(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if snapshots:
+            os.makedirs(snapshots, exist_ok=True)
+
+        last_snapshot = last_stats = time.perf_counter()
+        snapshot_count = 0
+
+        while not self.exited:
+            # blocks until there's a writer
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                while not self.exited:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        break
+
+                    self.feed(data)
+
+                    now = time.perf_counter()
+                    if stats_every and now - last_stats >= stats_every:
+                        print(self)
+                        last_stats = now
+
+                    if snapshots and snapshot_every and now - last_snapshot >= snapshot_every:
+                        self.snapshot(os.path.join(snapshots, "{:06}.png".format(snapshot_count)))
+                        snapshot_count += 1
+                        last_snapshot = now
+            finally:
+                os.close(fd)
+
+        print(self)
+        if snapshots:
+            self.snapshot(os.path.join(snapshots, "final.png"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulate the matrix, reading the pipe protocol into a framebuffer.")
+    parser.add_argument("--pipe", default=rpi_ipc.PIPE_PATH, help="the fifo to read from")
+    parser.add_argument("--size", type=int, nargs=2, default=(64, 64), metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--snapshots", help="a directory to save PNG snapshots to")
+    parser.add_argument("--snapshot-every", type=float, default=0, help="seconds between snapshots")
+    parser.add_argument("--stats-every", type=float, default=1, help="seconds between printing stats")
+    args = parser.parse_args()
+
+    emulator = Emulator(Vector2(*args.size))
+    try:
+        emulator.run(args.pipe, args.snapshots, args.snapshot_every, args.stats_every)
+    except KeyboardInterrupt:
+        print(emulator)
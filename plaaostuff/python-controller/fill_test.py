@@ -10,10 +10,16 @@ import random
 import time
 import sys
 
+import cli
 import path
+from animation import AnimationCache
 from canvas import Colour, Canvas
 from dat import Vector2
+from emulator import Emulator
+from preview import TerminalPreview
 import rpi_ipc
+import timing
+from scheduler import FrameScheduler
 
 
 last_print_time = time.time()
@@ -28,12 +34,9 @@ else:
     print_canvas = "--no-print-canvas" not in sys.argv
     os.system("cls")
 
-pipe = None
-if "--no-pipe" not in sys.argv:
-    pipe = rpi_ipc.open_pipe(clear=True)
-
-canvas = Canvas(Vector2(64, 64))
-col = 0
+# the pipe (or recording) and canvas, set up from --no-pipe, --record, --calibration and --timings (see cli.py)
+pipe, recorder, canvas = cli.setup()
+preview = TerminalPreview(canvas.dimensions)
 cols = (
     Colour.red,
     Colour.green,
@@ -41,19 +44,29 @@ cols = (
     Colour.black
 )
 
+
+def draw(n: int):
+    canvas.set_fill(Canvas.FILLTYPE.FILL, cols[n])
+
+
+# the colours go round and round, so each one only gets drawn once and then the same messages are sent every time.
+# that means the canvas stops changing, so the preview shows the messages decoded instead
+animation = AnimationCache(canvas, draw, len(cols), keyframe_every=len(cols))
+shown = Emulator(canvas.dimensions)
+
+scheduler = FrameScheduler(1)
 try:
     while True:
-        canvas.set_fill(Canvas.FILLTYPE.FILL, cols[col])
-
-        st = canvas.update_changes(clear_last=True)
+        scheduler.wait()
+        with timing.span("render"):
+            st = animation.next_message()
 
         if print_canvas:
-            print("\033[1;1H" + str(canvas))
-
-        rpi_ipc.send_prot_msg(pipe, st)
+            shown.feed(st)
+            print(preview.render(shown.framebuffer), end="", flush=True)
 
-        col = (col + 1) % 4
-        time.sleep(1)
+        rpi_ipc.send_prot_msg(pipe, st, animation.full_frame)
+        timing.report()
 
 except KeyboardInterrupt:
     if print_canvas:
@@ -66,6 +79,5 @@ except KeyboardInterrupt:
     else:
         print("Interrupted. Clearing screen and exiting...\n")
 
-    if pipe:
-        pipe.write("CLEAR")
-        pipe.flush()
+    animation.close()
+    cli.close(pipe, recorder)
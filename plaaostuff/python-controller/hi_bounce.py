@@ -2,15 +2,20 @@ import os
 import platform
 
 from bdfparser import Font
+import numpy as np
 from PIL import Image
 import random
-import time
 import sys
 
+import cli
 import path
-from canvas import Colour, Canvas
 from dat import Vector2
+from preview import TerminalPreview
 import rpi_ipc
+import timing
+from scheduler import FrameScheduler
+from shm import ShmFrameWriter
+from sprites import Sprites
 
 
 # set up constants
@@ -22,73 +27,66 @@ else:
     print_canvas = "--no-print-canvas" not in sys.argv
     os.system("cls")
 
-pipe = None
-if "--no-pipe" not in sys.argv:
-    pipe = rpi_ipc.open_pipe(clear=True)
+# the pipe (or recording) and canvas, set up from --no-pipe, --record, --calibration and --timings (see cli.py)
+pipe, recorder, canvas = cli.setup()
+preview = TerminalPreview(canvas.dimensions)
+
+# this can make frames faster than the matrix can show them, so if it falls behind it skips to the latest one
+# rather than lagging further and further behind. with --shm, whole frames go through shared memory instead
+sender = None
+if pipe:
+    if "--shm" in sys.argv:
+        sender = ShmFrameWriter(canvas.dimensions, pipe, calibration=canvas.calibration)
+    else:
+        sender = rpi_ipc.CoalescingSender(pipe, canvas.calibration)
 
-canvas = Canvas(Vector2(64, 64))
 font = Font(path.from_root("../../fonts/6x12.bdf"))
 test = font.glyph("h").draw().concat(font.glyph("i").draw())
 im = Image.frombytes("RGBA", (test.width(), test.height()), test.tobytes("RGBA"))
 
-positions = [Vector2(10, 10)]
 
-speeds = [Vector2(1 - (random.random() * 2), 1 - (random.random() * 2)).normalized() * (float(random.randint(50, 150)) / 200)]
+def random_speed() -> Vector2:
+    return Vector2(1 - (random.random() * 2), 1 - (random.random() * 2)).normalized() * (float(random.randint(50, 150)) / 200)
+
 
-w, h = im.size
-cols = [Colour(random.randint(0, 256), random.randint(0, 256), random.randint(0, 256))]
-bounds_x = (0, 54)
-bounds_y = (0, 53)
+# the sprites bounce around with their top left corner inside these, and a new one turns up every so often
+# (more and more often) until there are MAX_SPRITES of them
+MAX_SPRITES = 512
+sprites = Sprites(np.asarray(im)[:, :, 3] > 0, Vector2(0, 0), Vector2(54, 53), capacity=MAX_SPRITES)
+sprites.add(Vector2(10, 10), random_speed())
 
 ticks = 0
 timeout = 256
 
-frame_time = time.time()
+scheduler = FrameScheduler(1 / 60)
 try:
     while True:
-        while time.time() - frame_time < 1/60:
-            time.sleep(0.0001)
-
-        frame_time = time.time()
+        scheduler.wait()
 
         ticks += 1
-        if ticks % timeout == timeout - 1:
+        if ticks % timeout == timeout - 1 and not sprites.full:
             ticks = 0
             timeout = max(8, int(timeout / 1.05))
 
-            positions.append(Vector2(10, 10))
-            speeds.append(Vector2(1 - (random.random() * 2), 1 - (random.random() * 2)).normalized() * (float(random.randint(50, 150)) / 200))
-            cols.append(Colour(random.randint(0, 192), random.randint(64, 256), random.randint(0, 192)))
-
-        for index in range(len(positions)):
-            pos = positions[index]
-            speed = speeds[index]
-
-            positions[index] = pos + speed
-            pos = positions[index]
+            sprites.add(Vector2(10, 10), random_speed())
 
-            if not (bounds_x[0] <= pos.x < bounds_x[1]):
-                speeds[index] = speed * Vector2(-1, 1)
-                pos.x = max(bounds_x[0], min(bounds_x[1], pos.x))
-                cols[index] = Colour(random.randint(0, 192), random.randint(64, 256), random.randint(0, 192))
+        with timing.span("render"):
+            sprites.step()
+            sprites.draw(canvas)
 
-            if not (bounds_y[0] <= pos.y < bounds_y[1]):
-                speeds[index] = speed * Vector2(1, -1)
-                pos.y = max(bounds_y[0], min(bounds_y[1], pos.y))
-                cols[index] = Colour(random.randint(0, 192), random.randint(64, 256), random.randint(0, 192))
-
-            text_pos = pos.floor_to_intvec()
-            canvas.set_image(text_pos, im, cols[index])
-
-        st = canvas.update_changes(clear_last=True)
+            canvas.update_changes(clear_last=True, encode=False)
 
         if print_canvas:
-            print("\033[1;1H" + str(canvas))
+            print(preview.render(canvas.current_canvas, canvas.updated_regions), end="", flush=True)
 
-        rpi_ipc.send_prot_msg(pipe, st)
+        if sender:
+            sender.send(canvas.current_canvas)
+
+        timing.report()
 
 except KeyboardInterrupt:
     print("\033[1;1HInterrupted. Clearing screen and exiting...\n")
-    if pipe:
-        pipe.write("CLEAR")
-        pipe.flush()
+    if sender:
+        print("Sent {}".format(sender))
+
+    cli.close(pipe, recorder)
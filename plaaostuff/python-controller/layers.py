@@ -0,0 +1,178 @@
+"""A stack of retained-mode layers composited onto a Canvas, only recompositing what's changed."""
+
+from typing import List, Union
+
+import numpy as np
+
+import timing
+from canvas import Canvas, Colour, Surface
+from dat import Vector2, Rect, merge_rects, bounding_rect
+from textcache import TextCache
+
+
+class Layer(Surface):
+    """
+    One layer in a LayerStack. Unlike a Canvas, whatever's drawn on a layer stays there until it's cleared, so static
+    content only needs drawing once.
+
+    :param dimensions: The size of the layer
+    :param z: Where the layer sits in the stack; higher is further forward
+    :param opacity: How much of the layer shows over what's underneath it, from 0 to 1
+    :param colour_key: A colour to treat as transparent, if any
+    """
+
+    def __init__(
+            self, dimensions: Vector2, z: int = 0, opacity: float = 1.0, colour_key: Union[Colour, None] = None,
+            text_cache: Union[TextCache, None] = None
+    ):
+        super().__init__(dimensions, text_cache)
+
+        self.z = z
+        self._visible = True
+        self._opacity = opacity
+        self._colour_key = colour_key
+
+        # everywhere that's been drawn on since the layer was last cleared
+        self.drawn: List[Rect] = []
+
+    def _redraw(self):
+        # something that affects the whole layer changed, so everything on it needs compositing again
+        for rect in self.drawn:
+            self._add_damage(rect)
+
+    @property
+    def visible(self) -> bool:
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible: bool):
+        if visible != self._visible:
+            self._visible = visible
+            self._redraw()
+
+    @property
+    def opacity(self) -> float:
+        return self._opacity
+
+    @opacity.setter
+    def opacity(self, opacity: float):
+        if opacity != self._opacity:
+            self._opacity = opacity
+            self._redraw()
+
+    @property
+    def colour_key(self) -> Union[Colour, None]:
+        return self._colour_key
+
+    @colour_key.setter
+    def colour_key(self, colour_key: Union[Colour, None]):
+        if colour_key != self._colour_key:
+            self._colour_key = colour_key
+            self._redraw()
+
+    def clear(self):
+        # rub out everything on the layer. only the parts that were drawn on are touched
+        for rect in merge_rects(self.drawn + self.damage):
+            self.changes_mask[rect.slices()] = False
+            self._add_damage(rect)
+
+        self.drawn = []
+
+    def take_damage(self) -> List[Rect]:
+        # hand over the damage since the last call, remembering it as drawn
+        damage = self.damage
+        self.damage = []
+
+        self.drawn = merge_rects(self.drawn + damage)
+        if len(self.drawn) > Surface.MAX_DAMAGE_RECTS:
+            self.drawn = [bounding_rect(self.drawn)]
+
+        return damage
+
+    def composite(self, out: np.ndarray, region: Rect):
+        # draw the layer's part of region over out, which already holds everything underneath
+        if not self._visible or self._opacity <= 0:
+            return
+
+        area = region.slices()
+        colours = self.changes[area]
+        mask = self.changes_mask[area]
+        if self._colour_key is not None:
+            mask = mask & np.any(colours != Surface._rgb(self._colour_key), axis=2)
+
+        if self._opacity >= 1:
+            out[mask] = colours[mask]
+        else:
+            blended = out[mask] * (1 - self._opacity) + colours[mask] * self._opacity
+            out[mask] = np.round(blended).astype(np.uint8)
+
+
+class LayerStack:
+    """
+    Layers composited in z order onto a Canvas.
+
+    The composite of every layer up to each point in the stack is cached, so rendering only recomposites the areas
+    that changed, from the lowest changed layer upwards. Use canvas.update_changes() without clear_last afterwards;
+    the stack only sends the canvas the areas that changed, and the rest of the canvas has to stay as it was.
+
+    :param canvas: The canvas to draw the composite onto
+    :param background: What shows where no layer has anything drawn
+    """
+
+    def __init__(self, canvas: Canvas, background: Colour = Colour.black):
+        self.canvas = canvas
+        self.layers: List[Layer] = []
+
+        shape = (canvas.dimensions.y, canvas.dimensions.x, 3)
+        self.background = np.empty(shape, dtype=np.uint8)
+        self.background[:] = Surface._rgb(background)
+
+        # cache[i] is the composite of the background and layers[0..i]
+        self.cache: List[np.ndarray] = []
+        self.invalid: List[Rect] = [Rect(0, 0, canvas.dimensions.x, canvas.dimensions.y)]
+
+    def _restack(self):
+        self.layers.sort(key=lambda layer: layer.z)
+        self.cache = [self.background.copy() for _ in self.layers]
+        self.invalid = [Rect(0, 0, self.canvas.dimensions.x, self.canvas.dimensions.y)]
+
+    def add_layer(self, z: int = 0, **kwargs) -> Layer:
+        layer = Layer(self.canvas.dimensions, z, **kwargs)
+        self.layers.append(layer)
+        self._restack()
+        return layer
+
+    def remove_layer(self, layer: Layer):
+        self.layers.remove(layer)
+        self._restack()
+
+    def move_layer(self, layer: Layer, z: int):
+        layer.z = z
+        self._restack()
+
+    def render(self) -> List[Rect]:
+        """
+        Recomposite whatever changed and draw it onto the canvas. Returns the areas that were redrawn.
+        """
+        with timing.span("composite"):
+            regions = merge_rects(self.invalid)
+            self.invalid = []
+
+            below = self.background
+            for layer, cache in zip(self.layers, self.cache):
+                # a change to a layer means every layer above it needs recompositing there too
+                damage = layer.take_damage()
+                if damage:
+                    regions = merge_rects(regions + damage)
+
+                for region in regions:
+                    area = region.slices()
+                    cache[area] = below[area]
+                    layer.composite(cache[area], region)
+
+                below = cache
+
+            for region in regions:
+                self.canvas.set_pixels(Vector2(region.x, region.y), below[region.slices()])
+
+        return regions
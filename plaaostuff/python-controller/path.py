@@ -2,6 +2,7 @@
 
 from os import path
 import sys
+from typing import Union
 
 
 def from_root(relative: str):
@@ -13,3 +14,20 @@ def from_root(relative: str):
     """
     this_folder = path.dirname(sys.argv[0])
     return path.normpath(path.join(this_folder, relative))
+
+
+def from_argv(flag: str) -> Union[str, None]:
+    """
+    Return the path given after flag on the command line, or None if the flag isn't there. Exits with an error if the
+    flag is there with no path after it.
+
+    :param flag: The flag the path comes after, e.g. "--record"
+    """
+    if flag not in sys.argv:
+        return None
+
+    index = sys.argv.index(flag) + 1
+    if index >= len(sys.argv) or sys.argv[index].startswith("--"):
+        sys.exit("{} needs a path after it".format(flag))
+
+    return sys.argv[index]
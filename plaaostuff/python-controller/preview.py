@@ -0,0 +1,110 @@
+"""An incremental truecolour preview of a canvas in the terminal, for --print-canvas."""
+
+from typing import List, Union
+
+import numpy as np
+
+from dat import Rect, Vector2
+
+
+# the top half of a cell is the foreground colour and the bottom half the background, so each cell is two pixels
+UPPER_HALF = "▀"
+FULL = "█"
+
+
+class TerminalPreview:
+    """
+    Draws frames in the terminal two pixels to a character cell, using upper half blocks.
+
+    Only the cells that changed since the last draw are redrawn, the cursor is only moved when the next changed cell
+    isn't where it already is, and colours are only set when they're different to the ones already set. So a frame
+    where little has changed costs next to nothing to draw.
+
+    :param dimensions: The size of the frames
+    :param origin: Where the top left of the preview goes in the terminal, as 1-based (column, row)
+    """
+
+    def __init__(self, dimensions: Vector2, origin: Vector2 = Vector2(1, 1)):
+        self.dimensions = dimensions
+        self.origin = origin
+
+        self.rows = (dimensions.y + 1) // 2
+        # frames are padded to a whole number of cells; the padding stays black
+        self.current = np.zeros((self.rows * 2, dimensions.x, 3), dtype=np.uint8)
+        self.previous: Union[np.ndarray, None] = None
+
+    def invalidate(self):
+        # redraw everything next time, e.g. after the screen's been cleared
+        self.previous = None
+
+    def render(self, frame: np.ndarray, regions: Union[List[Rect], None] = None) -> str:
+        """
+        Return what needs printing to bring the preview up to date with an (h, w, 3) frame. It ends with the cursor
+        at the start of the line under the preview and colours reset.
+
+        :param frame: The frame to show
+        :param regions: The only areas that can have changed since the last frame shown, like a canvas's
+                        updated_regions, if they're known; only the rows of cells they cover are looked at
+        """
+        top = self.current[0::2]
+        bottom = self.current[1::2]
+
+        if self.previous is None or regions is None:
+            cell_rows = [(0, self.rows)]
+        else:
+            # the rows of cells covered by any of the regions, as runs of [start, end)
+            covered = np.zeros(self.rows + 1, dtype=bool)
+            for region in regions:
+                covered[region.y // 2:(region.bottom + 1) // 2] = True
+
+            edges = np.flatnonzero(np.diff(covered, prepend=False))
+            cell_rows = list(zip(edges[0::2].tolist(), edges[1::2].tolist()))
+
+        changed = np.zeros(top.shape[:2], dtype=bool)
+        for start, end in cell_rows:
+            self.current[start * 2:min(end * 2, self.dimensions.y)] = frame[start * 2:end * 2]
+            if self.previous is None:
+                changed[start:end] = True
+            else:
+                changed[start:end] = np.any(top[start:end] != self.previous[start * 2:end * 2:2], axis=2) \
+                    | np.any(bottom[start:end] != self.previous[start * 2 + 1:end * 2:2], axis=2)
+
+        if self.previous is None:
+            self.previous = self.current.copy()
+        else:
+            for start, end in cell_rows:
+                self.previous[start * 2:end * 2] = self.current[start * 2:end * 2]
+
+        rows, cols = np.nonzero(changed)
+        out: List[str] = []
+        fg = bg = None
+        cursor = None
+
+        for row, col, upper, lower in zip(rows.tolist(), cols.tolist(), top[rows, cols].tolist(),
+                                          bottom[rows, cols].tolist()):
+            if cursor != (row, col):
+                out.append("\x1b[{};{}H".format(self.origin.y + row, self.origin.x + col))
+
+            upper, lower = tuple(upper), tuple(lower)
+            if upper == lower:
+                # a solid cell can be drawn with either colour, so use whichever's already set
+                if upper == bg:
+                    out.append(" ")
+                else:
+                    if upper != fg:
+                        fg = upper
+                        out.append("\x1b[38;2;{};{};{}m".format(*fg))
+                    out.append(FULL)
+            else:
+                if upper != fg:
+                    fg = upper
+                    out.append("\x1b[38;2;{};{};{}m".format(*fg))
+                if lower != bg:
+                    bg = lower
+                    out.append("\x1b[48;2;{};{};{}m".format(*bg))
+                out.append(UPPER_HALF)
+
+            cursor = (row, col + 1)
+
+        out.append("\x1b[0m\x1b[{};1H".format(self.origin.y + self.rows))
+        return "".join(out)
@@ -0,0 +1,236 @@
+"""
+Recordings of the exact stream a controller sends down the pipe, timestamped, so it can be replayed (see replay.py)
+without running the controller again.
+
+A recording file is laid out as:
+    header (RECORDING_HEADER, padded to RECORDING_DATA_OFFSET bytes):
+        magic ("RMRC") | version (u8) | padding (3 bytes) | message count (u32) | index offset (u64)
+        | when recording started (f64, unix time)
+    messages, one after another, each:
+        length (u32) | time since recording started (f64, seconds) | the message itself
+    index, at the index offset: for each message, where it starts (u64), its length (u32) and its time (f64)
+all little endian.
+
+The index is fixed width, so finding message n is one lookup however long the recording is, and the whole file can be
+memory mapped and read straight from the mapping. It's written when the recording is closed; until then the message
+count and index offset are zero, and a reader rebuilds the index by walking the messages instead, so a recording cut
+short by a crash can still be played.
+"""
+
+import mmap
+import struct
+import time
+from typing import BinaryIO, Callable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+import rpi_ipc
+
+
+RECORDING_MAGIC = b"RMRC"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<4sB3xIQd")
+RECORDING_DATA_OFFSET = 32
+
+RECORD_HEADER = struct.Struct("<Id")
+INDEX_ENTRY = np.dtype([("offset", "<u8"), ("length", "<u4"), ("time", "<f8")])
+
+
+class FrameRecorder:
+    """
+    Writes a recording. Give one to a PipeWriter (as its recorder) to record everything sent down the pipe, or use it
+    in place of a PipeWriter to record without a matrix at all; it has the same write(), flush(), send() and close(),
+    and never has anything pending.
+
+    :param path: The file to record to; overwritten if it exists
+    :param clock: Where message times come from
+    """
+
+    def __init__(self, path: str, clock: Callable[[], float] = time.monotonic):
+        self.path = path
+        self.clock = clock
+
+        self.file: Union[BinaryIO, None] = open(path, "wb")
+        self.file.write(bytes(RECORDING_DATA_OFFSET))
+
+        self.started_at = time.time()
+        self.started = clock()
+        self.offset = RECORDING_DATA_OFFSET
+
+        self.offsets: List[int] = []
+        self.lengths: List[int] = []
+        self.times: List[float] = []
+        self.bytes = 0
+
+        # a recording never loses track of anything, but it's here for standing in for a PipeWriter
+        self.desynced = False
+
+    def __str__(self):
+        return "{} messages ({} bytes) recorded to {}".format(len(self.offsets), self.bytes, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, data: bytes, t: Union[float, None] = None):
+        """
+        Add a message, at time t (seconds since the recording started) or now.
+        """
+        if self.file is None:
+            return
+
+        if t is None:
+            t = self.clock() - self.started
+
+        self.file.write(RECORD_HEADER.pack(len(data), t))
+        self.file.write(data)
+
+        self.offsets.append(self.offset + RECORD_HEADER.size)
+        self.lengths.append(len(data))
+        self.times.append(t)
+        self.offset += RECORD_HEADER.size + len(data)
+        self.bytes += len(data)
+
+    # the same as a PipeWriter's, so this can stand in for one
+    @property
+    def pending(self) -> int:
+        return 0
+
+    def fileno(self) -> Union[int, None]:
+        return None
+
+    def write(self, data: bytes) -> bool:
+        if data:
+            self.record(data)
+        return True
+
+    def flush(self) -> bool:
+        return True
+
+    def drop(self):
+        pass
+
+    def resync(self, data: bytes) -> bool:
+        return self.write(data)
+
+    def send(self, data: bytes) -> bool:
+        return self.write(data)
+
+    def close(self, timeout: float = 0):
+        # write the index and fill the header in
+        if self.file is None:
+            return
+
+        index = np.empty(len(self.offsets), dtype=INDEX_ENTRY)
+        index["offset"] = self.offsets
+        index["length"] = self.lengths
+        index["time"] = self.times
+        self.file.write(index.tobytes())
+
+        self.file.seek(0)
+        self.file.write(RECORDING_HEADER.pack(
+            RECORDING_MAGIC, RECORDING_VERSION, len(index), self.offset, self.started_at
+        ))
+        self.file.close()
+        self.file = None
+
+
+class Recording:
+    """
+    A recording, memory mapped for reading. recording[n] is message n.
+
+    :param path: The recording file
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < RECORDING_DATA_OFFSET:
+            raise rpi_ipc.ProtocolError("{} is too small to be a recording".format(path))
+
+        magic, version, count, index_offset, self.started_at = RECORDING_HEADER.unpack_from(self.map, 0)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise rpi_ipc.ProtocolError("Not a version {} recording".format(RECORDING_VERSION))
+
+        # whether the recording was closed properly. if it wasn't, there's no index to read
+        self.complete = index_offset != 0
+        if self.complete:
+            if index_offset + count * INDEX_ENTRY.itemsize > len(self.map):
+                raise rpi_ipc.ProtocolError("Recording index runs past the end of the file")
+
+            self.index = np.frombuffer(self.map, dtype=INDEX_ENTRY, count=count, offset=index_offset)
+        else:
+            self.index = self._scan()
+
+    def _scan(self) -> np.ndarray:
+        # rebuild the index by walking the messages, stopping at one that was only partly written
+        entries: List[Tuple[int, int, float]] = []
+        pos = RECORDING_DATA_OFFSET
+        while pos + RECORD_HEADER.size <= len(self.map):
+            length, t = RECORD_HEADER.unpack_from(self.map, pos)
+            start = pos + RECORD_HEADER.size
+            if start + length > len(self.map):
+                break
+
+            entries.append((start, length, t))
+            pos = start + length
+
+        return np.array(entries, dtype=INDEX_ENTRY)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, n: int) -> bytes:
+        entry = self.index[n]
+        offset = int(entry["offset"])
+        return self.map[offset:offset + int(entry["length"])]
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.messages()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def time(self, n: int) -> float:
+        # when message n was sent, in seconds since the recording started
+        return float(self.index["time"][n])
+
+    def is_keyframe(self, n: int) -> bool:
+        # whether message n starts by clearing or filling the panel, so doesn't depend on anything sent before it
+        message = self[n]
+        return len(message) > rpi_ipc.FRAME_HEADER.size \
+            and message[rpi_ipc.FRAME_HEADER.size] in (rpi_ipc.OP_CLEAR, rpi_ipc.OP_FILL)
+
+    def keyframe_before(self, n: int) -> int:
+        """
+        The last keyframe before message n, or 0 if there isn't one; a controller starts from a cleared panel, so the
+        start of a recording is as good as one.
+        """
+        for key in range(min(n, len(self)) - 1, 0, -1):
+            if self.is_keyframe(key):
+                return key
+
+        return 0
+
+    @property
+    def duration(self) -> float:
+        return float(self.index["time"][-1]) if len(self.index) else 0.0
+
+    @property
+    def bytes(self) -> int:
+        return int(self.index["length"].sum())
+
+    def messages(self, start: int = 0, end: Union[int, None] = None) -> Iterator[bytes]:
+        for n in range(start, len(self) if end is None else min(end, len(self))):
+            yield self[n]
+
+    def close(self):
+        # the index can be a view of the mapping, which has to go before the mapping can be closed
+        self.index = np.zeros(0, dtype=INDEX_ENTRY)
+        self.map.close()
@@ -0,0 +1,133 @@
+"""
+Plays a recording (see recording.py) back down the matrix pipe, at the speed it was recorded or faster, without
+running the controller that made it.
+
+    python3 replay.py RECORDING [--pipe PATH] [--speed N] [--start MESSAGE] [--end MESSAGE] [--loop] [--no-clear]
+                                [--size WIDTH HEIGHT]
+
+--speed 0 sends everything as fast as the reader takes it, for benchmarking ipc.cc (or emulator.py) on its own.
+Every message is a delta against the ones before it, so starting part way through with --start first catches the
+panel up: everything from the last keyframe (a message that clears or fills the panel) up to the start is played
+into an emulator, and the result sent as one message that clears the panel and redraws it. With --no-clear it
+plays from there on top of whatever the panel is already showing instead.
+"""
+
+import argparse
+import select
+import time
+
+import numpy as np
+
+import rpi_ipc
+from dat import Vector2
+from emulator import Emulator
+from recording import Recording
+
+
+def send_blocking(pipe: rpi_ipc.PipeWriter, data: bytes):
+    # replays shouldn't drop anything, so wait for room in the queue rather than having messages refused
+    while not pipe.write(data):
+        if pipe.flush():
+            continue
+
+        fd = pipe.fileno()
+        if fd is None:
+            time.sleep(0.05)
+        else:
+            select.select([], [fd], [], 0.05)
+
+    pipe.flush()
+
+
+def catch_up(recording: Recording, start: int, dimensions: Vector2 = Vector2(64, 64)) -> bytes:
+    """
+    A message that clears the panel and draws what it would be showing just before message start, worked out by
+    playing everything from the keyframe before it into an emulator.
+    """
+    panel = Emulator(dimensions)
+    for message in recording.messages(recording.keyframe_before(start), start):
+        panel.feed(message)
+
+    encoder = rpi_ipc.FrameEncoder()
+    encoder.clear()
+    encoder.changes(np.any(panel.framebuffer != 0, axis=2), panel.framebuffer)
+    return encoder.getvalue()
+
+
+def replay(recording: Recording, pipe: rpi_ipc.PipeWriter, speed: float = 1, start: int = 0, end: int = -1,
+           clear: bool = True, dimensions: Vector2 = Vector2(64, 64)) -> float:
+    """
+    Send messages start to end (exclusive, or to the end if negative) of a recording down the pipe, spaced out like
+    they were when recorded (sped up speed times; 0 for no waiting). Returns how late the latest message was sent,
+    in seconds.
+
+    :param recording: What to play
+    :param pipe: Where to send it
+    :param speed: How many times faster than recorded to play it
+    :param start: The first message to send
+    :param end: The message to stop before
+    :param clear: Whether to clear the panel first (and catch it up to start, if that isn't 0)
+    :param dimensions: The size of the panel, for catching up
+    """
+    end = len(recording) if end < 0 else min(end, len(recording))
+    if start >= end:
+        return 0.0
+
+    if clear:
+        send_blocking(pipe, catch_up(recording, start, dimensions) if start else rpi_ipc.encode_clear())
+
+    times = recording.index["time"]
+    first = float(times[start])
+    began = time.monotonic()
+    latest = 0.0
+
+    for n in range(start, end):
+        if speed > 0:
+            due = began + (float(times[n]) - first) / speed
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            else:
+                latest = max(latest, -wait)
+
+        send_blocking(pipe, recording[n])
+
+    return latest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play a recording back down the matrix pipe.")
+    parser.add_argument("recording", help="the recording to play")
+    parser.add_argument("--pipe", default=rpi_ipc.PIPE_PATH, help="the fifo to write to")
+    parser.add_argument("--speed", type=float, default=1, help="how many times faster to play it (0 for flat out)")
+    parser.add_argument("--start", type=int, default=0, help="the message to start from")
+    parser.add_argument("--end", type=int, default=-1, help="the message to stop before")
+    parser.add_argument("--loop", action="store_true", help="play it over and over")
+    parser.add_argument("--no-clear", action="store_true", help="don't clear (or catch up) the panel before playing")
+    parser.add_argument("--size", type=int, nargs=2, default=(64, 64), metavar=("WIDTH", "HEIGHT"))
+    args = parser.parse_args()
+
+    recording = Recording(args.recording)
+    print("{} messages, {} bytes, {:.1f}s{}".format(
+        len(recording), recording.bytes, recording.duration, "" if recording.complete else " (not closed properly)"
+    ))
+
+    pipe = rpi_ipc.PipeWriter(args.pipe)
+    began = time.monotonic()
+    plays = 0
+    try:
+        while True:
+            late = replay(recording, pipe, args.speed, args.start, args.end, not args.no_clear, Vector2(*args.size))
+            plays += 1
+            if not args.loop:
+                break
+    except KeyboardInterrupt:
+        late = 0.0
+    finally:
+        elapsed = time.monotonic() - began
+        pipe.close()
+        recording.close()
+
+    print("played {} time(s) in {:.2f}s, {} writes, {} bytes{}".format(
+        plays, elapsed, pipe.writes, pipe.written, ", up to {:.1f}ms late".format(late * 1000) if late else ""
+    ))
@@ -1,37 +1,639 @@
 import os
+import select
+import struct
+import time
+from collections import deque
+from typing import Callable, Deque, Iterator, List, Tuple, Union
 
+import numpy as np
 
-def open_pipe(clear=False):
-    if os.path.exists("/home/pi/scrimblopipe"):
-        pipe = open("/home/pi/scrimblopipe", "w")
-        if clear:
-            pipe.write("CLEAR")
-            pipe.flush()
+import timing
+from calibration import Calibration
+from dat import Rect
 
-        return pipe
 
+PIPE_PATH = "/home/pi/scrimblopipe"
 
-def send_pipe(pipe, messages):
-    if pipe:
-        for st in messages:
-            pipe.write(st)
-            pipe.flush()
+# wire protocol, shared with ipc.cc.
+# everything sent down the pipe is a sequence of frames:
+#   magic (2 bytes, "RM") | version (u8) | body length (u16, little endian) | body
+# and a body is a sequence of commands, each an opcode byte followed by fixed width operands:
+#   PIXELS: count (u16), then count records of x, y, r, g, b (u8 each)
+#   CLEAR:  nothing
+#   FILL:   r, g, b
+#   EXIT:   nothing
+#   HLINE:  x, y, length, r, g, b
+#   VLINE:  x, y, length, r, g, b
+#   RECT:   x, y, width, height, r, g, b
+#   SHM_FRAME: buffer (u8), sequence number (u32); show a whole frame from shared memory (see shm.py)
+# frames are never bigger than PIPE_BUF, so each one can be written (and read) in one go.
+PROTOCOL_VERSION = 2
+MAGIC = b"RM"
+MAX_FRAME_SIZE = 4096
+
+FRAME_HEADER = struct.Struct("<2sBH")
+PIXELS_HEADER = struct.Struct("<BH")
+PIXEL_RECORD_SIZE = 5
+
+OP_PIXELS = 0x01
+OP_CLEAR = 0x02
+OP_FILL = 0x03
+OP_EXIT = 0x04
+OP_HLINE = 0x05
+OP_VLINE = 0x06
+OP_RECT = 0x07
+OP_SHM_FRAME = 0x08
+
+LINE_COMMAND_SIZE = 7
+RECT_COMMAND_SIZE = 8
+SHM_FRAME_COMMAND = struct.Struct("<BBI")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+class FrameEncoder:
+    """
+    Builds a protocol message out of commands, splitting it into as many frames as it needs.
+
+    :param max_frame_size: The largest frame (header included) that will be emitted
+    :param calibration: The panel calibration to apply to every colour sent, if any
+    """
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE, calibration: Union[Calibration, None] = None):
+        self.max_body = max_frame_size - FRAME_HEADER.size
+        self.calibration = calibration
+        self.buffer = bytearray()
+        self.frame_start = -1
+
+    def _body_len(self) -> int:
+        return len(self.buffer) - self.frame_start - FRAME_HEADER.size
+
+    def _end_frame(self):
+        if self.frame_start >= 0:
+            FRAME_HEADER.pack_into(self.buffer, self.frame_start, MAGIC, PROTOCOL_VERSION, self._body_len())
+            self.frame_start = -1
+
+    def _reserve(self, size: int):
+        # start a new frame if this command won't fit in the current one
+        if self.frame_start >= 0 and self._body_len() + size > self.max_body:
+            self._end_frame()
+
+        if self.frame_start < 0:
+            self.frame_start = len(self.buffer)
+            self.buffer += bytes(FRAME_HEADER.size)
+
+    def clear(self):
+        self._reserve(1)
+        self.buffer.append(OP_CLEAR)
+
+    def exit(self):
+        self._reserve(1)
+        self.buffer.append(OP_EXIT)
+
+    def shm_frame(self, index: int, seq: int):
+        self._reserve(SHM_FRAME_COMMAND.size)
+        self.buffer += SHM_FRAME_COMMAND.pack(OP_SHM_FRAME, index, seq)
+
+    def fill(self, r: int, g: int, b: int):
+        self._reserve(4)
+        self.buffer += bytes((OP_FILL, r, g, b))
+
+        # the panel gets filled uncalibrated, so go back over every pixel the calibration changes
+        if self.calibration is not None and not self.calibration.identity:
+            frame = np.empty(self.calibration.gain.shape, dtype=np.uint8)
+            frame[:] = (r, g, b)
+            self.changes(self.calibration.adjusted, frame)
+
+    def pixels(self, xs: np.ndarray, ys: np.ndarray, cols: np.ndarray):
+        """
+        Add a batch of pixel records.
+
+        :param xs: The x coordinate of each pixel
+        :param ys: The y coordinate of each pixel
+        :param cols: An (N, 3) array of the colour of each pixel
+        """
+        if len(xs) == 0:
+            return
+
+        if max(np.max(xs), np.max(ys)) > 255:
+            raise ProtocolError("Pixel coordinates must fit in a byte")
+
+        records = np.empty((len(xs), PIXEL_RECORD_SIZE), dtype=np.uint8)
+        records[:, 0] = xs
+        records[:, 1] = ys
+        records[:, 2:] = cols
+        data = records.tobytes()
+
+        done = 0
+        while done < len(xs):
+            self._reserve(PIXELS_HEADER.size + PIXEL_RECORD_SIZE)
+            space = (self.max_body - self._body_len() - PIXELS_HEADER.size) // PIXEL_RECORD_SIZE
+            count = min(space, len(xs) - done)
+
+            self.buffer += PIXELS_HEADER.pack(OP_PIXELS, count)
+            self.buffer += data[done * PIXEL_RECORD_SIZE:(done + count) * PIXEL_RECORD_SIZE]
+            done += count
+
+    def _commands(self, data: bytes, size: int):
+        # append a run of fixed size, self contained commands, moving on to new frames as each one fills up
+        count = len(data) // size
+        done = 0
+        while done < count:
+            self._reserve(size)
+            fits = min((self.max_body - self._body_len()) // size, count - done)
+
+            self.buffer += data[done * size:(done + fits) * size]
+            done += fits
+
+    def changes(self, mask: np.ndarray, frame: np.ndarray, origin_x: int = 0, origin_y: int = 0):
+        """
+        Add every pixel in mask, coalescing runs of the same colour into lines and rectangles where it can.
+        Colours are calibrated on the way.
+
+        :param mask: An (H, W) array of which pixels to send
+        :param frame: An (H, W, 3) array of the colour of each pixel
+        :param origin_x: Where the left edge of mask and frame is on the canvas
+        :param origin_y: Where the top edge of mask and frame is on the canvas
+        """
+        h, w = mask.shape
+        if not mask.any():
+            return
 
+        if max(origin_x + w, origin_y + h) > 256:
+            raise ProtocolError("Pixel coordinates must fit in a byte")
 
-def send_prot_msg(pipe, st):
-    sts = []
+        if self.calibration is not None:
+            frame = self.calibration.apply(frame, Rect(origin_x, origin_y, w, h))
 
-    if len(st) > 4096:
-        buffer = ""
-        for part in st.split("|"):
-            if len(buffer + part + "|") > 4096:
-                sts.append(buffer)
-                buffer = part + "|"
+        # pack every colour into one int so runs can be found with a single comparison, with -1 for anything
+        # we aren't sending. the extra column on the end stops any run carrying over onto the next row
+        keys = np.full((h, w + 1), -1, dtype=np.int32)
+        keys[:, :w] = np.where(
+            mask,
+            (frame[:, :, 0].astype(np.int32) << 16) | (frame[:, :, 1].astype(np.int32) << 8) | frame[:, :, 2],
+            -1
+        )
+
+        flat = keys.ravel()
+        starts = np.flatnonzero(np.concatenate(([True], flat[1:] != flat[:-1])))
+        lengths = np.diff(np.append(starts, len(flat)))
+        runs = flat[starts] != -1
+        starts, lengths = starts[runs], lengths[runs]
+        run_keys = flat[starts]
+        run_ys, run_xs = np.divmod(starts, w + 1)
+        run_xs += origin_x
+        run_ys += origin_y
+
+        # then stack runs with the same start, length and colour on consecutive rows into rectangles
+        rects = []
+        open_rects = {}
+        for x, y, length, key in zip(run_xs.tolist(), run_ys.tolist(), lengths.tolist(), run_keys.tolist()):
+            rect = open_rects.get((x, length, key))
+            if rect and rect[1] + rect[3] == y:
+                rect[3] += 1
             else:
-                buffer += part + "|"
+                rect = [x, y, length, 1, key]
+                open_rects[(x, length, key)] = rect
+                rects.append(rect)
+
+        rects = np.array(rects, dtype=np.int32).reshape(-1, 5)
+        xs, ys, ws, hs, ks = rects.T
+        cols = np.stack(((ks >> 16) & 0xff, (ks >> 8) & 0xff, ks & 0xff), axis=1)
+
+        single = (ws == 1) & (hs == 1)
+        self.pixels(xs[single], ys[single], cols[single])
+
+        for op, sel, length in (
+            (OP_HLINE, (ws > 1) & (hs == 1), ws),
+            (OP_VLINE, (ws == 1) & (hs > 1), hs)
+        ):
+            records = np.empty((np.count_nonzero(sel), LINE_COMMAND_SIZE), dtype=np.uint8)
+            records[:, 0] = op
+            records[:, 1] = xs[sel]
+            records[:, 2] = ys[sel]
+            records[:, 3] = length[sel]
+            records[:, 4:] = cols[sel]
+            self._commands(records.tobytes(), LINE_COMMAND_SIZE)
+
+        sel = (ws > 1) & (hs > 1)
+        records = np.empty((np.count_nonzero(sel), RECT_COMMAND_SIZE), dtype=np.uint8)
+        records[:, 0] = OP_RECT
+        records[:, 1] = xs[sel]
+        records[:, 2] = ys[sel]
+        records[:, 3] = ws[sel]
+        records[:, 4] = hs[sel]
+        records[:, 5:] = cols[sel]
+        self._commands(records.tobytes(), RECT_COMMAND_SIZE)
+
+    def getvalue(self) -> bytes:
+        self._end_frame()
+        return bytes(self.buffer)
+
+
+def encode_clear() -> bytes:
+    encoder = FrameEncoder()
+    encoder.clear()
+    return encoder.getvalue()
+
+
+def encode_exit() -> bytes:
+    encoder = FrameEncoder()
+    encoder.exit()
+    return encoder.getvalue()
+
+
+def encode_shm_frame(index: int, seq: int) -> bytes:
+    encoder = FrameEncoder()
+    encoder.shm_frame(index, seq)
+    return encoder.getvalue()
+
+
+def iter_frames(data: bytes) -> Iterator[Tuple[int, int]]:
+    """
+    Walk the frame headers in a message, yielding the (start, end) offsets of each whole frame.
+    """
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < FRAME_HEADER.size:
+            raise ProtocolError("Truncated frame header at offset {}".format(offset))
+
+        magic, version, length = FRAME_HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ProtocolError("Bad frame magic at offset {}".format(offset))
+
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError("Unsupported protocol version {}".format(version))
+
+        end = offset + FRAME_HEADER.size + length
+        if end > len(data):
+            raise ProtocolError("Truncated frame body at offset {}".format(offset))
+
+        yield offset, end
+        offset = end
+
+
+_LINE_NAMES = {OP_HLINE: "HLINE", OP_VLINE: "VLINE", OP_RECT: "RECT"}
+
+
+def decode(data: bytes) -> List[tuple]:
+    """
+    Reference decoder for the wire protocol; mirrors what ipc.cc does with a message.
+
+    Returns a list of commands, each one of ("CLEAR",), ("EXIT",), ("FILL", r, g, b), ("PIXEL", x, y, r, g, b),
+    ("HLINE", x, y, length, r, g, b), ("VLINE", x, y, length, r, g, b), ("RECT", x, y, width, height, r, g, b) or
+    ("SHM_FRAME", buffer, seq).
+    """
+    commands = []
+    for start, end in iter_frames(data):
+        body = memoryview(data)[start + FRAME_HEADER.size:end]
+        pos = 0
+        while pos < len(body):
+            op = body[pos]
+            if op == OP_CLEAR:
+                commands.append(("CLEAR",))
+                pos += 1
+            elif op == OP_EXIT:
+                commands.append(("EXIT",))
+                pos += 1
+            elif op == OP_FILL:
+                if pos + 4 > len(body):
+                    raise ProtocolError("Truncated FILL command")
+
+                commands.append(("FILL",) + tuple(body[pos + 1:pos + 4]))
+                pos += 4
+            elif op == OP_PIXELS:
+                if pos + PIXELS_HEADER.size > len(body):
+                    raise ProtocolError("Truncated PIXELS command")
+
+                _, count = PIXELS_HEADER.unpack_from(body, pos)
+                pos += PIXELS_HEADER.size
+                if pos + count * PIXEL_RECORD_SIZE > len(body):
+                    raise ProtocolError("Truncated PIXELS records")
+
+                for _ in range(count):
+                    commands.append(("PIXEL",) + tuple(body[pos:pos + PIXEL_RECORD_SIZE]))
+                    pos += PIXEL_RECORD_SIZE
+            elif op in (OP_HLINE, OP_VLINE, OP_RECT):
+                size = RECT_COMMAND_SIZE if op == OP_RECT else LINE_COMMAND_SIZE
+                if pos + size > len(body):
+                    raise ProtocolError("Truncated {} command".format(_LINE_NAMES[op]))
+
+                commands.append((_LINE_NAMES[op],) + tuple(body[pos + 1:pos + size]))
+                pos += size
+            elif op == OP_SHM_FRAME:
+                if pos + SHM_FRAME_COMMAND.size > len(body):
+                    raise ProtocolError("Truncated SHM_FRAME command")
+
+                _, index, seq = SHM_FRAME_COMMAND.unpack_from(body, pos)
+                commands.append(("SHM_FRAME", index, seq))
+                pos += SHM_FRAME_COMMAND.size
+            else:
+                raise ProtocolError("Unknown opcode {:#04x}".format(op))
+
+    return commands
 
-        sts.append(buffer)
-    else:
-        sts = [st]
 
-    send_pipe(pipe, sts)
+class PipeWriter:
+    """
+    Writes protocol messages to the matrix fifo without ever blocking.
+
+    Messages are queued in a preallocated buffer and written out in chunks of whole frames, each no bigger than
+    MAX_FRAME_SIZE (PIPE_BUF), so every chunk goes into the fifo atomically or not at all. Whatever the fifo can't
+    take yet stays queued for the next flush(), so a slow reader shows up as pending bytes rather than a stalled
+    render loop. If the reader isn't there (or goes away) the fifo is reopened on a later flush.
+
+    Every message is a delta against the last, so one that's refused, or a new reader that missed everything before
+    it, leaves the panel out of step with what's been sent. When that happens desynced is set, and it's up to whoever
+    is sending to resync() with a message that redraws the whole frame (see Canvas.full_frame()).
+
+    :param path: The fifo to write to
+    :param capacity: How many bytes can be queued before messages start getting refused
+    """
+
+    def __init__(self, path: str = PIPE_PATH, capacity: int = 64 * 1024):
+        self.path = path
+        self.fd: Union[int, None] = None
+
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        # what's queued is buffer[start:end], split into chunks ending at each of chunk_ends
+        self.start = 0
+        self.end = 0
+        self.chunk_ends: Deque[int] = deque()
+
+        # backpressure stats
+        self.writes = 0
+        self.written = 0
+        # times the fifo was full
+        self.eagain = 0
+        # messages (and their bytes) refused because the queue was full
+        self.refused = 0
+        self.refused_bytes = 0
+
+        # something to hand every queued message to as well, like a recording.FrameRecorder
+        self.recorder = None
+
+        # whether the panel's out of step with what's been sent, and whether the reader went away (so the next one
+        # to open the fifo is a new one)
+        self.desynced = False
+        self.reconnecting = False
+
+    def __str__(self):
+        return "{} bytes pending, {} writes, {} full, {} refused".format(
+            self.pending, self.writes, self.eagain, self.refused
+        )
+
+    @property
+    def pending(self) -> int:
+        return self.end - self.start
+
+    def fileno(self) -> Union[int, None]:
+        return self.fd
+
+    def open(self) -> bool:
+        """
+        Try to open the fifo, returning whether it's open. Fails if nothing has it open for reading.
+        """
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError:
+                return False
+
+            if self.reconnecting:
+                # the new reader wasn't there for anything before, so what's queued is deltas against nothing it's
+                # seen. no point sending them
+                self.reconnecting = False
+                self.drop()
+                self.desynced = True
+
+        return True
+
+    def drop(self):
+        # forget everything queued
+        self.start = self.end = 0
+        self.chunk_ends.clear()
+
+    def _compact(self):
+        # move whatever's queued back to the start of the buffer
+        length = self.pending
+        self.buffer[:length] = self.buffer[self.start:self.end]
+        self.chunk_ends = deque(end - self.start for end in self.chunk_ends)
+        self.start = 0
+        self.end = length
+
+    def write(self, data: bytes) -> bool:
+        """
+        Queue a message without writing anything. Returns False if there wasn't room for it, in which case none of it
+        is queued.
+        """
+        if not data:
+            return True
+
+        if self.pending + len(data) > len(self.buffer):
+            self.refused += 1
+            self.refused_bytes += len(data)
+            self.desynced = True
+            return False
+
+        if self.end + len(data) > len(self.buffer):
+            self._compact()
+
+        offset = self.end
+        self.view[offset:offset + len(data)] = data
+        self.end += len(data)
+
+        # extend the last chunk with as many frames as fit, then start new ones
+        for _, frame_end in iter_frames(data):
+            frame_end += offset
+            chunk_start = self.chunk_ends[-2] if len(self.chunk_ends) > 1 else self.start
+            if self.chunk_ends and frame_end - chunk_start <= MAX_FRAME_SIZE:
+                self.chunk_ends[-1] = frame_end
+            else:
+                self.chunk_ends.append(frame_end)
+
+        if self.recorder is not None:
+            self.recorder.record(data)
+
+        return True
+
+    def flush(self) -> bool:
+        """
+        Write as much of the queue as the fifo will take right now. Returns whether everything got written.
+        """
+        with timing.span("write"):
+            while self.chunk_ends:
+                if not self.open():
+                    return False
+                if not self.chunk_ends:
+                    # opening it found a new reader, so the queue's been dropped
+                    break
+
+                chunk_end = self.chunk_ends[0]
+                try:
+                    os.write(self.fd, self.view[self.start:chunk_end])
+                except BlockingIOError:
+                    self.eagain += 1
+                    return False
+                except BrokenPipeError:
+                    # the reader went away. the queue's kept until another one turns up, then dropped (see open())
+                    self.close_fd()
+                    self.reconnecting = True
+                    return False
+
+                self.writes += 1
+                self.written += chunk_end - self.start
+                self.start = chunk_end
+                self.chunk_ends.popleft()
+
+            self.start = self.end = 0
+            return True
+
+    def send(self, data: bytes) -> bool:
+        # queue a message and write as much as possible straight away
+        queued = self.write(data)
+        self.flush()
+        return queued
+
+    def resync(self, data: bytes) -> bool:
+        """
+        Drop everything queued and send data instead, which should bring the panel back in step from whatever it's
+        showing (e.g. a CLEAR and the whole frame). Returns whether it got queued.
+        """
+        self.drop()
+        self.desynced = False
+        return self.send(data)
+
+    def close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self, timeout: float = 1.0):
+        """
+        Spend up to timeout seconds getting the rest of the queue written, then close the fifo.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.flush():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            if self.fd is None:
+                time.sleep(min(remaining, 0.05))
+            else:
+                select.select([], [self.fd], [], remaining)
+
+        self.close_fd()
+
+
+class CoalescingSender:
+    """
+    Sends whole frames down a PipeWriter, latest frame wins.
+
+    Only one delta is ever queued at a time. While it's still being written, new frames aren't queued behind it;
+    each one just replaces the last one waiting. Once the queue empties, the newest frame is sent as one delta against
+    what the panel will be showing by then, and every frame in between is dropped. So when the matrix falls behind,
+    the display skips frames rather than lagging further and further behind.
+
+    :param writer: Where to send the frames
+    :param calibration: The panel calibration to apply to every colour sent, if any
+    """
+
+    def __init__(self, writer: PipeWriter, calibration: Union[Calibration, None] = None):
+        self.writer = writer
+        self.calibration = calibration
+
+        # what the panel shows after everything written so far, what it'll show once the queued delta is written,
+        # and the newest frame that hasn't been queued yet. None until the first frame
+        self.acked: Union[np.ndarray, None] = None
+        self.in_flight: Union[np.ndarray, None] = None
+        self.latest: Union[np.ndarray, None] = None
+        # whether there's a delta queued, and a frame waiting behind it
+        self.flying = False
+        self.waiting = False
+
+        self.frames = 0
+        self.sent = 0
+        self.dropped = 0
+
+    def __str__(self):
+        return "{} frames, {} sent, {} dropped".format(self.frames, self.sent, self.dropped)
+
+    def send(self, frame: np.ndarray) -> bool:
+        """
+        Send an (h, w, 3) frame, or hold onto it until the one before it is finished with. Returns whether it got
+        queued. The frame is copied, so it's fine to keep drawing on it afterwards.
+        """
+        if self.latest is None:
+            self.latest = np.empty_like(frame)
+            self.in_flight = np.empty_like(frame)
+            # the panel gets cleared before the first frame, so that's where we start from
+            self.acked = np.zeros_like(frame)
+            self.writer.write(encode_clear())
+
+        if self.waiting:
+            self.dropped += 1
+
+        self.frames += 1
+        self.latest[:] = frame
+        self.waiting = True
+        return self.flush()
+
+    def flush(self) -> bool:
+        """
+        Finish writing the queued delta if possible, then queue the frame waiting behind it. Returns whether there's
+        nothing left waiting.
+        """
+        drained = self.writer.flush()
+        if self.writer.desynced and self.latest is not None:
+            # the panel's lost track of what's been sent, so start again from a clear one with the newest frame
+            self.writer.resync(encode_clear())
+            self.acked[:] = 0
+            self.flying = False
+            self.waiting = True
+            drained = self.writer.flush()
+
+        if not drained:
+            return not self.waiting
+
+        if self.flying:
+            # the last delta's all written, so the panel's caught up to it
+            self.acked, self.in_flight = self.in_flight, self.acked
+            self.flying = False
+
+        if not self.waiting:
+            return True
+
+        with timing.span("encode"):
+            encoder = FrameEncoder(calibration=self.calibration)
+            encoder.changes(np.any(self.latest != self.acked, axis=2), self.latest)
+        if not self.writer.write(encoder.getvalue()):
+            return False
+
+        self.in_flight[:] = self.latest
+        self.flying = True
+        self.waiting = False
+        self.sent += 1
+
+        self.writer.flush()
+        return True
+
+
+def open_pipe(clear=False) -> Union[PipeWriter, None]:
+    if os.path.exists(PIPE_PATH):
+        pipe = PipeWriter(PIPE_PATH)
+        if clear:
+            pipe.send(encode_clear())
+
+        return pipe
+
+
+def send_prot_msg(pipe: Union[PipeWriter, None], st: bytes, resync: Union[Callable[[], bytes], None] = None):
+    # if the panel's lost track of what's been sent, resync() makes a message that redraws the whole frame instead
+    if pipe:
+        pipe.send(st)
+        if resync is not None and pipe.desynced:
+            pipe.resync(resync())
@@ -0,0 +1,153 @@
+"""
+An asyncio runtime for the controller scripts.
+
+The render loop, non-blocking writes to the matrix pipe, reads from input fifos and slow things like web requests
+all run as cooperative tasks, so nothing slow gets to hold up a frame.
+"""
+
+import asyncio
+import os
+import traceback
+from typing import Awaitable, Callable, List, Union
+
+import timing
+from rpi_ipc import PipeWriter
+from scheduler import FrameScheduler
+
+
+class Runtime:
+    """
+    Runs a render function on every tick of a scheduler, alongside any number of background tasks.
+
+    :param scheduler: What paces the render loop
+    :param pipe: The matrix pipe to send each frame to, if there is one
+    :param resync: Makes a message that redraws the whole frame, for when the panel's lost track of what's been sent
+                   (see PipeWriter.resync()); e.g. a canvas's full_frame
+    """
+
+    def __init__(
+            self, scheduler: FrameScheduler, pipe: Union[PipeWriter, None] = None,
+            resync: Union[Callable[[], bytes], None] = None
+    ):
+        self.scheduler = scheduler
+        self.pipe = pipe
+        self.resync = resync
+
+        self.tasks: List[Callable[[], Awaitable]] = []
+        # the pipe's fd while we're waiting for it to have room
+        self.watching: Union[int, None] = None
+
+    @staticmethod
+    async def run_blocking(func: Callable, *args, timeout: Union[float, None] = None):
+        """
+        Run a blocking function on a worker thread, giving up after timeout seconds.
+
+        If it times out the thread is left to finish in the background, but nothing waits for it any more.
+        """
+        return await asyncio.wait_for(asyncio.to_thread(func, *args), timeout)
+
+    def add_task(self, func: Callable[[], Awaitable]):
+        """
+        Run a coroutine function alongside the render loop.
+        """
+        self.tasks.append(func)
+
+    def read_lines(self, path: str, on_line: Callable[[str], None]):
+        """
+        Read lines from a fifo as they arrive, calling on_line with each one (without its newline).
+        """
+        async def task():
+            loop = asyncio.get_running_loop()
+            lines = asyncio.Queue()
+
+            # opened for reading and writing, so there's always a writer and we never see end of file
+            # when whoever's feeding the fifo goes away (this is fine on linux)
+            try:
+                fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+            except OSError:
+                traceback.print_exc()
+                return
+
+            partial = b""
+
+            def readable():
+                nonlocal partial
+                try:
+                    data = os.read(fd, 4096)
+                except BlockingIOError:
+                    return
+
+                *complete, partial = (partial + data).split(b"\n")
+                for line in complete:
+                    lines.put_nowait(line.decode("utf-8", "replace"))
+
+            loop.add_reader(fd, readable)
+            try:
+                while True:
+                    line = await lines.get()
+                    try:
+                        on_line(line)
+                    except Exception:
+                        traceback.print_exc()
+            finally:
+                loop.remove_reader(fd)
+                os.close(fd)
+
+        self.tasks.append(task)
+
+    def send(self, message: bytes):
+        # queue a message for the pipe and write as much as it'll take without waiting
+        if not self.pipe:
+            return
+
+        if message:
+            self.pipe.write(message)
+
+        if self.pipe.desynced and self.resync is not None:
+            self.pipe.resync(self.resync())
+
+        self._flush_pipe()
+
+    def _flush_pipe(self):
+        # whatever the pipe couldn't take gets written by the event loop as soon as there's room
+        loop = asyncio.get_running_loop()
+        drained = self.pipe.flush()
+
+        fd = None if drained else self.pipe.fileno()
+        if fd != self.watching:
+            if self.watching is not None:
+                loop.remove_writer(self.watching)
+            if fd is not None:
+                loop.add_writer(fd, self._flush_pipe)
+
+            self.watching = fd
+
+    async def _render_loop(self, render: Callable[[], Union[bytes, None]]):
+        while True:
+            await self.scheduler.tick()
+
+            with timing.span("render"):
+                message = render()
+
+            self.send(message)
+            timing.report()
+
+    async def main(self, render: Callable[[], Union[bytes, None]]):
+        tasks = [asyncio.create_task(task()) for task in self.tasks]
+        tasks.append(asyncio.create_task(self._render_loop(render)))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            if self.watching is not None:
+                asyncio.get_running_loop().remove_writer(self.watching)
+                self.watching = None
+
+    def run(self, render: Callable[[], Union[bytes, None]]):
+        """
+        Run forever, calling render on every tick and sending whatever message it returns down the pipe.
+        """
+        asyncio.run(self.main(render))
@@ -0,0 +1,136 @@
+"""Frame pacing for the controller scripts, without busy-waiting."""
+
+import asyncio
+import math
+import time
+from enum import Enum
+from typing import Tuple
+
+
+class FrameScheduler:
+    """
+    Paces a render loop to a fixed frame interval. Call wait() at the top of every frame.
+
+    Ticks are worked out from when the first one happened rather than from when the last one finished, so they don't
+    drift. Waiting is done with a sleep, then a short spin for the last little bit so the tick lands on time.
+
+    :param interval: How long each frame lasts, in seconds
+    :param align: Line ticks up with multiples of the interval on the wall clock (e.g. on the second for a clock)
+    :param policy: What to do when frames are running behind
+    :param spin: How long before each tick to stop sleeping and spin instead, in seconds
+    :param max_catch_up: With CATCH_UP, how many frames behind we can get before giving up and skipping the rest
+    """
+
+    class POLICY(Enum):
+        # run the missed frames back to back until we're back on schedule
+        CATCH_UP = 0
+        # drop the missed frames and carry on from the latest one
+        SKIP = 1
+
+    def __init__(
+            self, interval: float, align: bool = False, policy: "FrameScheduler.POLICY" = POLICY.SKIP,
+            spin: float = 0.001, max_catch_up: int = 5
+    ):
+        self.interval = interval
+        self.align = align
+        self.policy = policy
+        self.spin = spin
+        self.max_catch_up = max_catch_up
+
+        # aligning to the wall clock needs the wall clock, otherwise stick to something that can't jump around
+        self.clock = time.time if align else time.monotonic
+
+        self.next_tick = None
+        self.last_tick = None
+        self.frame_start = None
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.frames = 0
+        # frames that started more than a spin's worth after their tick
+        self.late = 0
+        # frames that were skipped entirely
+        self.missed = 0
+
+        # how long was spent between wait() calls, i.e. actually doing the frame's work
+        self.last_work = 0.0
+        self.total_work = 0.0
+        self.max_work = 0.0
+
+    def __str__(self):
+        return "{} frames, {} late, {} missed, {:.1%} of frame budget used (max {:.1%})".format(
+            self.frames, self.late, self.missed, self.budget_used, self.max_work / self.interval
+        )
+
+    @property
+    def budget_used(self) -> float:
+        # the average fraction of each frame spent working rather than waiting
+        if self.frames < 2:
+            return 0.0
+
+        return self.total_work / (self.frames - 1) / self.interval
+
+    def _plan(self) -> Tuple[float, int]:
+        # work out when the next frame is due and how many frames get skipped to get there
+        now = self.clock()
+
+        if self.frame_start is not None:
+            self.last_work = now - self.frame_start
+            self.total_work += self.last_work
+            self.max_work = max(self.max_work, self.last_work)
+
+        if self.next_tick is None:
+            if self.align:
+                self.next_tick = (math.floor(now / self.interval) + 1) * self.interval
+            else:
+                self.next_tick = now
+
+        deadline = self.next_tick
+        skipped = 0
+
+        behind = int((now - deadline) // self.interval)
+        if behind > 0 and (self.policy == FrameScheduler.POLICY.SKIP or behind > self.max_catch_up):
+            skipped = behind
+            deadline += behind * self.interval
+            self.missed += skipped
+
+        return deadline, skipped
+
+    def _arrive(self, deadline: float):
+        while self.clock() < deadline:
+            pass
+
+        self.frame_start = self.clock()
+        if self.frame_start - deadline > self.spin:
+            self.late += 1
+
+        self.frames += 1
+        self.last_tick = deadline
+        self.next_tick = deadline + self.interval
+
+    def wait(self) -> int:
+        """
+        Wait until the next frame is due. Returns how many frames were skipped to get there.
+        """
+        deadline, skipped = self._plan()
+
+        remaining = deadline - self.clock()
+        if remaining > self.spin:
+            time.sleep(remaining - self.spin)
+
+        self._arrive(deadline)
+        return skipped
+
+    async def tick(self) -> int:
+        """
+        The same as wait(), but lets other asyncio tasks run while waiting.
+        """
+        deadline, skipped = self._plan()
+
+        remaining = deadline - self.clock()
+        if remaining > self.spin:
+            await asyncio.sleep(remaining - self.spin)
+
+        self._arrive(deadline)
+        return skipped
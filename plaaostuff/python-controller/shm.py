@@ -0,0 +1,179 @@
+"""
+Shared memory transport: whole frames go through a memory mapped file instead of being encoded down the pipe, and
+the pipe only carries a tiny SHM_FRAME message saying which one to show.
+
+The file (shared with ipc.cc) is laid out as:
+    header (SHM_HEADER, padded to SHM_DATA_OFFSET bytes):
+        magic ("RMFB") | version (u8) | front buffer (u8) | width (u16) | height (u16) | padding (2 bytes)
+        | sequence number of buffer 0 (u32) | sequence number of buffer 1 (u32)
+    buffer 0: height * width * 3 bytes of rgb, row by row
+    buffer 1: the same again
+all little endian.
+
+Frames are double buffered; each new frame goes into whichever buffer isn't the front one. A buffer's sequence number
+is zeroed while it's being written and set once it's done, so a reader can tell if a buffer changed while it was
+copying it (i.e. it fell two frames behind) and skip it; there'll be another SHM_FRAME along right after.
+"""
+
+import mmap
+import os
+import struct
+from typing import Union
+
+import numpy as np
+
+import rpi_ipc
+import timing
+from calibration import Calibration
+from dat import Vector2
+
+
+SHM_PATH = "/dev/shm/scrimblo_fb"
+
+SHM_MAGIC = b"RMFB"
+SHM_VERSION = 1
+SHM_HEADER = struct.Struct("<4sBBHH2xII")
+SHM_DATA_OFFSET = 32
+
+# where the front buffer index and each buffer's sequence number live
+SHM_FRONT_OFFSET = 5
+SHM_SEQ_OFFSETS = (SHM_HEADER.size - 8, SHM_HEADER.size - 4)
+SEQ = struct.Struct("<I")
+
+
+def shm_size(dimensions: Vector2) -> int:
+    return SHM_DATA_OFFSET + 2 * dimensions.x * dimensions.y * 3
+
+
+class ShmFrameWriter:
+    """
+    Sends whole frames through shared memory, telling the matrix about each one down the pipe.
+
+    :param dimensions: The size of the frames
+    :param pipe: Where to send the SHM_FRAME messages
+    :param path: The shared memory file; created if it doesn't exist
+    :param calibration: The panel calibration to apply to every frame, if any
+    """
+
+    def __init__(
+            self, dimensions: Vector2, pipe: Union[rpi_ipc.PipeWriter, None], path: str = SHM_PATH,
+            calibration: Union[Calibration, None] = None
+    ):
+        self.dimensions = dimensions
+        self.pipe = pipe
+        self.calibration = calibration
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            os.ftruncate(fd, shm_size(dimensions))
+            self.map = mmap.mmap(fd, shm_size(dimensions))
+        finally:
+            os.close(fd)
+
+        frame_size = dimensions.x * dimensions.y * 3
+        self.buffers = [
+            np.frombuffer(self.map, dtype=np.uint8, count=frame_size, offset=SHM_DATA_OFFSET + i * frame_size)
+            .reshape((dimensions.y, dimensions.x, 3))
+            for i in range(2)
+        ]
+
+        self.front = 0
+        self.seq = 0
+        self.frames = 0
+        SHM_HEADER.pack_into(self.map, 0, SHM_MAGIC, SHM_VERSION, self.front, dimensions.x, dimensions.y, 0, 0)
+
+    def __str__(self):
+        return "{} frames through shared memory".format(self.frames)
+
+    def send(self, frame: np.ndarray) -> bool:
+        """
+        Write an (h, w, 3) frame into the back buffer, flip it to the front and tell the matrix. Returns whether the
+        message telling it got queued.
+        """
+        back = 1 - self.front
+        self.seq = self.seq % 0xffffffff + 1
+
+        with timing.span("write"):
+            SEQ.pack_into(self.map, SHM_SEQ_OFFSETS[back], 0)
+            if self.calibration is not None and not self.calibration.identity:
+                frame = self.calibration.apply(frame)
+            self.buffers[back][:] = frame
+            SEQ.pack_into(self.map, SHM_SEQ_OFFSETS[back], self.seq)
+
+        self.front = back
+        self.map[SHM_FRONT_OFFSET] = back
+        self.frames += 1
+
+        if self.pipe:
+            # every SHM_FRAME shows a whole frame, so there's nothing to catch up on if the panel lost track; anything
+            # still queued is just out of date
+            if self.pipe.desynced:
+                self.pipe.drop()
+                self.pipe.desynced = False
+
+            return self.pipe.send(rpi_ipc.encode_shm_frame(back, self.seq))
+
+        return True
+
+    def close(self):
+        self.buffers = []
+        self.map.close()
+
+
+class ShmFrameReader:
+    """
+    Reference reader for the shared memory transport; mirrors what ipc.cc does with an SHM_FRAME message.
+
+    :param path: The shared memory file
+    """
+
+    def __init__(self, path: str = SHM_PATH):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.dimensions = self._check_header()
+        width, height = self.dimensions.x, self.dimensions.y
+        if len(self.map) < shm_size(self.dimensions):
+            raise rpi_ipc.ProtocolError("Shared frame file is too small for {}x{} frames".format(width, height))
+
+        self.frame_size = width * height * 3
+
+    def _check_header(self) -> Vector2:
+        magic, version, _, width, height, _, _ = SHM_HEADER.unpack_from(self.map, 0)
+        if magic != SHM_MAGIC or version != SHM_VERSION:
+            raise rpi_ipc.ProtocolError("Not a version {} shared frame file".format(SHM_VERSION))
+
+        return Vector2(width, height)
+
+    @property
+    def front(self) -> int:
+        return self.map[SHM_FRONT_OFFSET]
+
+    def read(self, index: int, seq: int) -> Union[np.ndarray, None]:
+        """
+        Copy out the frame in a buffer, as long as it's still the one with sequence number seq. Returns None if it
+        isn't (it's been overwritten since, or is being right now). Raises ProtocolError if the writer's started over
+        with a different header since this was opened, in which case it needs opening again.
+        """
+        if self._check_header() != self.dimensions:
+            raise rpi_ipc.ProtocolError("Shared frames have changed size since they were opened")
+
+        offset = SHM_SEQ_OFFSETS[index]
+        if seq == 0 or SEQ.unpack_from(self.map, offset)[0] != seq:
+            return None
+
+        start = SHM_DATA_OFFSET + index * self.frame_size
+        frame = np.frombuffer(self.map[start:start + self.frame_size], dtype=np.uint8)
+
+        if SEQ.unpack_from(self.map, offset)[0] != seq:
+            return None
+
+        return frame.reshape((self.dimensions.y, self.dimensions.x, 3))
+
+    def latest(self) -> Union[np.ndarray, None]:
+        # the newest complete frame, whatever the pipe says
+        index = self.front
+        return self.read(index, SEQ.unpack_from(self.map, SHM_SEQ_OFFSETS[index])[0])
+
+    def close(self):
+        self.map.close()
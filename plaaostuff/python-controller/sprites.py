@@ -0,0 +1,94 @@
+"""Lots of copies of one sprite bouncing around, moved and drawn as arrays rather than one at a time."""
+
+from typing import Tuple, Union
+
+import numpy as np
+
+from canvas import Colour, Surface
+from dat import Vector2
+
+
+class Sprites:
+    """
+    Up to capacity copies of a sprite, each with its own position, velocity and colour, bouncing around inside some
+    bounds. Everything is held as arrays with a row per sprite, so moving and drawing them is a handful of numpy
+    operations however many there are.
+
+    A sprite that hits the edge of the bounds bounces off it and changes to a random colour.
+
+    :param mask: The (height, width) mask of the sprite; pixels that are true get drawn
+    :param low: The lowest position a sprite's top left corner can be at
+    :param high: The highest position a sprite's top left corner can be at
+    :param capacity: The most sprites there can be
+    :param colour_range: The lowest and highest (r, g, b) for random colours
+    :param seed: Seed for the random colours, if they should be the same every time
+    """
+
+    def __init__(
+            self, mask: np.ndarray, low: Vector2, high: Vector2, capacity: int = 512,
+            colour_range: Tuple[Tuple[int, int, int], Tuple[int, int, int]] = ((0, 64, 0), (192, 255, 192)),
+            seed: Union[int, None] = None
+    ):
+        self.mask = mask
+        self.low = np.array((low.x, low.y), dtype=np.float64)
+        self.high = np.array((high.x, high.y), dtype=np.float64)
+        self.capacity = capacity
+        self.colour_low = np.array(colour_range[0])
+        self.colour_high = np.array(colour_range[1])
+        self.rng = np.random.default_rng(seed)
+
+        # a row per sprite, only the first count of which are in use
+        self.positions = np.zeros((capacity, 2), dtype=np.float64)
+        self.velocities = np.zeros((capacity, 2), dtype=np.float64)
+        self.colours = np.zeros((capacity, 3), dtype=np.uint8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def random_colours(self, n: int) -> np.ndarray:
+        return self.rng.integers(self.colour_low, self.colour_high, size=(n, 3), endpoint=True).astype(np.uint8)
+
+    def add(self, pos: Vector2, velocity: Vector2, col: Union[Colour, None] = None) -> bool:
+        """
+        Add a sprite, in a random colour if it isn't given one. Returns False if there's no room for it.
+        """
+        if self.full:
+            return False
+
+        i = self.count
+        self.positions[i] = pos.x, pos.y
+        self.velocities[i] = velocity.x, velocity.y
+        self.colours[i] = Surface._rgb(col) if col is not None else self.random_colours(1)[0]
+        self.count += 1
+        return True
+
+    def step(self) -> np.ndarray:
+        """
+        Move every sprite along by its velocity, bouncing off the edges. Returns the indices of the ones that bounced.
+        """
+        positions = self.positions[:self.count]
+        velocities = self.velocities[:self.count]
+
+        positions += velocities
+
+        # the same as hi_bounce always did: outside is below low or at/past high, and a bounce flips that axis and
+        # puts the sprite back on the edge
+        outside = (positions < self.low) | (positions >= self.high)
+        velocities[outside] *= -1
+        np.clip(positions, self.low, self.high, out=positions)
+
+        bounced = np.flatnonzero(outside.any(axis=1))
+        if len(bounced):
+            self.colours[bounced] = self.random_colours(len(bounced))
+
+        return bounced
+
+    def draw(self, surface: Surface):
+        surface.set_masks(
+            np.floor(self.positions[:self.count]).astype(np.intp), self.mask, self.colours[:self.count]
+        )
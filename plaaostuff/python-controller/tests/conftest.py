@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the controller modules are all imported flat, from the directory above this one
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
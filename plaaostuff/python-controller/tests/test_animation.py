@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from animation import AnimationCache, MessageStore
+from calibration import Calibration
+from canvas import Canvas, Colour
+from dat import Vector2
+from emulator import Emulator
+
+
+DIMENSIONS = Vector2(64, 64)
+LENGTH = 24
+
+
+def make_canvas() -> Canvas:
+    return Canvas(DIMENSIONS, calibration=Calibration.default(DIMENSIONS))
+
+
+def drawer(canvas: Canvas):
+    # a block bouncing across a bar that never changes, so there's something static for the deltas to leave alone
+    def draw(n: int):
+        canvas.set_mask(Vector2(0, 40), np.ones((4, 64), dtype=bool), Colour(0, 0, 128))
+        x = n * 5 if n < LENGTH // 2 else (LENGTH - n) * 5
+        canvas.set_mask(Vector2(x, 10 + n % 3), np.ones((6, 6), dtype=bool), Colour(255, 8 * n, 0))
+
+    return draw
+
+
+def render_fresh(frames: int):
+    # every frame drawn and diffed from scratch, the way it'd be done without a cache
+    canvas = make_canvas()
+    draw = drawer(canvas)
+    for i in range(frames):
+        draw(i % LENGTH)
+        yield canvas.update_changes(clear_last=True)
+
+
+@pytest.mark.parametrize("memory_limit", [8 * 1024 * 1024, 256])
+def test_cached_messages_match_fresh_ones(memory_limit):
+    canvas = make_canvas()
+    cache = AnimationCache(canvas, drawer(canvas), LENGTH, keyframe_every=5, memory_limit=memory_limit)
+
+    cached = [cache.next_message() for _ in range(LENGTH * 3 + 5)]
+    assert cache.cached
+    assert (cache.store.spilled_from is not None) == (memory_limit == 256)
+
+    assert cached == list(render_fresh(LENGTH * 3 + 5))
+    cache.close()
+
+
+def test_seek_redraws_the_frame_from_a_keyframe():
+    canvas = make_canvas()
+    cache = AnimationCache(canvas, drawer(canvas), LENGTH, keyframe_every=5, memory_limit=256)
+    for _ in range(LENGTH):
+        cache.next_message()
+
+    # what the panel should look like on each frame
+    expected = []
+    panel = Emulator(DIMENSIONS)
+    for message in render_fresh(LENGTH):
+        panel.feed(message)
+        expected.append(panel.framebuffer.copy())
+
+    for n in (0, 4, 5, 13, LENGTH - 1):
+        panel = Emulator(DIMENSIONS)
+        panel.framebuffer[:] = 77
+        panel.feed(cache.seek(n))
+        assert np.array_equal(panel.framebuffer, expected[n])
+
+        # and carrying on from there
+        panel.feed(cache.next_message())
+        assert np.array_equal(panel.framebuffer, expected[(n + 1) % LENGTH])
+
+    panel = Emulator(DIMENSIONS)
+    panel.feed(cache.full_frame())
+    assert np.array_equal(panel.framebuffer, expected[(n + 1) % LENGTH])
+
+    cache.close()
+
+
+def test_message_store_spills_to_disk(tmp_path):
+    path = str(tmp_path / "spill.rec")
+    store = MessageStore(memory_limit=10, spill_path=path)
+    messages = [bytes([n]) * (n + 1) for n in range(8)]
+
+    assert [store.append(message) for message in messages] == list(range(8))
+    assert store.spilled_from == 4
+    with pytest.raises(ValueError):
+        store[5]
+
+    store.finish()
+    assert [store[n] for n in range(8)] == messages
+    with pytest.raises(ValueError):
+        store.append(b"late")
+
+    store.close()
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from calibration import DEAD_CHANNELS, DEAD_PIXELS, Calibration
+from canvas import Canvas
+from dat import Rect, Vector2
+
+
+DIMENSIONS = Vector2(64, 64)
+
+
+def random_frame(seed: int, h: int = 64, w: int = 64) -> np.ndarray:
+    return np.random.default_rng(seed).integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    gain = np.random.default_rng(1).random((64, 64, 3), dtype=np.float32)
+    path = str(tmp_path / "panel.npy")
+
+    Calibration(gain).save(path)
+    loaded = Calibration.load(path)
+
+    assert np.array_equal(loaded.gain, gain)
+    assert np.array_equal(loaded.apply(random_frame(2)), Calibration(gain).apply(random_frame(2)))
+
+
+def test_default_round_trips_too(tmp_path):
+    path = str(tmp_path / "panel.npy")
+    Calibration.default(DIMENSIONS).save(path)
+
+    loaded = Calibration.load(path)
+    assert np.array_equal(loaded.gain, Calibration.default(DIMENSIONS).gain)
+    assert not loaded.identity
+
+
+def test_uniform_is_identity():
+    calibration = Calibration.uniform(DIMENSIONS)
+    frame = random_frame(3)
+
+    assert calibration.identity
+    out = calibration.apply(frame)
+    assert np.array_equal(out, frame)
+    assert out is not frame
+
+    # a gain of exactly 1 loaded from anywhere counts as well, and so does part of a frame
+    calibration = Calibration(np.ones((64, 64, 3)))
+    assert calibration.identity
+    assert np.array_equal(calibration.apply(frame[10:20, 5:30], Rect(5, 10, 25, 10)), frame[10:20, 5:30])
+
+
+def test_apply_uses_the_gain_under_the_region():
+    calibration = Calibration.default(DIMENSIONS)
+    frame = np.full((64, 64, 3), 200, dtype=np.uint8)
+
+    out = calibration.apply(frame)
+    for pixel in DEAD_PIXELS:
+        assert not out[pixel.y, pixel.x].any()
+    for pixel, channels in DEAD_CHANNELS.items():
+        assert not out[pixel.y, pixel.x, list(channels)].any()
+
+    # the bottom right corner on its own gets the gain of the bottom right corner
+    region = Rect(60, 60, 4, 4)
+    assert np.array_equal(calibration.apply(frame[60:, 60:], region), out[60:, 60:])
+
+
+def test_bad_gain_shapes_are_refused():
+    with pytest.raises(ValueError):
+        Calibration(np.ones((64, 64)))
+
+    with pytest.raises(ValueError):
+        Calibration(np.ones((64, 64, 4)))
+
+
+def test_canvas_refuses_a_calibration_for_another_panel():
+    with pytest.raises(ValueError):
+        Canvas(DIMENSIONS, calibration=Calibration.uniform(Vector2(32, 64)))
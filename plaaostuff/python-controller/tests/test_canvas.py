@@ -0,0 +1,90 @@
+import random
+
+import numpy as np
+import pytest
+
+import rpi_ipc
+from calibration import Calibration
+from canvas import Canvas, Colour
+from dat import Rect, Vector2
+from emulator import Emulator
+
+
+DIMENSIONS = Vector2(64, 64)
+
+
+def per_pixel_changes(self, mask: np.ndarray, frame: np.ndarray, origin_x: int = 0, origin_y: int = 0):
+    # how FrameEncoder.changes() used to work, before runs were coalesced: every pixel as its own PIXELS record
+    h, w = mask.shape
+    if self.calibration is not None:
+        frame = self.calibration.apply(frame, Rect(origin_x, origin_y, w, h))
+
+    ys, xs = np.nonzero(mask)
+    self.pixels(xs + origin_x, ys + origin_y, frame[ys, xs])
+
+
+def draw_random(canvas: Canvas, rng: random.Random, n: int):
+    if n % 10 == 9:
+        canvas.set_fill(Canvas.FILLTYPE.FILL, Colour(rng.randrange(256), 0, 64))
+    elif n % 10 == 4:
+        canvas.set_fill(Canvas.FILLTYPE.CLEAR)
+    else:
+        canvas.set_fill(Canvas.FILLTYPE.NONE)
+
+    colours = [Colour(255, 255, 255), Colour(0, 0, 0), Colour(rng.randrange(256), rng.randrange(256), 0)]
+
+    # horizontal and vertical lines, blocks, and scattered pixels, some of them the colour that's already there
+    for _ in range(rng.randrange(4)):
+        canvas.set_mask(Vector2(rng.randrange(64), rng.randrange(64)), np.ones((1, rng.randrange(1, 30)), dtype=bool),
+                        rng.choice(colours))
+        canvas.set_mask(Vector2(rng.randrange(64), rng.randrange(64)), np.ones((rng.randrange(1, 30), 1), dtype=bool),
+                        rng.choice(colours))
+
+    for _ in range(rng.randrange(4)):
+        h, w = rng.randrange(1, 24), rng.randrange(1, 24)
+        block = np.array([[rng.random() < 0.8 for _ in range(w)] for _ in range(h)])
+        canvas.set_mask(Vector2(rng.randrange(-8, 64), rng.randrange(-8, 64)), block, rng.choice(colours))
+
+    for _ in range(rng.randrange(30)):
+        canvas.set_pixel(Vector2(rng.randrange(64), rng.randrange(64)), rng.choice(colours))
+
+
+@pytest.mark.parametrize("clear_last", [False, True])
+@pytest.mark.parametrize("seed", range(25))
+def test_coalesced_encoding_matches_per_pixel(monkeypatch, seed, clear_last):
+    # the same drawing on two canvases, one encoded the old way. both have to leave the panel looking the same
+    calibration = Calibration.default(DIMENSIONS)
+    coalesced, per_pixel = Canvas(DIMENSIONS, calibration=calibration), Canvas(DIMENSIONS, calibration=calibration)
+    coalesced_panel, per_pixel_panel = Emulator(DIMENSIONS), Emulator(DIMENSIONS)
+
+    for n in range(20):
+        draw_random(coalesced, random.Random(seed * 100 + n), n)
+        draw_random(per_pixel, random.Random(seed * 100 + n), n)
+
+        coalesced_panel.feed(coalesced.update_changes(clear_last=clear_last))
+        with monkeypatch.context() as patch:
+            patch.setattr(rpi_ipc.FrameEncoder, "changes", per_pixel_changes)
+            per_pixel_panel.feed(per_pixel.update_changes(clear_last=clear_last))
+
+        assert np.array_equal(coalesced.current_canvas, per_pixel.current_canvas)
+        assert np.array_equal(coalesced_panel.framebuffer, per_pixel_panel.framebuffer)
+        assert np.array_equal(coalesced_panel.framebuffer, calibration.apply(coalesced.current_canvas))
+
+    assert coalesced_panel.errors == per_pixel_panel.errors == 0
+
+
+def test_colours_from_numpy_ints_are_the_same_colour():
+    assert Colour(np.int64(3), np.uint8(0), np.int32(0)) == Colour(3, 0, 0)
+    assert hash(Colour(np.int64(3), 0, 0)) == hash(Colour(3, 0, 0))
+    assert type(Colour(np.int64(300), 0, 0).r) is int
+    assert Colour(np.int64(300), np.int64(-5), 0) == Colour(255, 0, 0)
+    assert Colour(np.int64(3), 0, 0, ignore_validation=True) == Colour(3, 0, 0)
+
+    # and so's one read back off the canvas
+    canvas = Canvas(DIMENSIONS, calibration=Calibration.uniform(DIMENSIONS))
+    canvas.set_pixel(Vector2(1, 2), Colour(10, 20, 30))
+    canvas.update_changes()
+    assert canvas.get_pixel(Vector2(1, 2)) == Colour(10, 20, 30)
+
+    # floats are kept as they are, like they always were
+    assert Colour(1.5, 0, 0) != Colour(1, 0, 0)
@@ -0,0 +1,82 @@
+import random
+
+import numpy as np
+import pytest
+
+import rpi_ipc
+from emulator import Emulator, StreamDecoder
+
+
+def random_stream(rng: random.Random) -> bytes:
+    # a few messages' worth of everything the protocol has, in frames of all sizes
+    encoder = rpi_ipc.FrameEncoder(max_frame_size=rng.choice((16, 200, rpi_ipc.MAX_FRAME_SIZE)))
+    encoder.clear()
+    for _ in range(20):
+        h, w = rng.randrange(1, 64), rng.randrange(1, 64)
+        mask = np.array([[rng.random() < 0.6 for _ in range(w)] for _ in range(h)])
+        frame = np.array([[rng.choice(((255, 0, 0), (0, 0, 255), (9, 9, 9))) for _ in range(w)] for _ in range(h)],
+                         dtype=np.uint8)
+        encoder.changes(mask, frame, rng.randrange(64 - w + 1), rng.randrange(64 - h + 1))
+        if rng.random() < 0.2:
+            encoder.fill(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+
+    return encoder.getvalue()
+
+
+def split_randomly(data: bytes, rng: random.Random):
+    pos = 0
+    while pos < len(data):
+        size = rng.choice((1, 2, 5, rng.randrange(1, 64), rng.randrange(1, 8192)))
+        yield data[pos:pos + size]
+        pos += size
+
+
+def reframe(body: bytes) -> bytes:
+    return rpi_ipc.FRAME_HEADER.pack(rpi_ipc.MAGIC, rpi_ipc.PROTOCOL_VERSION, len(body)) + body
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_stream_decoder_matches_the_reference_decoder(seed):
+    rng = random.Random(seed)
+    stream = random_stream(rng)
+
+    decoder = StreamDecoder()
+    bodies = [body for chunk in split_randomly(stream, rng) for body in decoder.feed(chunk)]
+
+    assert decoder.skipped == 0
+    assert not decoder.buffer
+    assert rpi_ipc.decode(b"".join(reframe(body) for body in bodies)) == rpi_ipc.decode(stream)
+
+
+def test_stream_decoder_skips_garbage_between_frames():
+    rng = random.Random(100)
+    stream = random_stream(rng)
+    frames = [stream[start:end] for start, end in rpi_ipc.iter_frames(stream)]
+
+    # junk (including a stray magic and a header claiming more than a frame can hold) before every frame
+    oversized = rpi_ipc.FRAME_HEADER.pack(rpi_ipc.MAGIC, rpi_ipc.PROTOCOL_VERSION, rpi_ipc.MAX_FRAME_SIZE)
+    junk = [b"\x00\xffR", b"RM\x09", oversized, b"M"]
+    noisy = b"".join(junk[n % len(junk)] + frame for n, frame in enumerate(frames))
+
+    decoder = StreamDecoder()
+    bodies = [body for chunk in split_randomly(noisy, rng) for body in decoder.feed(chunk)]
+
+    assert decoder.skipped == len(noisy) - len(stream)
+    assert rpi_ipc.decode(b"".join(reframe(body) for body in bodies)) == rpi_ipc.decode(stream)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_emulator_doesnt_care_how_the_stream_is_split(seed):
+    rng = random.Random(seed)
+    stream = random_stream(rng)
+
+    whole = Emulator()
+    whole.feed(stream)
+
+    split = Emulator()
+    for chunk in split_randomly(stream, rng):
+        split.feed(chunk)
+
+    assert split.frames == whole.frames
+    assert split.errors == whole.errors == 0
+    assert np.array_equal(split.framebuffer, whole.framebuffer)
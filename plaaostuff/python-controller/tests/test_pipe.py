@@ -0,0 +1,115 @@
+import os
+import random
+import threading
+
+import numpy as np
+
+import rpi_ipc
+from calibration import Calibration
+from canvas import Canvas, Colour
+from dat import Vector2
+from emulator import Emulator
+
+
+DIMENSIONS = Vector2(64, 64)
+
+
+def make_canvas() -> Canvas:
+    return Canvas(DIMENSIONS, calibration=Calibration.uniform(DIMENSIONS))
+
+
+def draw_frames(canvas: Canvas, pipe: rpi_ipc.PipeWriter, frames: int, rng: random.Random):
+    for _ in range(frames):
+        for _ in range(30):
+            canvas.set_pixel(
+                Vector2(rng.randrange(64), rng.randrange(64)),
+                Colour(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            )
+
+        rpi_ipc.send_prot_msg(pipe, canvas.update_changes(), canvas.full_frame)
+
+
+def start_emulator(path: str):
+    emulator = Emulator(DIMENSIONS)
+    thread = threading.Thread(target=emulator.run, args=(path,), kwargs={"stats_every": 0}, daemon=True)
+    thread.start()
+    return emulator, thread
+
+
+def finish(pipe: rpi_ipc.PipeWriter, thread: threading.Thread):
+    pipe.send(rpi_ipc.encode_exit())
+    pipe.close(timeout=5)
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_refused_frames_resync_once_a_reader_attaches(tmp_path):
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+
+    canvas = make_canvas()
+    pipe = rpi_ipc.PipeWriter(path)
+    pipe.send(rpi_ipc.encode_clear())
+
+    # nothing's reading, so the queue fills up and frames start getting refused
+    draw_frames(canvas, pipe, 1500, random.Random(1))
+    assert pipe.refused > 0
+    assert not pipe.desynced
+
+    emulator, thread = start_emulator(path)
+    draw_frames(canvas, pipe, 10, random.Random(2))
+    finish(pipe, thread)
+
+    assert np.array_equal(emulator.framebuffer, canvas.current_canvas)
+
+
+def test_new_reader_gets_a_resync_not_stale_deltas(tmp_path):
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+
+    canvas = make_canvas()
+    pipe = rpi_ipc.PipeWriter(path)
+    rng = random.Random(3)
+
+    # a reader that goes away part way through
+    reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    draw_frames(canvas, pipe, 20, rng)
+    os.close(reader)
+    draw_frames(canvas, pipe, 20, rng)
+    assert pipe.reconnecting
+
+    # and a new one, which starts from a blank panel and never saw any of that
+    emulator, thread = start_emulator(path)
+    draw_frames(canvas, pipe, 20, rng)
+    finish(pipe, thread)
+
+    assert np.array_equal(emulator.framebuffer, canvas.current_canvas)
+
+
+def test_coalescing_sender_resyncs_a_new_reader(tmp_path):
+    path = str(tmp_path / "pipe")
+    os.mkfifo(path)
+
+    canvas = make_canvas()
+    pipe = rpi_ipc.PipeWriter(path)
+    sender = rpi_ipc.CoalescingSender(pipe)
+    rng = random.Random(4)
+
+    def send_frames(frames: int):
+        for _ in range(frames):
+            canvas.set_pixel(Vector2(rng.randrange(64), rng.randrange(64)), Colour(rng.randrange(256), 255, 0))
+            canvas.update_changes(encode=False)
+            sender.send(canvas.current_canvas)
+
+    reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    send_frames(20)
+    os.close(reader)
+    send_frames(20)
+
+    emulator, thread = start_emulator(path)
+    send_frames(20)
+    while not sender.flush():
+        pass
+    finish(pipe, thread)
+
+    assert np.array_equal(emulator.framebuffer, canvas.current_canvas)
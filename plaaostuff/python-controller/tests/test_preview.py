@@ -0,0 +1,31 @@
+import random
+
+import numpy as np
+import pytest
+
+from canvas import Canvas, Colour
+from calibration import Calibration
+from dat import Vector2
+from preview import TerminalPreview
+
+
+@pytest.mark.parametrize("dimensions", [Vector2(64, 64), Vector2(20, 13)])
+def test_updated_regions_give_the_same_output(dimensions):
+    # a preview only looking at the canvas's updated regions has to print exactly what one looking everywhere does
+    rng = random.Random(dimensions.y)
+    canvas = Canvas(dimensions, calibration=Calibration.uniform(dimensions))
+    everywhere, regions_only = TerminalPreview(dimensions), TerminalPreview(dimensions)
+
+    for n in range(100):
+        canvas.set_fill(Canvas.FILLTYPE.FILL if n % 25 == 24 else Canvas.FILLTYPE.NONE, Colour(0, 0, 60))
+        for _ in range(rng.randrange(4)):
+            w, h = rng.randrange(1, 8), rng.randrange(1, 8)
+            canvas.set_mask(
+                Vector2(rng.randrange(-4, dimensions.x), rng.randrange(-4, dimensions.y)),
+                np.ones((h, w), dtype=bool), Colour(rng.randrange(256), 255, rng.choice((0, 255)))
+            )
+
+        canvas.update_changes(clear_last=rng.random() < 0.7, encode=False)
+        expected = everywhere.render(canvas.current_canvas)
+        assert regions_only.render(canvas.current_canvas, canvas.updated_regions) == expected
+        assert np.array_equal(regions_only.current[:dimensions.y], canvas.current_canvas)
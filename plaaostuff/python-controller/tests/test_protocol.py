@@ -0,0 +1,139 @@
+import random
+
+import numpy as np
+import pytest
+
+import rpi_ipc
+from calibration import Calibration
+from canvas import Canvas, Colour
+from dat import Vector2
+
+
+DIMENSIONS = Vector2(64, 64)
+PALETTE = [Colour(0, 0, 0), Colour(255, 0, 0), Colour(12, 130, 12), Colour(255, 255, 255)]
+
+
+def paint(commands, framebuffer: np.ndarray):
+    # apply decoded commands to a framebuffer, the dumbest way possible
+    for command in commands:
+        name, args = command[0], command[1:]
+        if name == "CLEAR":
+            framebuffer[:] = 0
+        elif name == "FILL":
+            framebuffer[:] = args
+        elif name == "PIXEL":
+            x, y, r, g, b = args
+            framebuffer[y, x] = (r, g, b)
+        elif name == "HLINE":
+            x, y, length, r, g, b = args
+            framebuffer[y, x:x + length] = (r, g, b)
+        elif name == "VLINE":
+            x, y, length, r, g, b = args
+            framebuffer[y:y + length, x] = (r, g, b)
+        elif name == "RECT":
+            x, y, w, h, r, g, b = args
+            framebuffer[y:y + h, x:x + w] = (r, g, b)
+
+
+def draw_random(canvas: Canvas, rng: random.Random):
+    # blocks and lines in a few colours, so there are runs to find, with some odd pixels on top
+    for _ in range(rng.randrange(1, 6)):
+        w, h = rng.randrange(1, 20), rng.randrange(1, 20)
+        canvas.set_mask(
+            Vector2(rng.randrange(-5, 64), rng.randrange(-5, 64)), np.ones((h, w), dtype=bool), rng.choice(PALETTE)
+        )
+
+    for _ in range(rng.randrange(0, 40)):
+        canvas.set_pixel(
+            Vector2(rng.randrange(64), rng.randrange(64)),
+            Colour(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        )
+
+
+def frame_sizes(data: bytes):
+    return [end - start for start, end in rpi_ipc.iter_frames(data)]
+
+
+@pytest.mark.parametrize("clear_last", [False, True])
+def test_decoded_messages_reproduce_the_canvas(clear_last):
+    rng = random.Random(1)
+    canvas = Canvas(DIMENSIONS, calibration=Calibration.uniform(DIMENSIONS))
+    panel = np.zeros_like(canvas.current_canvas)
+
+    for n in range(200):
+        if n % 50 == 49:
+            canvas.set_fill(Canvas.FILLTYPE.FILL, rng.choice(PALETTE))
+        elif n % 50 == 24:
+            canvas.set_fill(Canvas.FILLTYPE.CLEAR)
+        else:
+            canvas.set_fill(Canvas.FILLTYPE.NONE)
+
+        draw_random(canvas, rng)
+        paint(rpi_ipc.decode(canvas.update_changes(clear_last=clear_last)), panel)
+        assert np.array_equal(panel, canvas.current_canvas)
+
+
+def test_frames_never_go_over_the_limit():
+    rng = random.Random(2)
+    canvas = Canvas(DIMENSIONS, calibration=Calibration.uniform(DIMENSIONS))
+
+    # every pixel a different colour, so nothing coalesces and it all goes as PIXELS records
+    frame = np.array([[rng.randrange(1 << 24) for _ in range(64)] for _ in range(64)], dtype=np.int32)
+    colours = np.stack((frame >> 16, (frame >> 8) & 0xff, frame & 0xff), axis=2).astype(np.uint8)
+    canvas.set_pixels(Vector2(0, 0), colours)
+    message = canvas.update_changes()
+
+    sizes = frame_sizes(message)
+    assert len(sizes) > 1
+    assert max(sizes) <= rpi_ipc.MAX_FRAME_SIZE
+
+    # and the same for lines and rects, which have to be split on command boundaries
+    encoder = rpi_ipc.FrameEncoder()
+    stripes = np.zeros((64, 64, 3), dtype=np.uint8)
+    stripes[:, ::2] = 255
+    encoder.changes(np.ones((64, 64), dtype=bool), stripes)
+    for _ in range(1000):
+        encoder.changes(np.ones((2, 2), dtype=bool), np.full((2, 2, 3), 7, dtype=np.uint8), 3, 3)
+
+    assert max(frame_sizes(encoder.getvalue())) <= rpi_ipc.MAX_FRAME_SIZE
+
+
+@pytest.mark.parametrize("max_frame_size", [16, 61, 500, rpi_ipc.MAX_FRAME_SIZE])
+def test_splitting_across_frames_decodes_the_same(max_frame_size):
+    rng = random.Random(max_frame_size)
+    frame = np.array(
+        [[[rng.choice((0, 255)), rng.choice((0, 255)), 0] for _ in range(64)] for _ in range(64)], dtype=np.uint8
+    )
+    mask = np.array([[rng.random() < 0.7 for _ in range(64)] for _ in range(64)])
+
+    def encode(size: int) -> bytes:
+        encoder = rpi_ipc.FrameEncoder(max_frame_size=size)
+        encoder.clear()
+        encoder.changes(mask, frame)
+        encoder.fill(1, 2, 3)
+        encoder.exit()
+        return encoder.getvalue()
+
+    # one frame big enough for the whole lot
+    whole = encode(rpi_ipc.FRAME_HEADER.size + 0xffff)
+    assert len(frame_sizes(whole)) == 1
+
+    split = encode(max_frame_size)
+    assert max(frame_sizes(split)) <= max_frame_size
+    assert rpi_ipc.decode(split) == rpi_ipc.decode(whole)
+
+
+def test_decode_rejects_bad_frames():
+    message = rpi_ipc.encode_clear()
+
+    with pytest.raises(rpi_ipc.ProtocolError):
+        rpi_ipc.decode(b"XX" + message[2:])
+
+    with pytest.raises(rpi_ipc.ProtocolError):
+        rpi_ipc.decode(message[:2] + bytes((rpi_ipc.PROTOCOL_VERSION + 1,)) + message[3:])
+
+    with pytest.raises(rpi_ipc.ProtocolError):
+        rpi_ipc.decode(message[:-1])
+
+    with pytest.raises(rpi_ipc.ProtocolError):
+        rpi_ipc.decode(rpi_ipc.FRAME_HEADER.pack(rpi_ipc.MAGIC, rpi_ipc.PROTOCOL_VERSION, 1) + b"\xff")
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import rpi_ipc
+from calibration import Calibration
+from canvas import Canvas, Colour
+from dat import Vector2
+from emulator import Emulator
+from recording import FrameRecorder, Recording
+from replay import replay
+
+
+DIMENSIONS = Vector2(64, 64)
+FILL_AT = 15
+
+
+@pytest.fixture
+def recording(tmp_path):
+    # a bar drawn once at the start and never again, with a dot leaving a trail across it, and a fill part way
+    # through. like a controller would, it starts with a clear
+    canvas = Canvas(DIMENSIONS, calibration=Calibration.default(DIMENSIONS))
+    recorder = FrameRecorder(str(tmp_path / "bar.rec"))
+    recorder.record(rpi_ipc.encode_clear())
+
+    for n in range(1, 21):
+        if n == 1:
+            canvas.set_mask(Vector2(0, 30), np.ones((5, 64), dtype=bool), Colour(0, 200, 0))
+        if n == FILL_AT:
+            canvas.set_fill(Canvas.FILLTYPE.FILL, Colour(0, 0, 40))
+        else:
+            canvas.set_fill(Canvas.FILLTYPE.NONE)
+
+        canvas.set_pixel(Vector2(n * 3, n), Colour(255, 255, 255))
+        recorder.record(canvas.update_changes())
+
+    recorder.close()
+    with Recording(recorder.path) as recording:
+        yield recording
+
+
+def panel_after(recording: Recording, end: int) -> np.ndarray:
+    # what the panel shows after playing messages 0 to end (exclusive) in order
+    panel = Emulator(DIMENSIONS)
+    for message in recording.messages(0, end):
+        panel.feed(message)
+
+    return panel.framebuffer
+
+
+def replayed(tmp_path, recording: Recording, start: int, end: int = -1) -> np.ndarray:
+    # replay into another recording, then play that onto a panel that's showing something else entirely
+    sink = FrameRecorder(str(tmp_path / "replayed.rec"))
+    replay(recording, sink, speed=0, start=start, end=end)
+    sink.close()
+
+    panel = Emulator(DIMENSIONS)
+    panel.framebuffer[:] = 123
+    with Recording(sink.path) as played:
+        for message in played:
+            panel.feed(message)
+
+    return panel.framebuffer
+
+
+def test_keyframes(recording):
+    assert recording.is_keyframe(0)
+    assert recording.is_keyframe(FILL_AT)
+    assert not any(recording.is_keyframe(n) for n in range(1, FILL_AT))
+
+    assert recording.keyframe_before(0) == 0
+    assert recording.keyframe_before(FILL_AT) == 0
+    assert recording.keyframe_before(FILL_AT + 1) == FILL_AT
+    assert recording.keyframe_before(len(recording) + 10) == FILL_AT
+
+
+@pytest.mark.parametrize("start", [0, 1, 2, 11, FILL_AT, FILL_AT + 1, 20])
+def test_start_part_way_through_shows_what_was_there(tmp_path, recording, start):
+    # the bar is only in message 1, so it has to come from catching up
+    assert np.array_equal(replayed(tmp_path, recording, start, start + 1), panel_after(recording, start + 1))
+    assert np.array_equal(replayed(tmp_path, recording, start), panel_after(recording, len(recording)))
+
+
+def test_no_clear_plays_on_top(tmp_path, recording):
+    sink = FrameRecorder(str(tmp_path / "replayed.rec"))
+    replay(recording, sink, speed=0, start=11, clear=False)
+    sink.close()
+
+    with Recording(sink.path) as played:
+        assert list(played) == list(recording.messages(11))
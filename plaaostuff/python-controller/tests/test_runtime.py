@@ -0,0 +1,119 @@
+import asyncio
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from runtime import Runtime
+from scheduler import FrameScheduler
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    # a stand-in for a slow web api; answers every GET after the server's delay
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        body = "+12°C|+10°C".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def slow_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    server.delay = 0.5
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(url: str) -> bytes:
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return response.read()
+
+
+async def run_until(runtime: Runtime, render, done, timeout: float = 5):
+    # run the runtime until done() is true, then stop it
+    task = asyncio.create_task(runtime.main(render))
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+
+def test_read_lines_from_a_fifo(tmp_path):
+    path = str(tmp_path / "sensors")
+    os.mkfifo(path)
+
+    runtime = Runtime(FrameScheduler(0.01))
+    lines = []
+    runtime.read_lines(path, lines.append)
+
+    async def main():
+        async def feed():
+            # lines can be split across writes, and a partial one at the end waits for the rest
+            await asyncio.sleep(0.05)
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            os.write(fd, b"bedroom 21.5 40\noutside 9")
+            await asyncio.sleep(0.05)
+            os.write(fd, b".5 80\npartial")
+            os.close(fd)
+
+        feeding = asyncio.create_task(feed())
+        await run_until(runtime, lambda: None, lambda: len(lines) >= 2)
+        await feeding
+
+    asyncio.run(main())
+    assert lines == ["bedroom 21.5 40", "outside 9.5 80"]
+
+
+def test_run_blocking_returns_the_result():
+    assert asyncio.run(Runtime.run_blocking(sum, [1, 2, 3])) == 6
+
+
+def test_run_blocking_gives_up_after_timeout():
+    release = threading.Event()
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await Runtime.run_blocking(release.wait, 5, timeout=0.05)
+
+        # the thread's still blocked; let it go so the executor can shut down
+        release.set()
+
+    start = time.monotonic()
+    asyncio.run(main())
+    assert time.monotonic() - start < 2
+
+
+def test_render_loop_keeps_ticking_during_a_slow_fetch(slow_server):
+    url = "http://127.0.0.1:{}/weather".format(slow_server.server_address[1])
+    runtime = Runtime(FrameScheduler(0.02))
+
+    frames = []
+    fetched = {}
+
+    async def fetch_weather():
+        fetched["start"] = time.monotonic()
+        fetched["body"] = await Runtime.run_blocking(fetch, url, timeout=5)
+        fetched["end"] = time.monotonic()
+
+    runtime.add_task(fetch_weather)
+    asyncio.run(run_until(runtime, lambda: frames.append(time.monotonic()), lambda: "end" in fetched))
+
+    assert fetched["body"] == "+12°C|+10°C".encode()
+    during = [t for t in frames if fetched["start"] <= t <= fetched["end"]]
+    # 0.5s at 50 frames a second; allow plenty of slack for a busy machine
+    assert len(during) >= 10
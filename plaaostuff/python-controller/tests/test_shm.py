@@ -0,0 +1,156 @@
+import random
+
+import numpy as np
+import pytest
+
+import rpi_ipc
+from dat import Vector2
+from emulator import Emulator
+from recording import FrameRecorder, Recording
+from shm import SEQ, SHM_SEQ_OFFSETS, ShmFrameReader, ShmFrameWriter
+
+
+DIMENSIONS = Vector2(64, 64)
+
+
+def random_frame(rng: random.Random) -> np.ndarray:
+    return np.frombuffer(bytes(rng.randrange(256) for _ in range(64 * 64 * 3)), dtype=np.uint8).reshape(64, 64, 3)
+
+
+def test_emulator_shows_frames_from_shared_memory(tmp_path):
+    path = str(tmp_path / "fb")
+    rng = random.Random(1)
+
+    # the SHM_FRAME messages are caught in a recording and fed to the emulator from there
+    recorder = FrameRecorder(str(tmp_path / "messages.rec"))
+    writer = ShmFrameWriter(DIMENSIONS, recorder, path)
+    emulator = Emulator(DIMENSIONS, shm_path=path)
+
+    frames = [random_frame(rng) for _ in range(3)]
+    for frame in frames:
+        writer.send(frame)
+    recorder.close()
+
+    with Recording(recorder.path) as recording:
+        assert [rpi_ipc.decode(message)[0][0] for message in recording] == ["SHM_FRAME"] * 3
+
+        # the latest frame is the only one still there; the first would have been written over by the third
+        for message in recording:
+            emulator.feed(message)
+        assert np.array_equal(emulator.framebuffer, frames[-1])
+
+        emulator.framebuffer[:] = 0
+        emulator.feed(recording[0])
+        assert not emulator.framebuffer.any()
+
+    reader = ShmFrameReader(path)
+    assert reader.dimensions == DIMENSIONS
+    assert np.array_equal(reader.latest(), frames[-1])
+
+    emulator.shm.close()
+    reader.close()
+    writer.close()
+
+
+def test_reader_skips_frames_being_written(tmp_path):
+    path = str(tmp_path / "fb")
+    rng = random.Random(2)
+    writer = ShmFrameWriter(DIMENSIONS, None, path)
+    reader = ShmFrameReader(path)
+
+    writer.send(random_frame(rng))
+    index, seq = writer.front, writer.seq
+    assert reader.read(index, seq) is not None
+
+    # the writer zeroes a buffer's sequence number while it's writing to it
+    SEQ.pack_into(writer.map, SHM_SEQ_OFFSETS[index], 0)
+    assert reader.read(index, seq) is None
+    assert reader.read(index, 0) is None
+    SEQ.pack_into(writer.map, SHM_SEQ_OFFSETS[index], seq)
+
+    # two frames later, the same buffer holds something else
+    writer.send(random_frame(rng))
+    writer.send(random_frame(rng))
+    assert writer.front == index
+    assert reader.read(index, seq) is None
+    assert reader.read(index, writer.seq) is not None
+
+    reader.close()
+    writer.close()
+
+
+class TornMap(bytearray):
+    # a copy of the shared memory that the writer starts on again while the reader is copying a buffer out of it
+    def __getitem__(self, key):
+        data = super().__getitem__(key)
+        if isinstance(key, slice):
+            for offset in SHM_SEQ_OFFSETS:
+                SEQ.pack_into(self, offset, 0)
+
+        return data
+
+
+def test_reader_skips_frames_written_over_mid_copy(tmp_path):
+    path = str(tmp_path / "fb")
+    writer = ShmFrameWriter(DIMENSIONS, None, path)
+    reader = ShmFrameReader(path)
+
+    writer.send(random_frame(random.Random(3)))
+    reader.map.close()
+    reader.map = TornMap(writer.map)
+    assert reader.read(writer.front, writer.seq) is None
+
+    writer.close()
+
+
+def test_reader_refuses_mismatched_headers(tmp_path):
+    path = str(tmp_path / "fb")
+
+    with open(path, "wb") as f:
+        f.write(bytes(4096))
+    with pytest.raises(rpi_ipc.ProtocolError):
+        ShmFrameReader(path)
+
+    # a header for frames bigger than the file has room for
+    writer = ShmFrameWriter(Vector2(8, 8), None, path)
+    writer.map[6:10] = bytes((64, 0, 64, 0))
+    with pytest.raises(rpi_ipc.ProtocolError):
+        ShmFrameReader(path)
+    writer.close()
+
+    # and a writer that's started over at a different size since the reader opened it
+    writer = ShmFrameWriter(DIMENSIONS, None, path)
+    reader = ShmFrameReader(path)
+    writer.send(random_frame(random.Random(4)))
+    writer.close()
+
+    writer = ShmFrameWriter(Vector2(32, 32), None, path)
+    writer.send(np.zeros((32, 32, 3), dtype=np.uint8))
+    with pytest.raises(rpi_ipc.ProtocolError):
+        reader.read(writer.front, writer.seq)
+
+    reader.close()
+    writer.close()
+
+
+def test_emulator_reopens_shared_memory_that_changed_size(tmp_path):
+    path = str(tmp_path / "fb")
+    emulator = Emulator(DIMENSIONS, shm_path=path)
+
+    writer = ShmFrameWriter(DIMENSIONS, None, path)
+    writer.send(random_frame(random.Random(5)))
+    emulator.feed(rpi_ipc.encode_shm_frame(writer.front, writer.seq))
+    writer.close()
+
+    small = np.full((32, 32, 3), 9, dtype=np.uint8)
+    writer = ShmFrameWriter(Vector2(32, 32), None, path)
+    writer.send(small)
+
+    # the first one after the change is dropped, then it's opened again at the new size
+    emulator.feed(rpi_ipc.encode_shm_frame(writer.front, writer.seq))
+    assert emulator.shm is None
+    emulator.feed(rpi_ipc.encode_shm_frame(writer.front, writer.seq))
+    assert np.array_equal(emulator.framebuffer[:32, :32], small)
+
+    emulator.shm.close()
+    writer.close()
@@ -0,0 +1,127 @@
+"""Caching for rendered text, so strings that don't change between frames aren't re-rendered."""
+
+from collections import OrderedDict
+from typing import Dict, Tuple, Union
+
+import bdfparser
+import numpy as np
+
+
+class GlyphAtlas:
+    """
+    Every glyph of a font rasterised once, as a boolean mask plus how far to advance after drawing it.
+
+    Glyphs are rasterised the first time they're used, so big unicode fonts don't pay for characters that never
+    get drawn. Use GlyphAtlas.for_font() to share one atlas per font.
+
+    :param font: The font to rasterise
+    """
+
+    atlases: Dict[bdfparser.Font, "GlyphAtlas"] = {}
+
+    @classmethod
+    def for_font(cls, font: bdfparser.Font) -> "GlyphAtlas":
+        atlas = cls.atlases.get(font)
+        if atlas is None:
+            atlas = cls(font)
+            cls.atlases[font] = atlas
+
+        return atlas
+
+    def __init__(self, font: bdfparser.Font):
+        self.font = font
+        self.glyphs: Dict[str, Tuple[np.ndarray, int]] = {}
+
+    def glyph(self, c: str) -> Tuple[np.ndarray, int]:
+        entry = self.glyphs.get(c)
+        if entry is None:
+            glyph = self.font.glyph(c)
+            if glyph is None:
+                # not in the font, so leave a gap the size of the font's bounding box
+                mask = np.zeros((self.font.headers["fbby"], self.font.headers["fbbx"]), dtype=bool)
+            else:
+                bitmap = glyph.draw()
+                mask = np.array(bitmap.todata(2), dtype=bool).reshape(bitmap.height(), bitmap.width())
+
+            # glyphs have always been laid out edge to edge at the width they're drawn at
+            mask.flags.writeable = False
+            entry = (mask, mask.shape[1])
+            self.glyphs[c] = entry
+
+        return entry
+
+    def render(self, text: str) -> Union[np.ndarray, None]:
+        if not text:
+            return None
+
+        glyphs = [self.glyph(c) for c in text]
+        height = max(mask.shape[0] for mask, _ in glyphs)
+        out = np.zeros((height, sum(advance for _, advance in glyphs)), dtype=bool)
+
+        # blit each glyph in at its offset, lined up along the bottom
+        x = 0
+        for mask, advance in glyphs:
+            out[height - mask.shape[0]:, x:x + mask.shape[1]] = mask
+            x += advance
+
+        out.flags.writeable = False
+        return out
+
+
+def render_text(font: bdfparser.Font, text: str) -> Union[np.ndarray, None]:
+    """
+    Render a string to a (height, width) boolean mask of which pixels are lit, or None if there's nothing to draw.
+
+    :param font: The font to render with
+    :param text: The text to render
+    """
+    return GlyphAtlas.for_font(font).render(text)
+
+
+class TextCache:
+    """
+    A bounded LRU cache of rendered text masks keyed on (font, text).
+
+    :param max_size: How many rendered strings to keep before the least recently used one is thrown away
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries: "OrderedDict[tuple, Union[np.ndarray, None]]" = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return "{} entries, {} hits, {} misses ({:.1%} hit rate)".format(
+            len(self), self.hits, self.misses, self.hit_rate
+        )
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, font: bdfparser.Font, text: str) -> Union[np.ndarray, None]:
+        key = (font, text)
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        self.misses += 1
+        mask = render_text(font, text)
+
+        self.entries[key] = mask
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return mask
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
@@ -0,0 +1,180 @@
+"""Fixed-size history for sensor readings, and sparklines to draw it with."""
+
+import math
+import time
+from typing import Tuple, Union
+
+import numpy as np
+
+from canvas import Colour, Surface
+from dat import Vector2
+
+
+class TimeSeries:
+    """
+    A ring buffer of timestamped readings, each with a value for every channel (e.g. temperature and humidity).
+    Appending is O(1), and once it's full the oldest readings get overwritten, so memory use never grows.
+
+    :param capacity: How many readings to keep
+    :param channels: How many values each reading has
+    """
+
+    def __init__(self, capacity: int, channels: int = 1):
+        self.capacity = capacity
+        self.channels = channels
+
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.values = np.zeros((capacity, channels), dtype=np.float32)
+
+        # where the next reading goes, and how many readings there are
+        self.head = 0
+        self.count = 0
+
+        # goes up on every append, so anything built from the series knows when it's out of date
+        self.version = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, t: float, *values: float):
+        self.times[self.head] = t
+        self.values[self.head] = values
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.version += 1
+
+    @property
+    def latest_time(self) -> Union[float, None]:
+        if not self.count:
+            return None
+
+        return float(self.times[self.head - 1])
+
+    def latest(self) -> Union[Tuple[float, ...], None]:
+        if not self.count:
+            return None
+
+        return tuple(self.values[self.head - 1].tolist())
+
+    def ordered(self) -> Tuple[np.ndarray, np.ndarray]:
+        # every reading, oldest first, as (times, values). these are copies
+        start = (self.head - self.count) % self.capacity
+        order = (np.arange(self.count) + start) % self.capacity
+        return self.times[order], self.values[order]
+
+    def window(self, start: float, end: float, buckets: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Downsample the readings from start up to end into evenly sized buckets. Returns the (min, max, avg) of each
+        bucket as (buckets, channels) arrays; buckets without any readings in them are nan.
+
+        :param start: The start of the window, inclusive
+        :param end: The end of the window, exclusive
+        :param buckets: How many buckets to split the window into
+        """
+        times, values = self.ordered()
+        inside = (times >= start) & (times < end)
+        times, values = times[inside], values[inside]
+
+        index = ((times - start) * (buckets / (end - start))).astype(int)
+        np.clip(index, 0, buckets - 1, out=index)
+
+        mins = np.full((buckets, self.channels), np.inf, dtype=np.float32)
+        maxs = np.full((buckets, self.channels), -np.inf, dtype=np.float32)
+        sums = np.zeros((buckets, self.channels), dtype=np.float64)
+        np.minimum.at(mins, index, values)
+        np.maximum.at(maxs, index, values)
+        np.add.at(sums, index, values)
+        counts = np.bincount(index, minlength=buckets)[:, None]
+
+        empty = counts[:, 0] == 0
+        mins[empty] = np.nan
+        maxs[empty] = np.nan
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avgs = (sums / counts).astype(np.float32)
+
+        return mins, maxs, avgs
+
+
+class Sparkline:
+    """
+    A tiny graph of one channel of a TimeSeries over the last span seconds, one column per bucket. The range of each
+    bucket is drawn as a bar, with the average on top of it.
+
+    The graph is kept as a pair of masks, only rebuilt when there's a new reading or the buckets move along, so
+    drawing it every frame costs the same however much history there is.
+
+    :param series: The series to graph
+    :param size: The size of the graph in pixels; one bucket per column
+    :param span: How far back the graph goes, in seconds
+    :param channel: Which channel of the series to graph
+    :param limits: The values at the bottom and top of the graph. if not given, it scales to fit what's shown
+    """
+
+    def __init__(
+            self, series: TimeSeries, size: Vector2, span: float, channel: int = 0,
+            limits: Union[Tuple[float, float], None] = None
+    ):
+        self.series = series
+        self.size = size
+        self.span = span
+        self.channel = channel
+        self.limits = limits
+
+        self.bucket_width = span / size.x
+
+        self.range_mask = np.zeros((size.y, size.x), dtype=bool)
+        self.avg_mask = np.zeros((size.y, size.x), dtype=bool)
+        self.cache_key = None
+
+    def _rows(self, values: np.ndarray, lo: float, hi: float) -> np.ndarray:
+        # which row each value lands on, with the top row being hi
+        scale = (self.size.y - 1) / (hi - lo) if hi > lo else 0
+        rows = (self.size.y - 1) - np.rint((values - lo) * scale)
+        return np.clip(np.nan_to_num(rows), 0, self.size.y - 1).astype(int)
+
+    def update(self, now: Union[float, None] = None) -> bool:
+        """
+        Rebuild the masks if they're out of date. Returns whether they were.
+        """
+        if now is None:
+            now = time.time()
+
+        # buckets are lined up with the clock so they only move along once per bucket
+        end_bucket = math.floor(now / self.bucket_width) + 1
+        key = (self.series.version, end_bucket)
+        if key == self.cache_key:
+            return False
+
+        self.cache_key = key
+        self.range_mask[:] = False
+        self.avg_mask[:] = False
+
+        end = end_bucket * self.bucket_width
+        mins, maxs, avgs = self.series.window(end - self.span, end, self.size.x)
+        mins, maxs, avgs = mins[:, self.channel], maxs[:, self.channel], avgs[:, self.channel]
+
+        columns = np.flatnonzero(~np.isnan(avgs))
+        if not len(columns):
+            return True
+
+        lo, hi = self.limits if self.limits else (float(mins[columns].min()), float(maxs[columns].max()))
+        tops, bottoms = self._rows(maxs[columns], lo, hi), self._rows(mins[columns], lo, hi)
+
+        # fill each column from its max down to its min
+        rows = np.arange(self.size.y)[:, None]
+        self.range_mask[:, columns] = (rows >= tops) & (rows <= bottoms)
+        self.avg_mask[self._rows(avgs[columns], lo, hi), columns] = True
+
+        return True
+
+    def draw(self, surface: Surface, pos: Vector2, col: Colour, range_col: Union[Colour, None] = None):
+        """
+        Draw the graph with its top left at pos.
+
+        :param col: The colour of the averages
+        :param range_col: The colour of the range bars. defaults to a dimmer col
+        """
+        self.update()
+
+        surface.set_mask(pos, self.range_mask, range_col if range_col is not None else col.fade_black(0.6))
+        surface.set_mask(pos, self.avg_mask, col)
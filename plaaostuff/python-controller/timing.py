@@ -0,0 +1,181 @@
+"""
+Opt-in timing of each stage of a frame (rendering, text, diffing, encoding, writing to the pipe...), for working out
+what's eating the frame budget on a live panel.
+
+Wrap a stage in a span:
+
+    with timing.span("encode"):
+        ...
+
+Spans cost next to nothing until timing.enable() is called. Once it is, every span keeps the last few hundred
+durations it took, and report() prints a line of percentiles for each (and writes them to a stats file, if there is
+one) every so often.
+"""
+
+import json
+import os
+import time
+from typing import Dict, Union
+
+import numpy as np
+
+
+class RollingStats:
+    """
+    The last window durations of something, in nanoseconds, for rolling percentiles.
+
+    :param window: How many durations to keep
+    """
+
+    def __init__(self, window: int = 512):
+        self.samples = np.zeros(window, dtype=np.int64)
+        self.head = 0
+        self.count = 0
+
+        # over all time, not just the window
+        self.total_count = 0
+        self.total_ns = 0
+
+    def add(self, ns: int):
+        self.samples[self.head] = ns
+        self.head = (self.head + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+        self.total_count += 1
+        self.total_ns += ns
+
+    def percentiles(self, *qs: float) -> np.ndarray:
+        # in milliseconds
+        if not self.count:
+            return np.zeros(len(qs))
+
+        return np.percentile(self.samples[:self.count], qs) / 1e6
+
+    def summary(self) -> Dict[str, float]:
+        p50, p95, p99 = self.percentiles(50, 95, 99)
+        return {
+            "count": self.total_count,
+            "mean_ms": self.total_ns / self.total_count / 1e6 if self.total_count else 0.0,
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "max_ms": float(self.samples[:self.count].max() / 1e6) if self.count else 0.0,
+        }
+
+
+class Span:
+    __slots__ = ("stats", "start")
+
+    def __init__(self, stats: RollingStats):
+        self.stats = stats
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(time.perf_counter_ns() - self.start)
+
+
+class _NoSpan:
+    # what span() hands out while timing's off
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+class Timings:
+    """
+    Every named span, and when to report on them.
+
+    :param interval: How often report() actually reports, in seconds
+    :param path: A stats file to write the percentiles to whenever they're reported, if any
+    :param window: How many durations each span keeps
+    """
+
+    def __init__(self, interval: float = 10, path: Union[str, None] = None, window: int = 512):
+        self.interval = interval
+        self.path = path
+        self.window = window
+
+        self.stats: Dict[str, RollingStats] = {}
+        self.spans: Dict[str, Span] = {}
+        self.last_report = time.monotonic()
+
+    def span(self, name: str) -> Span:
+        span = self.spans.get(name)
+        if span is None:
+            self.stats[name] = RollingStats(self.window)
+            span = self.spans[name] = Span(self.stats[name])
+
+        return span
+
+    def __str__(self):
+        return " | ".join(
+            "{} p50 {:.2f} p95 {:.2f} p99 {:.2f}ms".format(name, *stats.percentiles(50, 95, 99))
+            for name, stats in self.stats.items()
+        )
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {name: stats.summary() for name, stats in self.stats.items()}
+
+    def write(self, path: str):
+        # written to a temporary file and moved into place, so anything watching the file never sees half of it
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump({"time": time.time(), "spans": self.summary()}, f, indent=2)
+
+        os.replace(tmp_path, path)
+
+    def report(self, force: bool = False) -> bool:
+        """
+        Print the percentiles (and write the stats file) if it's been interval seconds since the last time. Returns
+        whether it did.
+        """
+        now = time.monotonic()
+        if not force and now - self.last_report < self.interval:
+            return False
+
+        self.last_report = now
+        print("\ntimings: {}".format(self))
+        if self.path:
+            self.write(self.path)
+
+        return True
+
+
+# the timings everything reports to, while enabled
+timings: Union[Timings, None] = None
+
+
+def enable(interval: float = 10, path: Union[str, None] = None, window: int = 512) -> Timings:
+    global timings
+    timings = Timings(interval, path, window)
+    return timings
+
+
+def disable():
+    global timings
+    timings = None
+
+
+def span(name: str) -> Union[Span, _NoSpan]:
+    if timings is None:
+        return _no_span
+
+    return timings.span(name)
+
+
+def report(force: bool = False) -> bool:
+    if timings is None:
+        return False
+
+    return timings.report(force)